@@ -0,0 +1,363 @@
+"""Device, dtype and quantization selection for loading the chat model.
+
+The backend is picked by ``BackendConfig``, read from the environment by
+``web_demo.py`` and from the command line by ``server.py``:
+
+    CHAT_DEVICE         auto | cuda | cpu
+    CHAT_DTYPE          bfloat16 | float16 | float32
+    CHAT_QUANTIZATION   none | int8 | int4  (CPU only)
+    CHAT_NUM_THREADS    intra-op threads on CPU, physical cores by default
+    CHAT_QUANTIZED_CACHE_DIR  where quantized models are cached
+
+``int8`` swaps every linear layer but ``lm_head`` for dynamically quantized
+int8 kernels (fp32 activations). ``int4`` stores group-wise 4-bit weights
+and dequantizes them on the fly, trading speed for memory. Quantizing the
+7B model takes minutes, so its state dict is saved to disk and loaded back
+with ``weights_only`` into the empty quantized model.
+
+Checkpoints converted by ``weights.py`` are memory-mapped on CPU, so the
+unquantized weights are shared between processes through the page cache.
+Everything else is streamed tensor by tensor into the target dtype. Load
+time and peak RSS are logged and kept on ``model.load_stats``.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import psutil
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from transformers import AutoTokenizer
+from transformers.utils import logging
+
+from weights import (empty_model, finish_model, has_safetensors,
+                     load_mmap_model, load_streaming)
+
+logger = logging.get_logger(__name__)
+
+DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+    'float32': torch.float32,
+}
+QUANTIZATIONS = ('none', 'int8', 'int4')
+
+
+@dataclass
+class BackendConfig:
+    device: str = 'auto'
+    dtype: str = 'bfloat16'
+    quantization: str = 'none'
+    num_threads: Optional[int] = None
+    quantized_cache_dir: str = os.path.join(
+        os.path.expanduser('~'), '.cache', 'cuihun', 'quantized')
+
+    @classmethod
+    def from_env(cls):
+        config = cls()
+        config.device = os.environ.get('CHAT_DEVICE', config.device)
+        config.dtype = os.environ.get('CHAT_DTYPE', config.dtype)
+        config.quantization = os.environ.get('CHAT_QUANTIZATION',
+                                             config.quantization)
+        if os.environ.get('CHAT_NUM_THREADS'):
+            config.num_threads = int(os.environ['CHAT_NUM_THREADS'])
+        config.quantized_cache_dir = os.environ.get(
+            'CHAT_QUANTIZED_CACHE_DIR', config.quantized_cache_dir)
+        return config
+
+    def resolve(self):
+        """Fill in ``auto`` choices and fall back to what the host can run."""
+        if self.dtype not in DTYPES:
+            raise ValueError(f'unknown dtype {self.dtype!r}, '
+                             f'expected one of {sorted(DTYPES)}')
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f'unknown quantization {self.quantization!r}, '
+                             f'expected one of {QUANTIZATIONS}')
+        device = self.device
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        dtype = self.dtype
+        if device == 'cpu':
+            if dtype == 'float16' or (dtype == 'bfloat16'
+                                      and not cpu_supports_bf16()):
+                # fp16 matmuls and emulated bf16 are slow on CPU
+                logger.warning(f'{dtype} is not native on this CPU, '
+                               'falling back to float32')
+                dtype = 'float32'
+            if self.quantization == 'int8':
+                # dynamic int8 kernels take fp32 activations
+                dtype = 'float32'
+        elif self.quantization != 'none':
+            raise ValueError('quantization is only supported on CPU')
+        num_threads = self.num_threads
+        if device == 'cpu' and num_threads is None:
+            # hyperthreads only add contention to the matmul kernels
+            num_threads = psutil.cpu_count(logical=False) or os.cpu_count()
+        return BackendConfig(device=device,
+                             dtype=dtype,
+                             quantization=self.quantization,
+                             num_threads=num_threads,
+                             quantized_cache_dir=self.quantized_cache_dir)
+
+
+@dataclass
+class LoadStats:
+    load_s: float
+    start_rss_bytes: int
+    peak_rss_bytes: int
+    model_bytes: int
+
+
+class PeakMemory:
+    """Sample the resident set size of this process in the background and
+    keep the largest value seen while the context is active."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start_rss_bytes = self.peak_rss_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        self.peak_rss_bytes = max(self.peak_rss_bytes,
+                                  self.process.memory_info().rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.start_rss_bytes = self.peak_rss_bytes = (
+            self.process.memory_info().rss)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def model_nbytes(model):
+    return sum(t.numel() * t.element_size()
+               for t in (*model.parameters(), *model.buffers()))
+
+
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+class Int4Linear(nn.Module):
+    """Linear layer with group-wise asymmetric 4-bit weights.
+
+    Two weights are packed per byte, an odd last column is padded with a
+    zero nibble; each group of ``group_size`` input features has its own
+    scale and zero point. Weights are dequantized to ``dtype`` on every
+    forward. ``from_float`` quantizes an ``nn.Linear``, the constructor
+    only allocates the buffers a state dict is loaded into.
+    """
+
+    def __init__(self,
+                 in_features,
+                 out_features,
+                 bias=True,
+                 group_size=128,
+                 dtype=torch.float32):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.dtype = dtype
+        if in_features % group_size:
+            group_size = in_features
+        self.group_size = group_size
+        num_groups = in_features // group_size
+        self.register_buffer(
+            'packed',
+            torch.zeros(out_features, (in_features + 1) // 2,
+                        dtype=torch.uint8))
+        self.register_buffer('scale',
+                             torch.ones(out_features, num_groups, 1,
+                                        dtype=dtype))
+        self.register_buffer('zero',
+                             torch.zeros(out_features, num_groups, 1,
+                                         dtype=dtype))
+        self.bias = (nn.Parameter(torch.zeros(out_features, dtype=dtype),
+                                  requires_grad=False) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear, group_size=128, dtype=None):
+        module = cls(linear.in_features,
+                     linear.out_features,
+                     bias=linear.bias is not None,
+                     group_size=group_size,
+                     dtype=dtype or linear.weight.dtype)
+        weight = linear.weight.detach().float()
+        groups = weight.reshape(module.out_features, -1, module.group_size)
+        low = groups.amin(-1, keepdim=True)
+        high = groups.amax(-1, keepdim=True)
+        scale = ((high - low) / 15).clamp(min=1e-8)
+        zero = (-low / scale).round().clamp(0, 15)
+        q = (groups / scale + zero).round().clamp(0, 15).to(torch.uint8)
+        q = F.pad(q.reshape(module.out_features, module.in_features),
+                  (0, module.in_features % 2))
+        module.packed = q[:, 0::2] | (q[:, 1::2] << 4)
+        module.scale = scale.to(module.dtype)
+        module.zero = zero.to(module.dtype)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    def dequantize(self):
+        q = torch.stack([self.packed & 0xF, self.packed >> 4], dim=-1)
+        q = q.reshape(self.out_features, -1)[:, :self.in_features]
+        q = q.reshape(self.out_features, -1, self.group_size).to(self.dtype)
+        return ((q - self.zero) * self.scale).reshape(self.out_features,
+                                                      self.in_features)
+
+    def forward(self, x):
+        return F.linear(x.to(self.dtype), self.dequantize(), self.bias)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, '
+                f'out_features={self.out_features}, '
+                f'group_size={self.group_size}')
+
+
+def quantized_linear_names(model):
+    """Every linear layer but ``lm_head``."""
+    return [
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name != 'lm_head'
+    ]
+
+
+def replace_module(model, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name), child_name, module)
+
+
+def quantize_model(model, quantization, dtype=torch.float32):
+    """Quantize every linear layer but ``lm_head`` in place."""
+    names = quantized_linear_names(model)
+    if quantization == 'int8':
+        return torch.ao.quantization.quantize_dynamic(
+            model,
+            {name: torch.ao.quantization.default_dynamic_qconfig
+             for name in names},
+            dtype=torch.qint8)
+    if quantization == 'int4':
+        for name in names:
+            replace_module(
+                model, name,
+                Int4Linear.from_float(model.get_submodule(name),
+                                      dtype=dtype))
+        return model
+    raise ValueError(f'unknown quantization {quantization!r}')
+
+
+def empty_quantized_model(model_path, quantization, dtype):
+    """The model ``quantize_model`` returns, with empty quantized layers
+    and the other parameters on the meta device, to load a state dict
+    into."""
+    model = empty_model(model_path,
+                        torch.float32 if quantization == 'int8' else dtype)
+    for name in quantized_linear_names(model):
+        linear = model.get_submodule(name)
+        if quantization == 'int8':
+            module = torch.ao.nn.quantized.dynamic.Linear(
+                linear.in_features,
+                linear.out_features,
+                bias_=linear.bias is not None,
+                dtype=torch.qint8)
+        else:
+            module = Int4Linear(linear.in_features,
+                                linear.out_features,
+                                bias=linear.bias is not None,
+                                dtype=dtype)
+        replace_module(model, name, module)
+    return model
+
+
+def quantized_cache_path(model_path, config):
+    """One cache file per checkpoint contents and backend options."""
+    fingerprint = {
+        'format': 'state_dict',
+        'dtype': config.dtype,
+        'quantization': config.quantization,
+        'torch': torch.__version__,
+    }
+    for file_name in sorted(os.listdir(model_path)):
+        stat = os.stat(os.path.join(model_path, file_name))
+        fingerprint[file_name] = [stat.st_size, stat.st_mtime_ns]
+    digest = hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(config.quantized_cache_dir,
+                        f'{config.quantization}-{digest}.pt')
+
+
+def configure_threads(config):
+    if config.device != 'cpu' or not config.num_threads:
+        return
+    torch.set_num_threads(config.num_threads)
+    try:
+        # one request at a time per process, keep inter-op parallelism off
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # only allowed before the first parallel region runs
+        pass
+
+
+def build_model(model_path, config):
+    dtype = DTYPES[config.dtype]
+    if config.quantization == 'none':
+        if config.device == 'cpu' and has_safetensors(model_path):
+            return load_mmap_model(model_path, dtype)
+        return load_streaming(model_path, dtype, config.device)
+
+    cache_path = quantized_cache_path(model_path, config)
+    if os.path.exists(cache_path):
+        model = empty_quantized_model(model_path, config.quantization, dtype)
+        model.load_state_dict(torch.load(cache_path,
+                                         map_location='cpu',
+                                         weights_only=True),
+                              assign=True)
+        return finish_model(model, model_path)
+    model = load_streaming(
+        model_path,
+        torch.float32 if config.quantization == 'int8' else dtype)
+    model = quantize_model(model, config.quantization, dtype)
+    os.makedirs(config.quantized_cache_dir, exist_ok=True)
+    torch.save(model.state_dict(), cache_path + '.tmp')
+    os.replace(cache_path + '.tmp', cache_path)
+    return model
+
+
+def load_pretrained(model_path, config: Optional[BackendConfig] = None):
+    """Load model and tokenizer on the backend described by ``config``."""
+    config = (config or BackendConfig()).resolve()
+    configure_threads(config)
+    tokenizer = AutoTokenizer.from_pretrained(model_path,
+                                              trust_remote_code=True)
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+        model = build_model(model_path, config)
+    model.load_stats = LoadStats(load_s=time.perf_counter() - start,
+                                 start_rss_bytes=memory.start_rss_bytes,
+                                 peak_rss_bytes=memory.peak_rss_bytes,
+                                 model_bytes=model_nbytes(model))
+    logger.info(f'loaded {model_path}: {asdict(model.load_stats)}')
+    return model, tokenizer
@@ -0,0 +1,176 @@
+"""Generate a reply for every prompt of a dataset, batch by batch.
+
+Prompts come from an xtuner style ``.json`` file such as
+``data/cuihun-chinese-v0.1.json``, or from ``.jsonl`` with one such record
+(or ``{"input": ...}``) per line. They are sorted by token length so a
+batch pads little, and every finished batch is appended to the output
+JSONL right away. Running the same command again skips the prompts the
+output already answers:
+
+    python batch_generate.py ../data/cuihun-chinese-v0.1.json \\
+        ../finetune/replies.jsonl --model-path ../finetune/merge \\
+        --temperature 0 --max-new-tokens 256
+"""
+import argparse
+import json
+import os
+import time
+from dataclasses import asdict
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from backend import DTYPES, QUANTIZATIONS, BackendConfig, load_pretrained
+from generation import GenerationConfig, generate_batch_interactive
+from history import MessageTokenizer
+from prompts import system_instruction
+
+
+def prompt_record(item: Dict) -> Dict[str, Optional[str]]:
+    """``input`` and, for dataset records, the curated ``reference``."""
+    if 'conversation' in item:
+        turn = item['conversation'][0]
+        return {'input': turn['input'], 'reference': turn.get('output')}
+    return {'input': item['input'], 'reference': item.get('reference')}
+
+
+def load_prompts(path) -> List[Dict[str, Optional[str]]]:
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    return [prompt_record(item) for item in items]
+
+
+def answered_ids(path) -> Set[int]:
+    """Ids already in the output. A line cut short by a crash is dropped,
+    so the prompt is generated again."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    return {json.loads(line)['id'] for line in data[:end].splitlines()}
+
+
+def length_sorted_batches(lengths: Sequence[int],
+                          batch_size: int,
+                          max_batch_tokens: Optional[int] = None
+                          ) -> List[List[int]]:
+    """Indices grouped into batches of similar length.
+
+    A batch is padded to its longest prompt, so with ``max_batch_tokens``
+    it also stops growing once ``rows * longest`` would exceed it.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        # lengths only grow, so the new prompt is the longest
+        if batch and (len(batch) == batch_size or
+                      (max_batch_tokens is not None and
+                       (len(batch) + 1) * lengths[i] > max_batch_tokens)):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def generate_replies(model, tokenizer, prompt_ids: Sequence[List[int]],
+                     batches: Sequence[List[int]],
+                     **kwargs) -> Iterator[List[Tuple[int, str]]]:
+    """``(index, reply)`` pairs of each batch as soon as it finishes.
+
+    Rows stop on their own eos or length limit; ``kwargs`` go to
+    ``generate_batch_interactive``.
+    """
+    for batch in batches:
+        replies = []
+        for replies in generate_batch_interactive(
+                model, tokenizer, [prompt_ids[i] for i in batch], **kwargs):
+            pass
+        yield list(zip(batch, replies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help='xtuner style .json or .jsonl file')
+    parser.add_argument('output', help='.jsonl file, appended to')
+    parser.add_argument('--model-path', default='../finetune/merge')
+    parser.add_argument('--tiny',
+                        action='store_true',
+                        help='a tiny random model, see tiny_model.py')
+    parser.add_argument('--deepthink', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-batch-tokens', type=int, default=None)
+    parser.add_argument('--max-new-tokens', type=int, default=512)
+    parser.add_argument('--temperature',
+                        type=float,
+                        default=GenerationConfig.temperature,
+                        help='0 for greedy decoding')
+    parser.add_argument('--top-p', type=float, default=GenerationConfig.top_p)
+    parser.add_argument('--additional-eos-token-id', type=int, default=92542)
+    parser.add_argument('--device', default='auto')
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='bfloat16')
+    parser.add_argument('--quantization',
+                        choices=QUANTIZATIONS,
+                        default='none')
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+
+    records = load_prompts(args.input)
+    done = answered_ids(args.output)
+    todo = [i for i in range(len(records)) if i not in done]
+    print(f'{len(done)} of {len(records)} prompts already answered')
+    if not todo:
+        return
+    if args.tiny:
+        from tiny_model import load_tiny_model
+        model, tokenizer = load_tiny_model()
+    else:
+        backend_config = BackendConfig.from_env()
+        backend_config.device = args.device
+        backend_config.dtype = args.dtype
+        backend_config.quantization = args.quantization
+        backend_config.num_threads = args.num_threads
+        model, tokenizer = load_pretrained(args.model_path, backend_config)
+
+    message_tokenizer = MessageTokenizer(tokenizer)
+    system = {'role': 'system', 'content': system_instruction(args.deepthink)}
+    prompt_ids = [
+        message_tokenizer.encode_messages(
+            [system, {
+                'role': 'user',
+                'content': records[i]['input']
+            }]) for i in todo
+    ]
+    batches = length_sorted_batches([len(ids) for ids in prompt_ids],
+                                    args.batch_size, args.max_batch_tokens)
+    generation_kwargs = asdict(GenerationConfig())
+    del generation_kwargs['max_length']
+    generation_kwargs.update(max_new_tokens=args.max_new_tokens,
+                             temperature=args.temperature,
+                             top_p=args.top_p)
+    start = time.perf_counter()
+    num_done = 0
+    with open(args.output, 'a', encoding='utf-8') as f:
+        for results in generate_replies(
+                model,
+                tokenizer,
+                prompt_ids,
+                batches,
+                additional_eos_token_id=args.additional_eos_token_id,
+                **generation_kwargs):
+            for i, reply in results:
+                record = dict(id=todo[i], **records[todo[i]], output=reply)
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            num_done += len(results)
+            print(f'{num_done}/{len(todo)} prompts, '
+                  f'{num_done / (time.perf_counter() - start):.2f}/s')
+
+
+if __name__ == '__main__':
+    main()
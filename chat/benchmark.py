@@ -0,0 +1,147 @@
+"""CPU benchmarks for the chat path on a tiny randomly initialised Qwen2.
+
+The benchmarks live in the ``benchmarks`` package, one module per feature,
+and run on the model of tiny_model.py in seconds without a GPU, e.g.
+
+    python benchmark.py system-prompt
+    python benchmark.py compare --threads 4
+    python benchmark.py server --repeats 4
+    python benchmark.py backends
+    python benchmark.py mmap
+    python benchmark.py load
+    python benchmark.py speculative
+    python benchmark.py retrieval
+    python benchmark.py history
+    python benchmark.py segments
+    python benchmark.py batch
+    python benchmark.py render
+    python benchmark.py metrics
+    python benchmark.py profile
+    python benchmark.py cancel
+    python benchmark.py suite --baseline baseline.json --update-baseline
+    python benchmark.py suite --baseline baseline.json
+
+With ``--baseline`` the results are compared to an earlier run saved by
+``--update-baseline``, and the run fails if tokens per second, TTFT or peak
+memory got worse by more than ``--threshold``.
+"""
+import argparse
+import json
+import platform
+import sys
+
+import torch
+
+from benchmarks.conversation import (bench_history, bench_retrieval,
+                                     bench_segments)
+from benchmarks.decoding import (bench_compare, bench_metrics, bench_profile,
+                                 bench_speculative, bench_system_prompt)
+from benchmarks.loading import bench_backends, bench_load, bench_mmap
+from benchmarks.rendering import bench_render
+from benchmarks.serving import bench_batch, bench_cancel, bench_server
+from benchmarks.suite import bench_suite
+from tiny_model import load_tiny_model
+
+# how --baseline compares results, matched against the end of each key
+HIGHER_IS_BETTER = ('tokens_per_s', )
+LOWER_IS_BETTER = ('ttft_ms', 'peak_rss_bytes')
+
+
+def find_regressions(results, baseline, threshold, path=''):
+    """``(key, baseline, result, change)`` of every metric in ``results``
+    that is worse than in ``baseline`` by more than ``threshold``."""
+    regressions = []
+    for key, value in results.items():
+        name = f'{path}/{key}' if path else key
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            regressions.extend(
+                find_regressions(value, baseline[key], threshold, name))
+        elif key.endswith(HIGHER_IS_BETTER):
+            change = baseline[key] / value - 1
+            if change > threshold:
+                regressions.append((name, baseline[key], value, change))
+        elif key.endswith(LOWER_IS_BETTER):
+            change = value / baseline[key] - 1
+            if change > threshold:
+                regressions.append((name, baseline[key], value, change))
+    return regressions
+
+
+def benchmark_environment(args):
+    return {
+        'benchmark': args.benchmark,
+        'repeats': args.repeats,
+        'threads': torch.get_num_threads(),
+        'torch': torch.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+    }
+
+
+BENCHMARKS = {
+    'system-prompt': bench_system_prompt,
+    'compare': bench_compare,
+    'server': bench_server,
+    'backends': bench_backends,
+    'mmap': bench_mmap,
+    'load': bench_load,
+    'speculative': bench_speculative,
+    'retrieval': bench_retrieval,
+    'history': bench_history,
+    'segments': bench_segments,
+    'batch': bench_batch,
+    'render': bench_render,
+    'metrics': bench_metrics,
+    'profile': bench_profile,
+    'cancel': bench_cancel,
+    'suite': bench_suite,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--baseline', help='json file of an earlier run')
+    parser.add_argument('--update-baseline',
+                        action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.2,
+                        help='allowed relative regression, TTFT on a '
+                        'shared CPU varies by 10%% between runs')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, tokenizer = load_tiny_model()
+    results = BENCHMARKS[args.benchmark](model, tokenizer, args.repeats)
+    print(json.dumps(results, indent=4, ensure_ascii=False))
+    if args.baseline is None:
+        return
+    environment = benchmark_environment(args)
+    if args.update_baseline:
+        baseline = {'environment': environment, 'results': results}
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=4, ensure_ascii=False)
+        return
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline['environment'] != environment:
+        print(f"warning: baseline from {baseline['environment']}, "
+              f'this run is {environment}')
+    regressions = find_regressions(results, baseline['results'],
+                                   args.threshold)
+    for name, before, after, change in regressions:
+        print(f'regression {name}: {before:.6g} -> {after:.6g} '
+              f'({change:+.1%} worse)')
+    if regressions:
+        sys.exit(1)
+    print(f'no regression over {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
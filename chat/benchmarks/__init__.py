@@ -0,0 +1,2 @@
+"""Benchmarks of the chat path on the tiny model of tiny_model.py, one
+module per feature. ``benchmark.py`` runs them by name."""
@@ -0,0 +1,16 @@
+"""Helpers shared by the benchmarks."""
+import io
+
+import torch
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def serialized_nbytes(model):
+    """Size of the weights as stored, packed quantized tensors included."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
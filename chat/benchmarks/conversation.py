@@ -0,0 +1,151 @@
+"""Work done before a prompt reaches the model: retrieval, the history
+window and tokenizing the transcript."""
+import statistics
+import tempfile
+import time
+
+from benchmarks.common import percentile
+from history import HistoryWindow, MessageTokenizer, summarize_topics
+from prompts import render_messages, system_instruction
+from retrieval import RetrievalIndex, load_dataset
+from tiny_model import DATASET_PATH, SAMPLE_QUERY
+
+
+def bench_retrieval(model, tokenizer, repeats, scales=(1, 10, 100)):
+    """Query latency of the retrieval index at multiples of the dataset.
+
+    Larger indexes repeat the dataset, so every term matches ``scale``
+    times as many documents.
+    """
+    samples = load_dataset(DATASET_PATH)
+    queries = [SAMPLE_QUERY, '舅妈又问我什么时候结婚', '相亲'] + [
+        doc_input for doc_input, _ in samples[::len(samples) // 29]
+    ]
+    results = {}
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            RetrievalIndex.build(samples * scale).save(tmp_dir)
+            build_s = time.perf_counter() - start
+            index = RetrievalIndex.load(tmp_dir)
+            for query in queries:
+                index.search(query)
+            latencies = []
+            for _ in range(repeats):
+                for query in queries:
+                    start = time.perf_counter()
+                    index.search(query)
+                    latencies.append(time.perf_counter() - start)
+            results[f'x{scale}'] = {
+                'documents': len(index),
+                'index_bytes': index.nbytes,
+                'build_s': build_s,
+                'query_p50_us': percentile(latencies, 50) * 1e6,
+                'query_p99_us': percentile(latencies, 99) * 1e6,
+            }
+    return results
+
+
+def bench_history(model, tokenizer, repeats, num_turns=200, budget=1024):
+    """A long session through ``HistoryWindow``: prompt tokens per turn
+    with and without the window. ``tests/test_history.py`` asserts the
+    budget."""
+    samples = load_dataset(DATASET_PATH)
+    results = {}
+    for name, summarize in (('drop', None), ('summarize', summarize_topics)):
+        message_tokenizer = MessageTokenizer(tokenizer)
+        window = HistoryWindow(message_tokenizer,
+                               budget,
+                               summarize=summarize)
+        messages = [{'role': 'system', 'content': system_instruction()}]
+        full_tokens, window_tokens, fit_s = [], [], []
+        max_prompt_tokens, count_mismatches = 0, 0
+        for turn in range(num_turns):
+            doc_input, doc_output = samples[turn * 7 % len(samples)]
+            messages.append({'role': 'user', 'content': doc_input})
+            start = time.perf_counter()
+            fitted = window.fit(messages)
+            fit_s.append(time.perf_counter() - start)
+            num_tokens = len(
+                tokenizer(render_messages(fitted),
+                          add_special_tokens=False)['input_ids'])
+            max_prompt_tokens = max(max_prompt_tokens, num_tokens)
+            count_mismatches += num_tokens != window.last_stats[
+                'prompt_tokens']
+            full_tokens.append(window.last_stats['full_prompt_tokens'])
+            window_tokens.append(num_tokens)
+            messages.append({'role': 'assistant', 'content': doc_output})
+        results[name] = {
+            'turns': num_turns,
+            'budget': budget,
+            'max_prompt_tokens': max_prompt_tokens,
+            'count_mismatches': count_mismatches,
+            'mean_full_prompt_tokens': statistics.mean(full_tokens),
+            'mean_window_prompt_tokens': statistics.mean(window_tokens),
+            'last_full_prompt_tokens': full_tokens[-1],
+            'last_window_prompt_tokens': window_tokens[-1],
+            # one call per distinct message, never one per turn
+            'tokenizer_calls': message_tokenizer.tokenized,
+            'fit_p50_us': percentile(fit_s, 50) * 1e6,
+        }
+    return results
+
+
+def bench_segments(model, tokenizer, repeats, turn_counts=(5, 20, 50)):
+    """Tokenizer time of a whole session, re-tokenizing the full transcript
+    every turn against concatenating cached ``MessageTokenizer`` segments,
+    checking that both give the same ids on every turn."""
+    samples = load_dataset(DATASET_PATH)
+    results = {}
+    for num_turns in turn_counts:
+        sessions = []
+        for repeat in range(repeats):
+            messages = [{'role': 'system', 'content': system_instruction()}]
+            turns = []
+            for turn in range(num_turns):
+                doc_input, doc_output = samples[(repeat * num_turns + turn) *
+                                                7 % len(samples)]
+                turns.append(messages + [{
+                    'role': 'user',
+                    'content': doc_input
+                }])
+                messages = turns[-1] + [{
+                    'role': 'assistant',
+                    'content': doc_output
+                }]
+            sessions.append(turns)
+        timings = {'full': [], 'segments': []}
+        last_turn = {'full': [], 'segments': []}
+        mismatches = 0
+        for turns in sessions:
+            full_ids = []
+            start = time.perf_counter()
+            for messages in turns:
+                turn_start = time.perf_counter()
+                full_ids.append(
+                    tokenizer(render_messages(messages))['input_ids'])
+            timings['full'].append(time.perf_counter() - start)
+            last_turn['full'].append(time.perf_counter() - turn_start)
+            message_tokenizer = MessageTokenizer(tokenizer)
+            segment_ids = []
+            start = time.perf_counter()
+            for messages in turns:
+                turn_start = time.perf_counter()
+                segment_ids.append(message_tokenizer.encode_messages(messages))
+            timings['segments'].append(time.perf_counter() - start)
+            last_turn['segments'].append(time.perf_counter() - turn_start)
+            mismatches += sum(a != b for a, b in zip(full_ids, segment_ids))
+        full_s = statistics.median(timings['full'])
+        segments_s = statistics.median(timings['segments'])
+        results[f'{num_turns}_turns'] = {
+            'prompt_tokens': len(full_ids[-1]),
+            'session_full_ms': full_s * 1e3,
+            'session_segments_ms': segments_s * 1e3,
+            'session_speedup': full_s / segments_s,
+            'last_turn_full_us':
+            statistics.median(last_turn['full']) * 1e6,
+            'last_turn_segments_us':
+            statistics.median(last_turn['segments']) * 1e6,
+            'id_mismatches': mismatches,
+        }
+    return results
@@ -0,0 +1,289 @@
+"""One request through ``generate_interactive``: the shared system prompt,
+compare mode, speculative decoding and the cost of metrics and profiling.
+"""
+import json
+import os
+import statistics
+import tempfile
+import time
+from contextlib import nullcontext
+from dataclasses import asdict
+
+import torch
+
+from generation import (SpeculationStats, generate_batch_interactive,
+                        generate_interactive, prompt_lookup_draft)
+from kv_cache import SystemPromptCache
+from metrics import RequestMetrics, log_requests
+from profiling import profile_request
+from prompts import cur_query_prompt, render_messages, system_prompt
+from tiny_model import DATASET_PATH, SAMPLE_QUERY, greedy_config
+
+
+def time_to_first_token(model, tokenizer, prompt, **kwargs):
+    start = time.perf_counter()
+    generator = generate_interactive(model=model,
+                                     tokenizer=tokenizer,
+                                     prompt=prompt,
+                                     **kwargs)
+    next(generator)
+    elapsed = time.perf_counter() - start
+    generator.close()
+    return elapsed
+
+
+def bench_system_prompt(model, tokenizer, repeats):
+    """TTFT with and without the shared system prompt KV."""
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    results = {}
+    for deepthink in (False, True):
+        prompt = system_prompt(deepthink) + cur_query_prompt.format(
+            user=SAMPLE_QUERY)
+        generation_kwargs = greedy_config(1)
+        cold = [
+            time_to_first_token(model, tokenizer, prompt,
+                                **generation_kwargs) for _ in range(repeats)
+        ]
+        warm = [
+            time_to_first_token(model,
+                                tokenizer,
+                                prompt,
+                                system_cache=system_cache,
+                                **generation_kwargs) for _ in range(repeats)
+        ]
+        results['deepthink' if deepthink else 'normal'] = {
+            'ttft_ms': statistics.median(cold) * 1000,
+            'ttft_shared_prefix_ms': statistics.median(warm) * 1000,
+        }
+    results['system_cache_bytes'] = system_cache.nbytes
+    return results
+
+
+def bench_compare(model, tokenizer, repeats, max_new_tokens=64):
+    """Compare mode: one batch of two prompts against two sequential runs."""
+    prompts = [
+        system_prompt(deepthink) + cur_query_prompt.format(user=SAMPLE_QUERY)
+        for deepthink in (False, True)
+    ]
+    generation_kwargs = greedy_config(max_new_tokens)
+    sequential, batched = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        num_tokens = sum(
+            len(list(generate_interactive(model, tokenizer, prompt,
+                                          **generation_kwargs)))
+            for prompt in prompts)
+        sequential.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in generate_batch_interactive(model, tokenizer, prompts,
+                                            **generation_kwargs):
+            pass
+        batched.append(time.perf_counter() - start)
+    sequential_s = statistics.median(sequential)
+    batched_s = statistics.median(batched)
+    return {
+        'generated_tokens': num_tokens,
+        'sequential_tokens_per_s': num_tokens / sequential_s,
+        'batched_tokens_per_s': num_tokens / batched_s,
+        'speedup': sequential_s / batched_s,
+    }
+
+
+def load_dataset_samples(num_samples):
+    """``(messages, reference reply)`` pairs spread over the dataset."""
+    with open(DATASET_PATH, encoding='utf-8') as f:
+        dataset = json.load(f)
+    step = max(len(dataset) // num_samples, 1)
+    samples = []
+    for item in dataset[::step][:num_samples]:
+        turn = item['conversation'][0]
+        samples.append(([{
+            'role': 'system',
+            'content': turn['system']
+        }, {
+            'role': 'user',
+            'content': turn['input']
+        }], turn['output']))
+    return samples
+
+
+def bench_speculative(model,
+                      tokenizer,
+                      repeats,
+                      num_samples=32,
+                      num_speculative_tokens=5,
+                      max_new_tokens=64):
+    """Prompt-lookup speculative decoding on the dataset's inputs.
+
+    ``reference`` replays the dataset's own replies through the drafting
+    and acceptance rule, which is what the finetuned model would see. The
+    randomly initialised model only measures the decoding overhead and
+    checks greedy outputs stay identical.
+    """
+    samples = load_dataset_samples(num_samples)
+    reference = SpeculationStats()
+    for messages, output in samples:
+        prompt_ids = tokenizer(render_messages(messages),
+                               return_tensors='pt')['input_ids'][0]
+        reply_ids = tokenizer(output, return_tensors='pt')['input_ids'][0]
+        pos = 0
+        while pos < len(reply_ids):
+            draft_ids = prompt_lookup_draft(
+                torch.cat([prompt_ids, reply_ids[:pos]]),
+                num_speculative_tokens)
+            target_ids = reply_ids[pos:pos + len(draft_ids)]
+            num_accepted = len(draft_ids)
+            mismatches = (draft_ids[:len(target_ids)] != target_ids).nonzero()
+            if len(mismatches) or len(target_ids) < len(draft_ids):
+                num_accepted = (mismatches[0].item()
+                                if len(mismatches) else len(target_ids))
+            reference.forward_passes += 1
+            reference.drafted_tokens += len(draft_ids)
+            reference.accepted_tokens += num_accepted
+            pos += num_accepted + 1
+        reference.generated_tokens += len(reply_ids)
+
+    generation_kwargs = greedy_config(max_new_tokens)
+    timings = {'plain': [], 'speculative': []}
+    stats = SpeculationStats()
+    identical = True
+    for _ in range(repeats):
+        for messages, _ in samples:
+            prompt = render_messages(messages)
+            start = time.perf_counter()
+            plain = list(
+                generate_interactive(model, tokenizer, prompt,
+                                     **generation_kwargs))
+            timings['plain'].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            speculative = list(
+                generate_interactive(
+                    model,
+                    tokenizer,
+                    prompt,
+                    num_speculative_tokens=num_speculative_tokens,
+                    speculation_stats=stats,
+                    **generation_kwargs))
+            timings['speculative'].append(time.perf_counter() - start)
+            identical = identical and plain == speculative
+    return {
+        'reference_acceptance_rate': reference.acceptance_rate,
+        'reference_tokens_per_forward': (reference.generated_tokens /
+                                         reference.forward_passes),
+        'acceptance_rate': stats.acceptance_rate,
+        'tokens_per_forward': stats.generated_tokens / stats.forward_passes,
+        'speedup': sum(timings['plain']) / sum(timings['speculative']),
+        'greedy_identical': identical,
+    }
+
+
+def instrumentation_cost(prompt_tokens, output_tokens, device, runs=1000):
+    """Seconds one ``RequestMetrics`` adds to a request, export included."""
+    start = time.perf_counter()
+    for _ in range(runs):
+        lifecycle = RequestMetrics()
+        lifecycle.begin_prefill(prompt_tokens, 0, device)
+        lifecycle.first_token(device)
+        lifecycle.finish('length', output_tokens, device)
+    return (time.perf_counter() - start) / runs
+
+
+def bench_metrics(model, tokenizer, repeats, max_new_tokens=64):
+    """``generate_interactive`` with and without ``RequestMetrics``, runs
+    interleaved so drift hits both alike. The JSON request log is written
+    to /dev/null to count its cost too.
+
+    Long runs like these are noisier than the overhead they measure;
+    ``tests/test_metrics.py`` holds many short interleaved runs to 2%.
+    """
+    log_requests(os.devnull)
+    prompt = tokenizer(
+        system_prompt() +
+        cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+    generation_kwargs = greedy_config(max_new_tokens)
+    timings = {'bare': [], 'instrumented': []}
+    # warm up
+    list(generate_interactive(model, tokenizer, prompt, **generation_kwargs))
+    for _ in range(repeats * 10):
+        for name in timings:
+            metrics = RequestMetrics() if name == 'instrumented' else None
+            start = time.perf_counter()
+            for _ in generate_interactive(model,
+                                          tokenizer,
+                                          prompt,
+                                          metrics=metrics,
+                                          **generation_kwargs):
+                pass
+            timings[name].append(time.perf_counter() - start)
+    bare_s = statistics.median(timings['bare'])
+    instrumented_s = statistics.median(timings['instrumented'])
+    overhead = instrumented_s / bare_s - 1
+    # the instrumentation alone, far below the noise of the runs above
+    instrumentation_s = instrumentation_cost(len(prompt), max_new_tokens,
+                                             model.device)
+    return {
+        'requests': len(timings['bare']),
+        'bare_ms': bare_s * 1e3,
+        'instrumented_ms': instrumented_s * 1e3,
+        'overhead': overhead,
+        'instrumentation_us': instrumentation_s * 1e6,
+        'instrumentation_overhead': instrumentation_s / bare_s,
+        'last_request': {
+            key: value
+            for key, value in asdict(metrics).items()
+            if not key.startswith('_') and key != 'submitted'
+        },
+    }
+
+
+def bench_profile(model, tokenizer, repeats, max_new_tokens=64):
+    """One profiled request, checked for its trace, summary and phase
+    ranges, and the cost of the no-op phases of unprofiled requests: the
+    profiled request enters a range wherever they enter a ``nullcontext``.
+    """
+    prompt = tokenizer(
+        system_prompt() +
+        cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+    generation_kwargs = greedy_config(max_new_tokens)
+
+    def run():
+        start = time.perf_counter()
+        for _ in generate_interactive(model, tokenizer, prompt,
+                                      **generation_kwargs):
+            pass
+        return time.perf_counter() - start
+
+    # warm up
+    run()
+    unprofiled_s = statistics.median(run() for _ in range(repeats * 4))
+    with tempfile.TemporaryDirectory() as out_dir:
+        with profile_request(out_dir, 'request') as profiling:
+            profiled_s = run()
+        with open(os.path.join(out_dir, 'request.json'),
+                  encoding='utf-8') as f:
+            events = json.load(f)['traceEvents']
+        with open(os.path.join(out_dir, 'request.txt'),
+                  encoding='utf-8') as f:
+            summary = f.read()
+    ranges = {}
+    for event in events:
+        if event.get('name', '').startswith('chat.'):
+            ranges[event['name']] = ranges.get(event['name'], 0) + 1
+    num_phases = sum(ranges.values())
+    start = time.perf_counter()
+    for _ in range(100000):
+        with nullcontext('chat.sample'):
+            pass
+    nullcontext_s = (time.perf_counter() - start) / 100000
+    return {
+        'profiled': profiling,
+        'unprofiled_ms': unprofiled_s * 1e3,
+        'profiled_ms': profiled_s * 1e3,
+        'ranges': ranges,
+        'summary_rows': len(summary.splitlines()),
+        'phases_per_request': num_phases,
+        'phase_overhead': num_phases * nullcontext_s / unprofiled_s,
+    }
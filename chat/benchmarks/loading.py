@@ -0,0 +1,159 @@
+"""Loading the weights: CPU backends, memory-mapped safetensors and the
+peak memory of casting while loading."""
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+import torch
+
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from backend import BackendConfig, load_pretrained
+from benchmarks.common import serialized_nbytes
+from generation import generate_interactive
+from prompts import cur_query_prompt, system_prompt
+from tiny_model import (SAMPLE_QUERY, greedy_config, measure_load,
+                        save_sharded_checkpoint)
+from weights import convert, load_mmap_model
+
+
+def bench_backends(model, tokenizer, repeats, max_new_tokens=64):
+    """Memory footprint and decode speed per CPU backend option."""
+    prompt = system_prompt() + cur_query_prompt.format(user=SAMPLE_QUERY)
+    options = [('float32', 'none'), ('bfloat16', 'none'),
+               ('float32', 'int8'), ('bfloat16', 'int4')]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, 'model')
+        model.save_pretrained(model_path)
+        tokenizer.save_pretrained(model_path)
+        for dtype, quantization in options:
+            config = BackendConfig(device='cpu',
+                                   dtype=dtype,
+                                   quantization=quantization,
+                                   quantized_cache_dir=os.path.join(
+                                       tmp_dir, 'quantized'))
+            start = time.perf_counter()
+            backend_model, _ = load_pretrained(model_path, config)
+            first_load_s = time.perf_counter() - start
+            # a second load is served from the quantized cache
+            start = time.perf_counter()
+            backend_model, _ = load_pretrained(model_path, config)
+            cached_load_s = time.perf_counter() - start
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                num_tokens = len(
+                    list(
+                        generate_interactive(backend_model, tokenizer, prompt,
+                                             **greedy_config(max_new_tokens))))
+                timings.append(time.perf_counter() - start)
+            results[f'{config.resolve().dtype}/{quantization}'] = {
+                'weights_bytes': serialized_nbytes(backend_model),
+                'tokens_per_s': num_tokens / statistics.median(timings),
+                'first_load_s': first_load_s,
+                'cached_load_s': cached_load_s,
+            }
+    return results
+
+
+def evict_page_cache(model_path):
+    for file_name in os.listdir(model_path):
+        fd = os.open(os.path.join(model_path, file_name), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def load_worker(loader, model_path, loaded, measured, results):
+    import psutil
+
+    # import the modeling code up front, it is not part of the load
+    config = AutoConfig.from_pretrained(model_path)
+    AutoModelForCausalLM._model_mapping[type(config)]
+    start = time.perf_counter()
+    if loader == 'mmap':
+        model = load_mmap_model(model_path)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path, torch_dtype=torch.float32)
+    load_s = time.perf_counter() - start
+    # a forward pass touches every weight page, mapped ones included
+    with torch.inference_mode():
+        model(torch.tensor([[0]]))
+    # every process holds its weights while memory is sampled
+    loaded.wait()
+    memory = psutil.Process().memory_full_info()
+    results.put({
+        'load_s': load_s,
+        'rss': memory.rss,
+        'uss': memory.uss,
+        'pss': memory.pss,
+    })
+    measured.wait()
+    del model
+
+
+def bench_mmap(model, tokenizer, repeats, num_processes=(1, 4)):
+    """Cold start and resident memory of pickled against memory-mapped
+    weights, for one and for several processes loading at once."""
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {
+            'pickle': os.path.join(tmp_dir, 'bin'),
+            'mmap': os.path.join(tmp_dir, 'safetensors'),
+        }
+        model.save_pretrained(paths['pickle'], safe_serialization=False)
+        convert(paths['pickle'], paths['mmap'], torch.float32)
+        for loader, model_path in paths.items():
+            for processes in num_processes:
+                runs = []
+                for _ in range(repeats):
+                    evict_page_cache(model_path)
+                    loaded = context.Barrier(processes)
+                    measured = context.Barrier(processes + 1)
+                    queue = context.Queue()
+                    workers = [
+                        context.Process(target=load_worker,
+                                        args=(loader, model_path, loaded,
+                                              measured, queue))
+                        for _ in range(processes)
+                    ]
+                    for worker in workers:
+                        worker.start()
+                    runs.append([queue.get() for _ in workers])
+                    measured.wait()
+                    for worker in workers:
+                        worker.join()
+                results[f'{loader}/{processes}'] = {
+                    'load_s': statistics.median(
+                        max(r['load_s'] for r in run) for run in runs),
+                    'rss_per_process_bytes': statistics.median(
+                        r['rss'] for run in runs for r in run),
+                    'uss_per_process_bytes': statistics.median(
+                        r['uss'] for run in runs for r in run),
+                    'pss_total_bytes': statistics.median(
+                        sum(r['pss'] for r in run) for run in runs),
+                }
+        results['weights_bytes'] = serialized_nbytes(model)
+    return results
+
+
+def bench_load(model, tokenizer, repeats, shard_size='16MB'):
+    """Peak memory of loading a multi-shard fp32 checkpoint as bf16.
+
+    ``from_pretrained`` followed by ``.to`` is the old load, the other two
+    cast while loading. ``tests/test_weights.py`` holds the streaming
+    loader to ``LOAD_PEAK_BOUND``.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results['shards'] = save_sharded_checkpoint(tmp_dir, shard_size)
+        for loader in ('from_pretrained', 'from_pretrained_dtype',
+                       'streaming'):
+            results[loader] = measure_load(loader, tmp_dir, repeats)
+    return results
@@ -0,0 +1,93 @@
+"""Streaming a reply into the Streamlit page."""
+import statistics
+import time
+
+from detokenizer import IncrementalDetokenizer
+from renderer import StreamRenderer, convert_math
+from retrieval import load_dataset
+from tiny_model import DATASET_PATH
+
+
+def bench_render(model,
+                 tokenizer,
+                 repeats,
+                 reply_tokens=(256, 1024, 4096),
+                 tokens_per_s=50,
+                 frame_interval_s=0.05):
+    """Streamlit CPU time and messages per streamed reply, redrawing the
+    converted full text on every token against ``StreamRenderer``.
+
+    Replies are dataset outputs with some LaTeX, streamed token by token at
+    ``tokens_per_s`` on a simulated clock.
+    """
+    import logging
+    import streamlit as st
+    # every bare mode call warns about the missing script run context, the
+    # logger and its level are set up on the first one
+    st.empty()
+    logging.getLogger('streamlit.runtime.scriptrunner_utils.'
+                      'script_run_context').setLevel(logging.ERROR)
+
+    class Placeholder:
+        # a bare mode st.empty() builds the same protos as in the app
+        def __init__(self):
+            self.element = st.empty()
+            self.messages = 0
+            self.nbytes = 0
+
+        def markdown(self, body):
+            self.element.markdown(body)
+            self.messages += 1
+            self.nbytes += len(body.encode())
+
+    class Clock:
+
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    samples = load_dataset(DATASET_PATH)
+    text = ''.join(f'{doc_output}\\(x_{i}^2\\)\n'
+                   for i, (_, doc_output) in enumerate(samples[:500]))
+    token_ids = tokenizer(text, add_special_tokens=False)['input_ids']
+    prefix = ':blue[[Normal Response]]\n\n'
+    results = {}
+    for num_tokens in reply_tokens:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        stream = []
+        for token_id in token_ids[:num_tokens]:
+            detokenizer.push(token_id)
+            stream.append(detokenizer.text)
+        timings = {'per_token': [], 'renderer': []}
+        placeholders = {}
+        for _ in range(repeats):
+            placeholder = placeholders['per_token'] = Placeholder()
+            start = time.process_time()
+            for response in stream:
+                placeholder.markdown(prefix + convert_math(response) + '▌')
+            placeholder.markdown(prefix + convert_math(response))
+            timings['per_token'].append(time.process_time() - start)
+
+            placeholder = placeholders['renderer'] = Placeholder()
+            clock = Clock()
+            renderer = StreamRenderer(placeholder,
+                                      prefix=prefix,
+                                      frame_interval_s=frame_interval_s,
+                                      clock=clock)
+            start = time.process_time()
+            for response in stream:
+                clock.now += 1 / tokens_per_s
+                renderer.update(response)
+            renderer.finish()
+            timings['renderer'].append(time.process_time() - start)
+        results[f'{num_tokens}_tokens'] = {
+            name: {
+                'cpu_ms': statistics.median(timings[name]) * 1e3,
+                'messages': placeholders[name].messages,
+                'sent_bytes': placeholders[name].nbytes,
+            }
+            for name in timings
+        }
+    return results
@@ -0,0 +1,255 @@
+"""Many requests at once: server.py under load, batch_generate.py and
+cancelling replies on the ``GenerationWorker``."""
+import asyncio
+import json
+import statistics
+import time
+
+from batch_generate import generate_replies, length_sorted_batches
+from benchmarks.common import percentile
+from generation import generate_interactive
+from history import MessageTokenizer
+from kv_cache import PrefixCache, SystemPromptCache
+from prometheus_client import REGISTRY
+from prompts import cur_query_prompt, system_instruction, system_prompt
+from retrieval import load_dataset
+from tiny_model import DATASET_PATH, SAMPLE_QUERY, greedy_config
+from worker import GenerationWorker, ReplyCancelled
+
+
+def bench_server(model, tokenizer, repeats, concurrency=8, max_new_tokens=32):
+    """Load test of server.py: ``concurrency`` clients, ``repeats`` requests
+    each, over real HTTP on localhost."""
+    import aiohttp
+    from aiohttp.test_utils import TestServer
+
+    from server import ContinuousBatchingEngine, create_app
+
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    engine = ContinuousBatchingEngine(model,
+                                      tokenizer,
+                                      max_batch_size=concurrency,
+                                      system_cache=system_cache)
+    latencies, ttfts = [], []
+
+    async def client(session, url, idx):
+        for turn in range(repeats):
+            messages = [{
+                'role': 'system',
+                'content': system_instruction(deepthink=idx % 2 == 1)
+            }, {
+                'role': 'user',
+                'content': f'{SAMPLE_QUERY} {idx} {turn}'
+            }]
+            start = time.perf_counter()
+            ttft = None
+            async with session.post(url,
+                                    json={
+                                        'messages': messages,
+                                        'stream': True,
+                                        'temperature': 0.0,
+                                        'max_tokens': max_new_tokens,
+                                    }) as response:
+                async for line in response.content:
+                    if (ttft is None and line.startswith(b'data: {') and
+                            json.loads(line[6:])['choices'][0]['delta'].get(
+                                'content')):
+                        ttft = time.perf_counter() - start
+            latencies.append(time.perf_counter() - start)
+            ttfts.append(ttft)
+
+    async def run():
+        server = TestServer(create_app(engine))
+        await server.start_server()
+        url = str(server.make_url('/v1/chat/completions'))
+        start = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(client(session, url, idx)
+                                   for idx in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        await server.close()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    num_tokens = engine.generated_tokens
+    return {
+        'requests': len(latencies),
+        'concurrency': concurrency,
+        'completion_tokens': num_tokens,
+        'aggregate_tokens_per_s': num_tokens / elapsed,
+        'latency_p50_ms': percentile(latencies, 50) * 1000,
+        'latency_p99_ms': percentile(latencies, 99) * 1000,
+        'ttft_p50_ms': percentile(ttfts, 50) * 1000,
+        'ttft_p99_ms': percentile(ttfts, 99) * 1000,
+    }
+
+
+def bench_batch(model,
+                tokenizer,
+                repeats,
+                num_prompts=64,
+                batch_size=8,
+                max_new_tokens=32):
+    """batch_generate.py over dataset inputs against the sequential
+    ``generate_interactive`` loop, with batches in dataset order and
+    sorted by prompt length. ``tests/test_batch_generate.py`` asserts the
+    replies are the same."""
+    samples = load_dataset(DATASET_PATH)
+    message_tokenizer = MessageTokenizer(tokenizer)
+    system = {'role': 'system', 'content': system_instruction()}
+    # alternate the short dataset asks with longer follow ups
+    prompt_ids = [
+        message_tokenizer.encode_messages([
+            system, {
+                'role': 'user',
+                'content': doc_input if i % 2 else doc_input + doc_output
+            }
+        ]) for i, (doc_input, doc_output) in enumerate(
+            samples[::len(samples) // num_prompts][:num_prompts])
+    ]
+    lengths = [len(ids) for ids in prompt_ids]
+    generation_kwargs = greedy_config(max_new_tokens)
+    schedules = {
+        'unsorted': [
+            list(range(i, min(i + batch_size, num_prompts)))
+            for i in range(0, num_prompts, batch_size)
+        ],
+        'sorted': length_sorted_batches(lengths, batch_size),
+    }
+    timings = {'sequential': []}
+    replies = {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        replies['sequential'] = [
+            list(generate_interactive(model, tokenizer, ids,
+                                      **generation_kwargs))[-1]
+            for ids in prompt_ids
+        ]
+        timings['sequential'].append(time.perf_counter() - start)
+        for name, batches in schedules.items():
+            start = time.perf_counter()
+            replies[name] = dict(
+                pair for results in generate_replies(
+                    model, tokenizer, prompt_ids, batches, **
+                    generation_kwargs) for pair in results)
+            timings.setdefault(name, []).append(time.perf_counter() - start)
+    sequential_s = statistics.median(timings['sequential'])
+    results = {
+        'prompts': num_prompts,
+        'prompt_tokens_min': min(lengths),
+        'prompt_tokens_max': max(lengths),
+        'sequential_prompts_per_s': num_prompts / sequential_s,
+    }
+    for name, batches in schedules.items():
+        batch_s = statistics.median(timings[name])
+        padded = sum(len(batch) * max(lengths[i] for i in batch)
+                     for batch in batches)
+        results[name] = {
+            'prompts_per_s': num_prompts / batch_s,
+            'speedup': sequential_s / batch_s,
+            'padding_ratio': 1 - sum(lengths) / padded,
+            'same_as_sequential': all(
+                replies[name][i] == reply
+                for i, reply in enumerate(replies['sequential'])),
+        }
+    return results
+
+
+def bench_cancel(model,
+                 tokenizer,
+                 repeats,
+                 read_steps=16,
+                 max_new_tokens=512,
+                 overhead_tokens=128):
+    """A reply dropped after ``read_steps`` steps, as a rerun of web_demo.py
+    does, and the next turn of the same session.
+
+    Before: the generator is abandoned and keeps the KV cache it checked
+    out. After: the ``GenerationWorker`` job is cancelled, stops after the
+    step in progress and puts the cache back. Also the cost of the worker
+    thread on a reply that is read to its end.
+    """
+    prompt = tokenizer(
+        system_prompt() +
+        cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+    generation_kwargs = greedy_config(max_new_tokens)
+    worker = GenerationWorker(max_workers=1)
+
+    def reply(prefix_cache, **kwargs):
+        return generate_interactive(model,
+                                    tokenizer,
+                                    prompt,
+                                    prefix_cache=prefix_cache,
+                                    cache_key='session',
+                                    **dict(generation_kwargs, **kwargs))
+
+    def reused_tokens(prefix_cache):
+        # the next turn extends the transcript by a few tokens
+        _, num_reused = prefix_cache.acquire('session', prompt + [0] * 8)
+        return num_reused
+
+    # warm up
+    list(reply(None))
+    prefix_cache = PrefixCache(max_bytes=1024**3)
+    abandoned = reply(prefix_cache)
+    for _ in range(read_steps):
+        next(abandoned)
+    before_reused = reused_tokens(prefix_cache)
+
+    wasted = REGISTRY.get_sample_value('chat_wasted_decode_steps_total')
+    step_times, cancel_times, steps_after_cancel, after_reused = [], [], [], []
+    for _ in range(repeats):
+        prefix_cache = PrefixCache(max_bytes=1024**3)
+        job = worker.submit('session', reply(prefix_cache))
+        start = time.perf_counter()
+        for steps, _ in enumerate(job, 1):
+            if steps == read_steps:
+                break
+        step_times.append((time.perf_counter() - start) / read_steps)
+        steps_at_cancel = job.steps
+        start = time.perf_counter()
+        worker.cancel('session')
+        cancel_times.append(time.perf_counter() - start)
+        steps_after_cancel.append(job.steps - steps_at_cancel)
+        after_reused.append(reused_tokens(prefix_cache))
+    try:
+        list(job)
+        raised = False
+    except ReplyCancelled:
+        raised = True
+    wasted = REGISTRY.get_sample_value(
+        'chat_wasted_decode_steps_total') - wasted
+
+    # interleaved, a run varies by 10% on a shared CPU
+    timings = {'direct': [], 'worker': []}
+    for _ in range(repeats * 2):
+        for name in timings:
+            start = time.perf_counter()
+            stream = reply(None, max_new_tokens=overhead_tokens)
+            if name == 'worker':
+                stream = worker.submit('session', stream)
+            for _ in stream:
+                pass
+            timings[name].append(time.perf_counter() - start)
+    direct_s = statistics.median(timings['direct'])
+    worker_s = statistics.median(timings['worker'])
+    return {
+        'prompt_tokens': len(prompt),
+        'before': {
+            'reused_tokens_next_turn': before_reused,
+        },
+        'after': {
+            'decode_step_ms': statistics.median(step_times) * 1e3,
+            'cancel_ms': statistics.median(cancel_times) * 1e3,
+            'max_steps_after_cancel': max(steps_after_cancel),
+            'reused_tokens_next_turn': min(after_reused),
+            'wasted_decode_steps': wasted,
+            'reader_sees_cancel': raised,
+        },
+        'direct_ms': direct_s * 1e3,
+        'worker_ms': worker_s * 1e3,
+        'worker_overhead': worker_s / direct_s - 1,
+    }
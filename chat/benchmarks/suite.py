@@ -0,0 +1,110 @@
+"""Seeded end-to-end workloads compared against a baseline by
+``benchmark.py suite --baseline``."""
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+import torch
+
+from backend import PeakMemory
+from generation import (GenerationConfig, generate_batch_interactive,
+                        generate_interactive)
+from history import MessageTokenizer
+from prompts import system_instruction
+from retrieval import load_dataset
+from tiny_model import DATASET_PATH
+
+
+def suite_messages(samples, rng, num_turns=0, deepthink=False):
+    """A session of ``num_turns`` dataset exchanges and a dataset ask."""
+    messages = [{'role': 'system', 'content': system_instruction(deepthink)}]
+    for doc_input, doc_output in rng.sample(samples, num_turns):
+        messages.append({'role': 'user', 'content': doc_input})
+        messages.append({'role': 'assistant', 'content': doc_output})
+    messages.append({'role': 'user', 'content': rng.choice(samples)[0]})
+    return messages
+
+
+def timed_stream(stream):
+    """``(ttft_s, total_s)`` of draining a reply stream."""
+    start = time.perf_counter()
+    ttft_s = None
+    for _ in stream:
+        if ttft_s is None:
+            ttft_s = time.perf_counter() - start
+    return ttft_s, time.perf_counter() - start
+
+
+def bench_suite(model,
+                tokenizer,
+                repeats,
+                seed=0,
+                max_new_tokens=64,
+                num_sessions=4):
+    """Seeded workloads of the chat path, for ``--baseline`` runs.
+
+    Every request generates exactly ``max_new_tokens`` with the sampling
+    settings of the app, so throughput compares across runs and commits.
+    """
+    samples = load_dataset(DATASET_PATH)
+    message_tokenizer = MessageTokenizer(tokenizer)
+    generation_kwargs = asdict(GenerationConfig())
+    del generation_kwargs['max_length']
+    generation_kwargs.update(max_new_tokens=max_new_tokens,
+                             min_new_tokens=max_new_tokens)
+
+    def reply(messages):
+        return timed_stream(
+            generate_interactive(model, tokenizer,
+                                 message_tokenizer.encode_messages(messages),
+                                 **generation_kwargs))
+
+    def compare(messages):
+        return timed_stream(
+            generate_batch_interactive(model, tokenizer, [
+                message_tokenizer.encode_messages(messages),
+                message_tokenizer.encode_messages([{
+                    'role': 'system',
+                    'content': system_instruction(True)
+                }] + messages[1:])
+            ], **generation_kwargs))
+
+    def concurrent(sessions):
+        # streamlit runs every browser session in a thread of its own
+        with ThreadPoolExecutor(len(sessions)) as executor:
+            timings = list(executor.map(reply, sessions))
+        return ([ttft_s for ttft_s, _ in timings],
+                max(total_s for _, total_s in timings))
+
+    workloads = {
+        'single_turn': (reply, 1, lambda rng: suite_messages(samples, rng)),
+        'history_10': (reply, 1,
+                       lambda rng: suite_messages(samples, rng, 10)),
+        'deepthink': (reply, 1, lambda rng: suite_messages(
+            samples, rng, deepthink=True)),
+        'compare': (compare, 2, lambda rng: suite_messages(samples, rng)),
+        'concurrent': (concurrent, num_sessions, lambda rng: [
+            suite_messages(samples, rng, turn) for turn in range(num_sessions)
+        ]),
+    }
+    # warm up
+    reply(suite_messages(samples, random.Random(seed)))
+    results = {}
+    for name, (run, num_replies, make_inputs) in workloads.items():
+        rng = random.Random(seed)
+        torch.manual_seed(seed)
+        inputs = [make_inputs(rng) for _ in range(repeats)]
+        ttfts, total_s = [], 0.0
+        with PeakMemory() as peak:
+            for workload_input in inputs:
+                ttft_s, elapsed_s = run(workload_input)
+                ttfts.extend(ttft_s if isinstance(ttft_s, list) else [ttft_s])
+                total_s += elapsed_s
+        results[name] = {
+            'tokens_per_s': repeats * num_replies * max_new_tokens / total_s,
+            'ttft_ms': statistics.median(ttfts) * 1e3,
+            'peak_rss_bytes': peak.peak_rss_bytes,
+        }
+    return results
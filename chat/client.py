@@ -0,0 +1,71 @@
+"""Streaming client for the OpenAI compatible ``server.py``."""
+import json
+import queue
+import threading
+
+import httpx
+
+
+def stream_chat_completion(base_url, messages, timeout=600.0,
+                           **generation_kwargs):
+    """Yield the accumulated reply after every chunk, like
+    ``generate_interactive`` does after every token."""
+    response_text = ''
+    with httpx.stream('POST',
+                      f'{base_url}/chat/completions',
+                      json={
+                          'messages': messages,
+                          'stream': True,
+                          **generation_kwargs
+                      },
+                      timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith('data: '):
+                continue
+            data = line[len('data: '):]
+            if data == '[DONE]':
+                break
+            choice = json.loads(data)['choices'][0]
+            response_text += choice['delta'].get('content') or ''
+            yield response_text
+
+
+def stream_chat_completions(base_url, batch_messages, **generation_kwargs):
+    """Stream several conversations at once, yielding the list of replies.
+
+    Each conversation is its own request; the server batches them. Closing
+    the stream closes the requests, which the server then aborts.
+    """
+    updates = queue.Queue()
+    closed = threading.Event()
+
+    def worker(row, messages):
+        try:
+            for response_text in stream_chat_completion(
+                    base_url, messages, **generation_kwargs):
+                if closed.is_set():
+                    return
+                updates.put((row, response_text, None))
+        except Exception as e:  # noqa: B902
+            updates.put((row, None, e))
+            return
+        updates.put((row, None, None))
+
+    for row, messages in enumerate(batch_messages):
+        threading.Thread(target=worker, args=(row, messages),
+                         daemon=True).start()
+    responses = [''] * len(batch_messages)
+    pending = len(batch_messages)
+    try:
+        while pending:
+            row, response_text, error = updates.get()
+            if error is not None:
+                raise error
+            if response_text is None:
+                pending -= 1
+                continue
+            responses[row] = response_text
+            yield list(responses)
+    finally:
+        closed.set()
@@ -0,0 +1,64 @@
+from typing import Iterable, Iterator, List, Tuple
+
+# byte-level BPE decodes an incomplete UTF-8 sequence to this character
+REPLACEMENT_CHAR = '�'
+
+
+class IncrementalDetokenizer:
+    """Turn a stream of generated token ids into text deltas.
+
+    Only the last few tokens are decoded on every step instead of the whole
+    response. ``prefix_offset`` marks the start of the window that is
+    re-decoded for context, ``read_offset`` the first token whose text has
+    not been emitted yet. A step whose text ends in a partial UTF-8 sequence
+    (e.g. half of a Chinese character or emoji) is held back until the
+    following tokens complete it.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=False):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ''
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id: int) -> str:
+        """Add one token and return the newly completed text, if any."""
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(
+            self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith(
+                REPLACEMENT_CHAR):
+            return ''
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    def flush(self) -> str:
+        """Emit whatever is still held back, incomplete or not."""
+        if self.read_offset == len(self.token_ids):
+            return ''
+        prefix_text = self._decode(
+            self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+    def stream(self, token_ids: Iterable[int]) -> Iterator[Tuple[str, str]]:
+        """Yield ``(delta, text)`` for every token, flushing at the end."""
+        for token_id in token_ids:
+            yield self.push(token_id), self.text
+        delta = self.flush()
+        if delta:
+            yield delta, self.text
@@ -0,0 +1,477 @@
+import copy
+import time
+import warnings
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Callable, Hashable, List, Optional, Union
+
+import torch
+from torch import nn
+
+from transformers import DynamicCache
+from transformers.generation.utils import LogitsProcessorList
+from transformers.utils import logging
+
+from detokenizer import IncrementalDetokenizer
+from kv_cache import PrefixCache, SystemPromptCache
+from metrics import RequestMetrics
+from profiling import phase_ranges
+
+logger = logging.get_logger(__name__)
+
+
+@dataclass
+class GenerationConfig:
+    # this config is used for chat to provide more diversity
+    max_length: int = 32768
+    top_p: float = 0.8
+    temperature: float = 0.8
+    do_sample: bool = True
+    repetition_penalty: float = 1.005
+
+
+@dataclass
+class SpeculationStats:
+    """Counters of prompt-lookup speculative decoding."""
+    forward_passes: int = 0
+    drafted_tokens: int = 0
+    accepted_tokens: int = 0
+    generated_tokens: int = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / max(self.drafted_tokens, 1)
+
+
+def prepare_generation(
+    model,
+    input_ids,
+    generation_config,
+    logits_processor,
+    prefix_allowed_tokens_fn,
+    additional_eos_token_id,
+    kwargs,
+):
+    """Resolve the generation config, eos ids and logits processors.
+
+    Returns ``(generation_config, logits_processor, eos_token_id,
+    model_kwargs)``.
+    """
+    input_ids_seq_length = input_ids.shape[-1]
+    if generation_config is None:
+        generation_config = model.generation_config
+    generation_config = copy.deepcopy(generation_config)
+    generation_config._eos_token_tensor = generation_config.eos_token_id
+    model_kwargs = generation_config.update(**kwargs)
+    if generation_config.temperature == 0.0:
+        generation_config.do_sample = False
+    eos_token_id = generation_config.eos_token_id
+    if isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    if additional_eos_token_id is not None:
+        eos_token_id.append(additional_eos_token_id)
+    has_default_max_length = kwargs.get(
+        'max_length') is None and generation_config.max_length is not None
+    if has_default_max_length and generation_config.max_new_tokens is None:
+        warnings.warn(
+            f"Using 'max_length''s default \
+                ({repr(generation_config.max_length)}) \
+                to control the generation length. "
+            'This behaviour is deprecated and will be removed from the \
+                config in v5 of Transformers -- we'
+            ' recommend using `max_new_tokens` to control the maximum \
+                length of the generation.',
+            UserWarning,
+        )
+    elif generation_config.max_new_tokens is not None:
+        generation_config.max_length = (generation_config.max_new_tokens +
+                                        input_ids_seq_length)
+        if not has_default_max_length:
+            logger.warn(  # pylint: disable=W4902
+                f"Both 'max_new_tokens' (={generation_config.max_new_tokens}) "
+                f"and 'max_length'(={generation_config.max_length}) seem to "
+                "have been set. 'max_new_tokens' will take precedence. "
+                'Please refer to the documentation for more information. '
+                '(https://huggingface.co/docs/transformers/main/'
+                'en/main_classes/text_generation)',
+                UserWarning,
+            )
+
+    if input_ids_seq_length >= generation_config.max_length:
+        input_ids_string = 'input_ids'
+        logger.warning(
+            f'Input length of {input_ids_string} is {input_ids_seq_length}, '
+            f"but 'max_length' is set to {generation_config.max_length}. "
+            'This can lead to unexpected behavior. You should consider'
+            " increasing 'max_new_tokens'.")
+
+    # 2. Set generation parameters if not already defined
+    logits_processor = (logits_processor if logits_processor is not None else
+                        LogitsProcessorList())
+    logits_processor = model._get_logits_processor(
+        generation_config=generation_config,
+        input_ids_seq_length=input_ids_seq_length,
+        encoder_input_ids=input_ids,
+        prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+        logits_processor=logits_processor,
+    )
+    return generation_config, logits_processor, eos_token_id, model_kwargs
+
+
+def sample_next_tokens(generation_config,
+                       logits_processor,
+                       input_ids,
+                       next_token_logits,
+                       phase=nullcontext):
+    # pre-process distribution
+    with phase('chat.logits_processors'):
+        next_token_scores = logits_processor(input_ids, next_token_logits)
+
+    # sample
+    with phase('chat.sample'):
+        probs = nn.functional.softmax(next_token_scores, dim=-1)
+        if generation_config.do_sample:
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return torch.argmax(probs, dim=-1)
+
+
+def prompt_lookup_draft(token_ids, num_tokens, max_ngram_size=3):
+    """Guess the next ``num_tokens`` tokens of a 1-D ``token_ids``.
+
+    The trailing n-gram, longest first, is looked up earlier in the
+    sequence and the tokens that followed its latest occurrence are
+    proposed. Replies echo the relatives and scenes named in the prompt,
+    which makes these guesses cheap and often right.
+    """
+    for ngram_size in range(min(max_ngram_size, len(token_ids) - 1), 0, -1):
+        ngram = token_ids[-ngram_size:]
+        windows = token_ids[:-1].unfold(0, ngram_size, 1)
+        matches = (windows == ngram).all(-1).nonzero()
+        if len(matches):
+            start = matches[-1].item() + ngram_size
+            return token_ids[start:start + num_tokens]
+    return token_ids[:0]
+
+
+def accept_draft(generation_config,
+                 logits_processor,
+                 input_ids,
+                 logits,
+                 draft_ids,
+                 phase=nullcontext):
+    """Verify ``draft_ids`` against the logits of one forward pass.
+
+    ``logits[:, j]`` scores the token after ``draft_ids[:j]``. A draft token
+    is kept if decoding would have picked it: when greedy if it is the
+    argmax, when sampling with probability p(draft), resampling from the
+    rest of p otherwise, so the output distribution is unchanged. The first
+    corrected token, or the one after a fully accepted draft, is appended
+    as well.
+
+    Returns the extended ``input_ids`` and the number of accepted drafts.
+    ``phase`` names the ranges of a profile, see ``profiling.py``.
+    """
+    for j, draft_id in enumerate(draft_ids.tolist()):
+        if not generation_config.do_sample:
+            next_tokens = sample_next_tokens(generation_config,
+                                             logits_processor, input_ids,
+                                             logits[:, j, :], phase)
+            accepted = next_tokens.item() == draft_id
+        else:
+            with phase('chat.logits_processors'):
+                scores = logits_processor(input_ids, logits[:, j, :])
+            with phase('chat.sample'):
+                probs = nn.functional.softmax(scores, dim=-1)
+                accepted = torch.rand(()).item() < probs[0, draft_id].item()
+                if accepted:
+                    next_tokens = draft_ids[j:j + 1]
+                else:
+                    probs[0, draft_id] = 0
+                    next_tokens = torch.multinomial(probs, num_samples=1)[0]
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        if not accepted:
+            return input_ids, j
+    next_tokens = sample_next_tokens(generation_config, logits_processor,
+                                     input_ids, logits[:, len(draft_ids), :],
+                                     phase)
+    input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+    return input_ids, len(draft_ids)
+
+
+@torch.inference_mode()
+def generate_interactive(
+    model,
+    tokenizer,
+    prompt: Union[str, List[int]],
+    generation_config: Optional[GenerationConfig] = None,
+    logits_processor: Optional[LogitsProcessorList] = None,
+    prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor],
+                                                List[int]]] = None,
+    additional_eos_token_id: Optional[int] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+    cache_key: Optional[Hashable] = None,
+    system_cache: Optional[SystemPromptCache] = None,
+    num_speculative_tokens: int = 0,
+    max_ngram_size: int = 3,
+    speculation_stats: Optional[SpeculationStats] = None,
+    metrics: Optional[RequestMetrics] = None,
+    **kwargs,
+):
+    """Stream the reply to ``prompt``, yielding the text after every token.
+
+    With ``num_speculative_tokens`` set, up to that many tokens are drafted
+    by ``prompt_lookup_draft`` and verified in the same forward pass as the
+    last sampled token. Greedy output is unchanged, only faster when the
+    reply repeats the prompt.
+
+    ``prompt`` may also be its token ids, e.g. from
+    ``MessageTokenizer.encode_messages``, to skip the tokenizer.
+
+    ``metrics`` is filled in and exported when the reply ends. Under a
+    running ``torch.profiler`` every phase gets a named range.
+    """
+    phase = phase_ranges()
+    if isinstance(prompt, str):
+        start = time.perf_counter()
+        with phase('chat.tokenize'):
+            prompt = tokenizer(prompt)['input_ids']
+        if metrics is not None:
+            metrics.tokenize_s += time.perf_counter() - start
+    input_ids = torch.tensor([prompt], device=model.device)
+    generation_config, logits_processor, eos_token_id, model_kwargs = (
+        prepare_generation(model, input_ids, generation_config,
+                           logits_processor, prefix_allowed_tokens_fn,
+                           additional_eos_token_id, kwargs))
+    attention_mask = model_kwargs.get('attention_mask',
+                                      torch.ones_like(input_ids))
+    prompt_ids = input_ids[0].tolist()
+    past_key_values, num_cached = None, 0
+    with phase('chat.kv_cache_lookup'):
+        if prefix_cache is not None:
+            # reuse the KV states of the transcript processed in earlier
+            # turns
+            past_key_values, num_cached = prefix_cache.acquire(
+                cache_key, prompt_ids)
+        if system_cache is not None:
+            # a new or reset session still skips the shared system prompt
+            shared_key_values, num_shared = system_cache.acquire(prompt_ids)
+            if num_shared > num_cached:
+                past_key_values, num_cached = shared_key_values, num_shared
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    # the first step prefills the uncached part of the prompt, every later
+    # step feeds the token sampled in the previous step and the drafts
+    step_input_ids = input_ids[:, num_cached:]
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    # only hand the cache back if we stopped between steps, a failed forward
+    # may have left some layers updated and others not
+    cache_consistent = False
+    stop_reason = 'error'
+    if metrics is not None:
+        metrics.begin_prefill(len(prompt_ids), num_cached, model.device)
+    try:
+        draft_ids = input_ids[0, :0]
+        while True:
+            # forward pass to get next token, plus one verifying each draft
+            num_drafts = len(draft_ids)
+            with phase('chat.prefill' if input_ids.shape[-1] ==
+                       len(prompt_ids) else 'chat.forward'):
+                outputs = model(
+                    input_ids=torch.cat([step_input_ids, draft_ids[None]],
+                                        dim=-1),
+                    attention_mask=torch.cat(
+                        [attention_mask,
+                         attention_mask.new_ones((1, num_drafts))],
+                        dim=-1),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    logits_to_keep=1 + num_drafts,
+                    return_dict=True,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                )
+            past_key_values = outputs.past_key_values
+
+            # update generated ids, model inputs, and length for next step
+            num_input = input_ids.shape[-1]
+            input_ids, num_accepted = accept_draft(generation_config,
+                                                   logits_processor,
+                                                   input_ids, outputs.logits,
+                                                   draft_ids, phase)
+            if num_accepted < num_drafts:
+                # forget the rejected drafts, the accepted ones stay cached
+                past_key_values.crop(num_input + num_accepted)
+            new_tokens = input_ids[0, num_input:].tolist()
+            eos_idx = next((idx for idx, token_id in enumerate(new_tokens)
+                            if token_id in eos_token_id), len(new_tokens))
+            if eos_idx < len(new_tokens) - 1:
+                # an accepted draft ended the reply, drop what came after
+                # it; eos is not cached, as when it is sampled
+                new_tokens = new_tokens[:eos_idx + 1]
+                input_ids = input_ids[:, :num_input + eos_idx + 1]
+                past_key_values.crop(num_input + eos_idx)
+            if metrics is not None and num_input == len(prompt_ids):
+                metrics.first_token(model.device)
+            attention_mask = torch.cat(
+                [attention_mask,
+                 attention_mask.new_ones((1, len(new_tokens)))],
+                dim=-1)
+            step_input_ids = input_ids[:, -1:]
+            if speculation_stats is not None:
+                speculation_stats.forward_passes += 1
+                speculation_stats.drafted_tokens += num_drafts
+                speculation_stats.accepted_tokens += num_accepted
+
+            for idx, next_token_id in enumerate(new_tokens):
+                # stop when each sentence is finished
+                # or if we exceed the maximum length
+                finished = (next_token_id in eos_token_id
+                            or num_input + idx + 1 >=
+                            generation_config.max_length)
+                with phase('chat.detokenize'):
+                    # eos is never shown
+                    if next_token_id not in eos_token_id:
+                        detokenizer.push(next_token_id)
+                    if finished:
+                        detokenizer.flush()
+                if finished:
+                    stop_reason = ('stop' if next_token_id in eos_token_id
+                                   else 'length')
+                if speculation_stats is not None:
+                    speculation_stats.generated_tokens += 1
+
+                yield detokenizer.text
+                if finished:
+                    break
+            if finished:
+                break
+            # never draft past max_length, a draft is verified only once
+            draft_ids = input_ids[0, :0]
+            num_draft_tokens = min(
+                num_speculative_tokens,
+                generation_config.max_length - input_ids.shape[-1] - 1)
+            if num_draft_tokens > 0:
+                with phase('chat.draft'):
+                    draft_ids = prompt_lookup_draft(input_ids[0],
+                                                    num_draft_tokens,
+                                                    max_ngram_size)
+    except GeneratorExit:
+        # abandoned by the caller while suspended at a yield
+        cache_consistent = True
+        stop_reason = 'abort'
+        raise
+    else:
+        cache_consistent = True
+    finally:
+        if prefix_cache is not None and cache_consistent:
+            # the last sampled token was never fed, so it is not cached
+            num_fed = past_key_values.get_seq_length()
+            with phase('chat.kv_cache_release'):
+                prefix_cache.release(cache_key,
+                                     input_ids[0, :num_fed].tolist(),
+                                     past_key_values)
+        if metrics is not None:
+            metrics.finish(stop_reason, input_ids.shape[-1] - len(prompt_ids),
+                           model.device)
+
+
+@torch.inference_mode()
+def generate_batch_interactive(
+    model,
+    tokenizer,
+    prompts: List[Union[str, List[int]]],
+    generation_config: Optional[GenerationConfig] = None,
+    logits_processor: Optional[LogitsProcessorList] = None,
+    prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor],
+                                                List[int]]] = None,
+    additional_eos_token_id: Optional[int] = None,
+    **kwargs,
+):
+    """Stream several prompts from one forward pass per step.
+
+    Prompts are left padded so every row samples from its last position.
+    Each row gets the generation config, logits processors and length
+    limits of its own unpadded prompt, so it is sampled as by
+    ``generate_interactive``. Each row stops on its own eos and keeps its
+    final text while the others finish; every step yields the list of
+    responses so far. Prompts may be given as token ids, as in
+    ``generate_interactive``. No KV cache is shared with other calls and no
+    metrics are recorded.
+    """
+    rows = [
+        tokenizer(prompt)['input_ids'] if isinstance(prompt, str) else prompt
+        for prompt in prompts
+    ]
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    max_row_length = max(len(row) for row in rows)
+    input_ids = torch.tensor(
+        [[pad_token_id] * (max_row_length - len(row)) + row for row in rows],
+        device=model.device)
+    attention_mask = torch.tensor(
+        [[0] * (max_row_length - len(row)) + [1] * len(row) for row in rows],
+        device=model.device)
+    # the padding is the eos token, a repetition penalty or min_new_tokens
+    # must only see the row's own tokens
+    row_input_ids = [torch.tensor([row], device=model.device) for row in rows]
+    row_generations = [
+        prepare_generation(model, row_ids, generation_config,
+                           logits_processor, prefix_allowed_tokens_fn,
+                           additional_eos_token_id, kwargs)
+        for row_ids in row_input_ids
+    ]
+    eos_token_id = row_generations[0][2]
+    # positions count real tokens only, so padding does not shift RoPE
+    position_ids = attention_mask.cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    past_key_values = DynamicCache()
+    unfinished = [True] * len(rows)
+    detokenizers = [IncrementalDetokenizer(tokenizer) for _ in prompts]
+    step_input_ids = input_ids
+    while True:
+        outputs = model(
+            input_ids=step_input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1,
+            return_dict=True,
+            output_attentions=False,
+            output_hidden_states=False,
+        )
+        past_key_values = outputs.past_key_values
+        # finished rows keep decoding padding until the batch is done
+        next_tokens = [pad_token_id] * len(rows)
+        for row, (row_config, row_processor, _, _) in enumerate(
+                row_generations):
+            if not unfinished[row]:
+                continue
+            next_token = sample_next_tokens(row_config, row_processor,
+                                            row_input_ids[row],
+                                            outputs.logits[row:row + 1, -1])
+            row_input_ids[row] = torch.cat(
+                [row_input_ids[row], next_token[:, None]], dim=-1)
+            token_id = next_tokens[row] = next_token.item()
+            # stop when each sentence is finished
+            # or if we exceed the maximum length
+            unfinished[row] = (token_id not in eos_token_id
+                               and row_input_ids[row].shape[-1] <
+                               row_config.max_length)
+            if token_id not in eos_token_id:
+                detokenizers[row].push(token_id)
+            if not unfinished[row]:
+                detokenizers[row].flush()
+
+        attention_mask = torch.cat(
+            [attention_mask,
+             attention_mask.new_ones((attention_mask.shape[0], 1))],
+            dim=-1)
+        step_input_ids = torch.tensor(next_tokens,
+                                      device=model.device)[:, None]
+        position_ids = position_ids[:, -1:] + 1
+
+        yield [detokenizer.text for detokenizer in detokenizers]
+        if not any(unfinished):
+            break
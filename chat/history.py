@@ -0,0 +1,164 @@
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from prompts import render_message
+
+Message = Dict[str, str]
+
+
+class MessageTokenizer:
+    """Token ids of rendered chat messages, each tokenized only once.
+
+    Ids are keyed by role and content, so the history of a conversation is
+    not tokenized again on later turns, in any session; only the new query
+    goes through the tokenizer. Every rendered message starts at a special
+    token, so the ids of a prompt are the concatenated ids of its messages,
+    the same as tokenizing the whole ``render_messages`` string.
+    """
+
+    def __init__(self, tokenizer, max_entries: int = 65536):
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        # (role, content, is_query) -> array of token ids
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+        self.tokenized = 0
+
+    def _segment(self, message: Message, is_query: bool) -> array:
+        key = (message['role'], message['content'], is_query)
+        with self._lock:
+            segment = self._segments.get(key)
+            if segment is not None:
+                self._segments.move_to_end(key)
+                return segment
+        # 4 bytes a token instead of a python int each
+        segment = array(
+            'i',
+            self.tokenizer(render_message(message, is_query),
+                           add_special_tokens=False)['input_ids'])
+        with self._lock:
+            self.tokenized += 1
+            self._segments[key] = segment
+            while len(self._segments) > self.max_entries:
+                self._segments.popitem(last=False)
+        return segment
+
+    def encode(self, message: Message, is_query: bool = False) -> List[int]:
+        return self._segment(message, is_query).tolist()
+
+    def count(self, message: Message, is_query: bool = False) -> int:
+        return len(self._segment(message, is_query))
+
+    def encode_messages(self, messages: List[Message]) -> List[int]:
+        """Prompt ids of ``messages``, as ``render_messages`` lays them out."""
+        *history, query = messages
+        ids = array('i')
+        for message in history:
+            ids.extend(self._segment(message, False))
+        ids.extend(self._segment(query, True))
+        return ids.tolist()
+
+    def count_messages(self, messages: List[Message]) -> int:
+        *history, query = messages
+        return sum(self.count(message) for message in history) + self.count(
+            query, is_query=True)
+
+
+def summarize_topics(messages: List[Message], max_chars: int = 120) -> str:
+    """A one-line reminder of what the dropped user turns asked."""
+    asks = [
+        message['content'].strip().replace('\n', ' ')[:20]
+        for message in messages if message['role'] == 'user'
+    ]
+    return ('(此前聊过: ' + '; '.join(asks))[:max_chars] + ')'
+
+
+class HistoryWindow:
+    """Fit the chat history of one conversation into ``budget`` tokens.
+
+    Leading system messages and the query are always kept. Once the prompt
+    outgrows the budget, whole turns are dropped from the front until it
+    fits ``low_watermark * budget``, and the start of the window then stays
+    put for the following turns. The prompt prefix, and with it the cached
+    KV states, only changes on those jumps instead of on every turn.
+
+    With ``summarize`` the dropped turns are replaced by a user message of
+    its text, e.g. ``summarize_topics``.
+    """
+
+    def __init__(self,
+                 message_tokenizer: MessageTokenizer,
+                 budget: int,
+                 low_watermark: float = 0.75,
+                 summarize: Optional[Callable[[List[Message]], str]] = None):
+        self.message_tokenizer = message_tokenizer
+        self.budget = budget
+        self.low_watermark = low_watermark
+        self.summarize = summarize
+        # number of history messages dropped from the front
+        self.start = 0
+        self._summary = (0, None)
+        self.last_stats = {}
+
+    def _summary_message(self, history: List[Message]) -> Optional[Message]:
+        if self.summarize is None or self.start == 0:
+            return None
+        if self._summary[0] != self.start:
+            self._summary = (self.start, {
+                'role': 'user',
+                'content': self.summarize(history[:self.start])
+            })
+        return self._summary[1]
+
+    def fit(self, messages: List[Message]) -> List[Message]:
+        """The messages to render, at most ``budget`` tokens long.
+
+        Raises ValueError if the system prompt and query alone do not fit.
+        """
+        num_system = 0
+        while (num_system < len(messages) - 1
+               and messages[num_system]['role'] == 'system'):
+            num_system += 1
+        system, history, query = (messages[:num_system],
+                                  messages[num_system:-1], messages[-1])
+        count = self.message_tokenizer.count
+        fixed_tokens = sum(count(message) for message in system) + count(
+            query, is_query=True)
+        counts = [count(message) for message in history]
+        if self.start > len(history):
+            # the conversation was cleared or replaced
+            self.start = 0
+
+        def window_tokens():
+            summary = self._summary_message(history)
+            summary_tokens = count(summary) if summary is not None else 0
+            return fixed_tokens + sum(counts[self.start:]) + summary_tokens
+
+        if window_tokens() > self.budget:
+            target = self.low_watermark * self.budget
+            while self.start < len(history) and window_tokens() > target:
+                # drop a whole turn, the window starts at a user message
+                self.start += 1
+                while (self.start < len(history)
+                       and history[self.start]['role'] != 'user'):
+                    self.start += 1
+        summary = self._summary_message(history)
+        if window_tokens() > self.budget:
+            # everything is dropped and even the summary does not fit
+            summary = None
+        prompt_tokens = fixed_tokens + sum(counts[self.start:])
+        if summary is not None:
+            prompt_tokens += count(summary)
+        if prompt_tokens > self.budget:
+            raise ValueError(f'the system prompt and query take '
+                             f'{prompt_tokens} tokens, over the budget of '
+                             f'{self.budget}')
+        self.last_stats = {
+            'full_prompt_tokens': fixed_tokens + sum(counts),
+            'prompt_tokens': prompt_tokens,
+            'dropped_messages': self.start,
+        }
+        return (system + ([summary] if summary is not None else []) +
+                history[self.start:] + [query])
@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable, Optional, Sequence, Tuple
+
+import torch
+
+from transformers import DynamicCache
+
+
+def cache_nbytes(cache: DynamicCache) -> int:
+    """Bytes held by the key/value tensors of ``cache``."""
+    return sum(t.numel() * t.element_size()
+               for t in (*cache.key_cache, *cache.value_cache))
+
+
+def common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """LRU store of per-session KV caches for the already processed transcript.
+
+    Each entry holds the token ids that were fed through the model together
+    with the resulting ``DynamicCache``. A new turn reuses the longest common
+    prefix of its prompt with the stored ids, so only the new messages are
+    prefilled. An entry is checked out while a generation runs on it and put
+    back afterwards; least recently used entries are evicted once the total
+    size exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # key -> (token_ids, cache, nbytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def acquire(
+            self, key: Hashable,
+            token_ids: Sequence[int]) -> Tuple[Optional[DynamicCache], int]:
+        """Check out the cache for ``key`` cropped to its overlap with
+        ``token_ids``. Returns ``(cache, num_reused_tokens)`` or
+        ``(None, 0)`` on a miss."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+        if entry is None:
+            self.misses += 1
+            return None, 0
+        cached_ids, cache, _ = entry
+        # at least one prompt token has to go through the model to get logits
+        num_reused = min(common_prefix_length(cached_ids, token_ids),
+                         len(token_ids) - 1)
+        if num_reused <= 0:
+            self.misses += 1
+            return None, 0
+        cache.crop(num_reused)
+        self.hits += 1
+        self.reused_tokens += num_reused
+        return cache, num_reused
+
+    def release(self, key: Hashable, token_ids: Sequence[int],
+                cache: DynamicCache):
+        """Store ``cache``, which holds the KV states of ``token_ids``."""
+        nbytes = cache_nbytes(cache)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (list(token_ids), cache, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted
+
+    def invalidate(self, *keys: Hashable):
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.total_bytes -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def share_cache(cache: DynamicCache) -> DynamicCache:
+    """A new ``DynamicCache`` over the same tensors.
+
+    ``DynamicCache.update`` and ``crop`` replace the per-layer tensors instead
+    of writing into them, so generating on the copy never touches ``cache``.
+    """
+    return DynamicCache.from_legacy_cache(cache.to_legacy_cache())
+
+
+class SystemPromptCache:
+    """KV states of the system prompts, computed once and shared read-only.
+
+    Every conversation starts with one of a handful of fixed system prompts
+    (normal and deepthink). Their caches are built at model load time and
+    each generation starts from a shallow copy, so prefill begins right
+    after the system prompt.
+    """
+
+    def __init__(self):
+        # (token_ids, cache), longest prompt first
+        self._entries = []
+
+    @classmethod
+    @torch.inference_mode()
+    def build(cls, model, tokenizer, prompts: Iterable[str]):
+        system_cache = cls()
+        for prompt in prompts:
+            input_ids = tokenizer([prompt],
+                                  return_tensors='pt')['input_ids'].to(
+                                      model.device)
+            cache = DynamicCache()
+            model(input_ids=input_ids,
+                  past_key_values=cache,
+                  use_cache=True,
+                  logits_to_keep=1)
+            system_cache._entries.append((input_ids[0].tolist(), cache))
+        system_cache._entries.sort(key=lambda entry: -len(entry[0]))
+        return system_cache
+
+    def acquire(
+            self,
+            token_ids: Sequence[int]) -> Tuple[Optional[DynamicCache], int]:
+        """A private copy of the cache whose prompt starts ``token_ids``."""
+        for cached_ids, cache in self._entries:
+            num_cached = len(cached_ids)
+            if (num_cached < len(token_ids)
+                    and list(token_ids[:num_cached]) == cached_ids):
+                return share_cache(cache), num_cached
+        return None, 0
+
+    @property
+    def nbytes(self):
+        return sum(cache_nbytes(cache) for _, cache in self._entries)
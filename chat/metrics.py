@@ -0,0 +1,220 @@
+"""Per-request inference metrics.
+
+A ``RequestMetrics`` follows one reply from submission to its last token:
+
+    submitted -> tokenized -> queued -> prefill -> first token -> decode
+
+``finish`` exports it as Prometheus metrics (served on ``/metrics`` by
+``server.py``, or on ``CHAT_METRICS_PORT`` by ``web_demo.py``) and as one
+JSON line on the ``chat.requests`` logger. Only a few timestamps are taken
+per request, none per token. The hits, misses and saved generation time of
+response_cache.py are exported next to them.
+"""
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram
+
+REQUEST_LOG = logging.getLogger('chat.requests')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384,
+                 32768)
+
+QUEUE_WAIT = Histogram('chat_queue_wait_seconds',
+                       'Time from submission to the start of prefill',
+                       buckets=LATENCY_BUCKETS)
+TOKENIZE = Histogram('chat_tokenize_seconds',
+                     'Time spent tokenizing the prompt',
+                     buckets=LATENCY_BUCKETS)
+PREFILL = Histogram('chat_prefill_seconds',
+                    'Forward pass over the uncached prompt tokens',
+                    buckets=LATENCY_BUCKETS)
+TTFT = Histogram('chat_time_to_first_token_seconds',
+                 'Time from submission to the first sampled token',
+                 buckets=LATENCY_BUCKETS)
+DECODE_RATE = Histogram('chat_decode_tokens_per_second',
+                        'Tokens per second after the first one',
+                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+PROMPT_TOKENS = Histogram('chat_prompt_tokens',
+                          'Prompt length in tokens',
+                          buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = Histogram('chat_output_tokens',
+                          'Generated tokens per request',
+                          buckets=TOKEN_BUCKETS)
+REQUESTS = Counter('chat_requests', 'Finished requests', ['stop_reason'])
+PEAK_MEMORY = Gauge('chat_peak_memory_bytes',
+                    'Peak memory while the last finished request ran')
+# replies cancelled by web_demo.py when its user moved on, see worker.py
+WASTED_DECODE_STEPS = Counter(
+    'chat_wasted_decode_steps',
+    'Decode steps run after their reply was cancelled')
+CANCEL_LATENCY = Histogram(
+    'chat_cancel_latency_seconds',
+    'Time from cancelling a reply to its generation stopping',
+    buckets=LATENCY_BUCKETS)
+# replies served by response_cache.py, the hit rate is
+# rate(hits) / (rate(hits) + rate(misses))
+RESPONSE_CACHE_HITS = Counter('chat_response_cache_hits',
+                              'Replies served from the response cache')
+RESPONSE_CACHE_MISSES = Counter('chat_response_cache_misses',
+                                'Response cache lookups that generated')
+RESPONSE_CACHE_SAVED = Counter(
+    'chat_response_cache_saved_seconds',
+    'Generation time of the cached replies served instead')
+
+
+def peak_memory(device) -> int:
+    """Peak CUDA memory since the last ``reset_peak_memory``, else peak RSS.
+
+    On Linux the RSS peak is the kernel's high-water mark (``VmHWM``),
+    which ``reset_peak_memory`` lowers to the current RSS. Elsewhere it is
+    the peak of the whole process.
+    """
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+# requests between begin_prefill and finish: the peak can only be reset for
+# the whole process (or device), so it is reset only while none is running
+_running = 0
+_running_lock = threading.Lock()
+
+
+def _enter_peak_window(device):
+    global _running
+    with _running_lock:
+        if _running == 0:
+            reset_peak_memory(device)
+        _running += 1
+
+
+def _leave_peak_window():
+    global _running
+    with _running_lock:
+        _running -= 1
+
+
+def log_requests(path: Optional[str] = None):
+    """Write the JSON line of every request to ``path``, or to stderr."""
+    handler = (logging.FileHandler(path, encoding='utf-8')
+               if path else logging.StreamHandler())
+    REQUEST_LOG.addHandler(handler)
+    REQUEST_LOG.setLevel(logging.INFO)
+    REQUEST_LOG.propagate = False
+
+
+@dataclass
+class RequestMetrics:
+    """Timings of one request, all in seconds.
+
+    ``stop_reason`` is ``stop`` (eos), ``length``, ``abort`` (the client
+    went away or the reply was cancelled) or ``error``.
+    ``peak_memory_bytes`` is the CUDA or RSS peak from the start of prefill,
+    see ``peak_memory``. Resetting it would lose the peak of any other
+    running request, so with concurrent requests it is the peak of all of
+    them since the oldest one began prefill, an upper bound on its own.
+    """
+    request_id: str = ''
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    tokenize_s: float = 0.0
+    queue_wait_s: float = 0.0
+    prefill_s: float = 0.0
+    ttft_s: float = 0.0
+    decode_s: float = 0.0
+    decode_tokens_per_s: float = 0.0
+    stop_reason: Optional[str] = None
+    peak_memory_bytes: int = 0
+    # unix time
+    finished_at: float = 0.0
+    submitted: float = field(default_factory=time.perf_counter, repr=False)
+    _prefill_start: float = field(default=0.0, repr=False)
+    _first_token: Optional[float] = field(default=None, repr=False)
+
+    def begin_prefill(self, prompt_tokens: int, cached_tokens: int, device):
+        now = time.perf_counter()
+        self.prompt_tokens = prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.queue_wait_s = now - self.submitted - self.tokenize_s
+        self._prefill_start = now
+        _enter_peak_window(device)
+
+    def first_token(self, device):
+        """Call once the first token was sampled (and synced to the host)."""
+        now = time.perf_counter()
+        self._first_token = now
+        self.prefill_s = now - self._prefill_start
+        self.ttft_s = now - self.submitted
+        self.peak_memory_bytes = peak_memory(device)
+
+    def finish(self, stop_reason: str, output_tokens: int, device):
+        """Record the end of the request and export it, once."""
+        if self.stop_reason is not None:
+            return
+        now = time.perf_counter()
+        self.finished_at = time.time()
+        self.stop_reason = stop_reason
+        self.output_tokens = output_tokens
+        if self._first_token is not None:
+            self.decode_s = now - self._first_token
+            if output_tokens > 1 and self.decode_s > 0:
+                # the first token came out of the prefill
+                self.decode_tokens_per_s = ((output_tokens - 1) /
+                                            self.decode_s)
+        if self._prefill_start:
+            self.peak_memory_bytes = max(self.peak_memory_bytes,
+                                         peak_memory(device))
+            _leave_peak_window()
+        self.export()
+
+    def export(self):
+        REQUESTS.labels(self.stop_reason).inc()
+        TOKENIZE.observe(self.tokenize_s)
+        PROMPT_TOKENS.observe(self.prompt_tokens)
+        OUTPUT_TOKENS.observe(self.output_tokens)
+        if self._prefill_start:
+            QUEUE_WAIT.observe(self.queue_wait_s)
+            PEAK_MEMORY.set(self.peak_memory_bytes)
+        if self._first_token is not None:
+            PREFILL.observe(self.prefill_s)
+            TTFT.observe(self.ttft_s)
+        if self.decode_tokens_per_s:
+            DECODE_RATE.observe(self.decode_tokens_per_s)
+        if REQUEST_LOG.isEnabledFor(logging.INFO):
+            record = {
+                key: value
+                for key, value in asdict(self).items()
+                if not key.startswith('_') and key != 'submitted'
+            }
+            REQUEST_LOG.info(json.dumps(record))
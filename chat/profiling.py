@@ -0,0 +1,82 @@
+"""On-demand ``torch.profiler`` capture of single chat requests.
+
+While a request is profiled, ``generate_interactive`` marks its phases
+with ``record_function`` ranges (``chat.tokenize``, ``chat.forward``,
+``chat.logits_processors``, ``chat.sample``, ``chat.detokenize``, ...).
+Every profiled request leaves two files in the output directory:
+
+    <request_id>.json  Chrome trace, open in chrome://tracing or Perfetto
+    <request_id>.txt   the ops with the most self time
+
+The profiler only records the thread it was started on, which is why
+``profiled_stream`` starts it on the thread that pulls the reply; the
+redraws of ``web_demo.py`` run on another one and are not in the trace.
+Unprofiled requests run exactly as before, the ranges are only entered
+while a profiler is active.
+"""
+import os
+import random
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Iterator, Optional
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+# torch allows one profiler per process
+_profiler_lock = threading.Lock()
+
+
+def phase_ranges() -> Callable:
+    """``record_function`` while a profiler runs, else a no-op context.
+
+    Decided once per request: entering a ``record_function`` costs
+    microseconds even when nothing records it.
+    """
+    if torch.autograd._profiler_enabled():
+        return record_function
+    return nullcontext
+
+
+def should_profile(enabled: bool, sample_rate: float = 0.0) -> bool:
+    """Profile if switched on, or for a ``sample_rate`` share of requests."""
+    return enabled or (sample_rate > 0 and random.random() < sample_rate)
+
+
+@contextmanager
+def profile_request(out_dir: Optional[str],
+                    request_id: str,
+                    row_limit: int = 30):
+    """Profile the block and write the trace and summary of
+    ``request_id`` to ``out_dir``. Yields whether it is profiling: with
+    ``out_dir`` None, or while another request is being profiled, the block
+    runs as is."""
+    if out_dir is None or not _profiler_lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities) as profiler:
+            yield True
+        os.makedirs(out_dir, exist_ok=True)
+        profiler.export_chrome_trace(
+            os.path.join(out_dir, f'{request_id}.json'))
+        sort_by = ('self_cuda_time_total'
+                   if torch.cuda.is_available() else 'self_cpu_time_total')
+        with open(os.path.join(out_dir, f'{request_id}.txt'),
+                  'w',
+                  encoding='utf-8') as f:
+            f.write(profiler.key_averages().table(sort_by=sort_by,
+                                                  row_limit=row_limit))
+    finally:
+        _profiler_lock.release()
+
+
+def profiled_stream(stream: Iterable, out_dir: Optional[str],
+                    request_id: str) -> Iterator:
+    """``stream`` profiled by ``profile_request`` on whichever thread
+    iterates it. A stream closed before its end leaves no files."""
+    with profile_request(out_dir, request_id):
+        yield from stream
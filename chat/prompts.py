@@ -0,0 +1,95 @@
+meta_instruction = ('你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。')
+deepthink_instruction = (
+    """You are an expert mathematician with extensive experience in mathematical competitions. You approach problems through systematic thinking and rigorous reasoning. When solving problems, follow these thought processes:
+## Deep Understanding
+Take time to fully comprehend the problem before attempting a solution. Consider:
+- What is the real question being asked?
+- What are the given conditions and what do they tell us?
+- Are there any special restrictions or assumptions?
+- Which information is crucial and which is supplementary?
+## Multi-angle Analysis
+Before solving, conduct thorough analysis:
+- What mathematical concepts and properties are involved?
+- Can you recall similar classic problems or solution methods?
+- Would diagrams or tables help visualize the problem?
+- Are there special cases that need separate consideration?
+## Systematic Thinking
+Plan your solution path:
+- Propose multiple possible approaches
+- Analyze the feasibility and merits of each method
+- Choose the most appropriate method and explain why
+- Break complex problems into smaller, manageable steps
+## Rigorous Proof
+During the solution process:
+- Provide solid justification for each step
+- Include detailed proofs for key conclusions
+- Pay attention to logical connections
+- Be vigilant about potential oversights
+## Repeated Verification
+After completing your solution:
+- Verify your results satisfy all conditions
+- Check for overlooked special cases
+- Consider if the solution can be optimized or simplified
+- Review your reasoning process
+Remember:
+1. Take time to think thoroughly rather than rushing to an answer
+2. Rigorously prove each key conclusion
+3. Keep an open mind and try different approaches
+4. Summarize valuable problem-solving methods
+5. Maintain healthy skepticism and verify multiple times
+Your response should reflect deep mathematical understanding and precise logical thinking, making your solution path and reasoning clear to others.
+When you're ready, present your complete solution with:
+- Clear problem understanding
+- Detailed solution process
+- Key insights
+- Thorough verification
+Focus on clear, logical progression of ideas and thorough explanation of your mathematical reasoning. Provide answers in the same language as the user asking the question, repeat the final answer using a '\\boxed{}' without any units, you have [[8192]] tokens to complete the answer.
+""")  # noqa: E501
+
+user_prompt = '<|im_start|>user\n{user}<|im_end|>\n'
+robot_prompt = '<|im_start|>assistant\n{robot}<|im_end|>\n'
+cur_query_prompt = '<|im_start|>user\n{user}<|im_end|>\n\
+    <|im_start|>assistant\n'
+system_prompt_template = '<s><|im_start|>system\n{system}<|im_end|>\n'
+
+
+def system_instruction(deepthink=False):
+    if deepthink:
+        return meta_instruction + deepthink_instruction
+    return meta_instruction
+
+
+def system_prompt(deepthink=False):
+    return system_prompt_template.format(system=system_instruction(deepthink))
+
+
+def render_message(message, is_query=False):
+    """Render one OpenAI style message; the query opens the assistant turn.
+
+    Every message starts at a special token, so the token count of a prompt
+    is the sum of the counts of its rendered messages.
+    """
+    cur_content = message['content']
+    if is_query:
+        if message['role'] != 'user':
+            raise ValueError('the last message must come from the user')
+        return cur_query_prompt.format(user=cur_content)
+    if message['role'] == 'system':
+        return system_prompt_template.format(system=cur_content)
+    if message['role'] == 'user':
+        return user_prompt.format(user=cur_content)
+    if message['role'] == 'assistant':
+        return robot_prompt.format(robot=cur_content)
+    raise ValueError(f"unknown role {message['role']!r}")
+
+
+def render_messages(messages):
+    """Render OpenAI style chat ``messages`` into the prompt string.
+
+    The last message is the user query and is followed by an open assistant
+    turn, laid out as ``combine_history`` in ``web_demo.py`` used to.
+    """
+    *history, query = messages
+    query_prompt = render_message(query, is_query=True)
+    return ''.join(render_message(message)
+                   for message in history) + query_prompt
@@ -0,0 +1,74 @@
+import math
+import re
+import time
+from typing import Callable, Optional
+
+CURSOR = '▌'
+
+
+def convert_math(text: str) -> str:
+    """``\\(..\\)`` and ``\\[..\\]`` to the ``$`` delimiters of st.markdown."""
+    text = re.sub(r'\\\(|\\\)', r'$', text)
+    return re.sub(r'\\\[|\\\]', r'$$', text)
+
+
+class StreamRenderer:
+    """Draw a streamed reply into a streamlit placeholder.
+
+    ``update`` takes the whole reply so far, as the generators yield it,
+    but only converts the text added since the previous call: every
+    delimiter is a backslash and the character after it, so it is enough to
+    hold back a trailing backslash. The placeholder is redrawn at most every
+    ``frame_interval_s`` and, with ``tokens_per_frame``, also once that many
+    updates are pending, instead of once per token.
+    """
+
+    def __init__(self,
+                 placeholder,
+                 prefix: str = '',
+                 frame_interval_s: float = 0.05,
+                 tokens_per_frame: Optional[int] = None,
+                 clock: Callable[[], float] = time.perf_counter):
+        self.placeholder = placeholder
+        self.prefix = prefix
+        self.frame_interval_s = frame_interval_s
+        self.tokens_per_frame = tokens_per_frame
+        self.clock = clock
+        self.text = ''
+        self.frames = 0
+        self._chunks = [prefix]
+        self._held = ''
+        self._pending = 0
+        self._last_frame = -math.inf
+
+    def update(self, text: str):
+        if not text.startswith(self.text):
+            # not a continuation, e.g. a cached reply replacing the stream
+            self.text, self._chunks, self._held = '', [self.prefix], ''
+        new_text = self._held + text[len(self.text):]
+        self.text = text
+        if not new_text:
+            return
+        self._held = new_text[-1] if new_text.endswith('\\') else ''
+        self._chunks.append(
+            convert_math(new_text[:len(new_text) - len(self._held)]))
+        self._pending += 1
+        if (self.clock() - self._last_frame >= self.frame_interval_s
+                or (self.tokens_per_frame is not None
+                    and self._pending >= self.tokens_per_frame)):
+            self._draw(CURSOR)
+
+    def finish(self) -> str:
+        """Draw the final text without the cursor and return the reply."""
+        self._chunks.append(self._held)
+        self._held = ''
+        self._draw('')
+        return self.text
+
+    def _draw(self, cursor: str):
+        markdown = ''.join(self._chunks)
+        self._chunks = [markdown]
+        self.placeholder.markdown(markdown + cursor)
+        self.frames += 1
+        self._pending = 0
+        self._last_frame = self.clock()
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import (RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES,
+                     RESPONSE_CACHE_SAVED)
+from worker import close_stream
+
+# (response, latency_s, created)
+Variant = Tuple[str, float, float]
+
+# the access time on disk is only rewritten this often per key, so hits do
+# not each cost a write; LRU eviction on disk needs no finer resolution
+ACCESS_RESOLUTION_S = 60.0
+
+
+def normalize_text(text: str) -> str:
+    """Fold full-width forms and whitespace so near-identical asks match.
+
+    Spaces only matter between ASCII words, ``父亲, 幽默`` and ``父亲，幽默``
+    are the same ask.
+    """
+    text = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', text)).strip()
+    return re.sub(r'(?<![A-Za-z0-9]) | (?![A-Za-z0-9])', '', text)
+
+
+def response_cache_key(messages: List[Dict[str, str]],
+                       generation_kwargs: Dict,
+                       namespace: str = '') -> str:
+    """Key of a reply: normalised query, history hash and sampling config.
+
+    ``namespace`` separates models, e.g. the checkpoint path.
+    """
+    *history, query = messages
+    history_hash = hashlib.sha256(
+        json.dumps([[message['role'],
+                     normalize_text(message['content'])]
+                    for message in history],
+                   ensure_ascii=False).encode()).hexdigest()
+    payload = json.dumps(
+        {
+            'namespace': namespace,
+            'query': normalize_text(query['content']),
+            'history': history_hash,
+            'config': generation_kwargs,
+        },
+        sort_keys=True,
+        ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Finished replies in an in-process LRU backed by SQLite on disk.
+
+    Greedy replies are deterministic and cached once. Sampled replies get up
+    to ``num_variants`` per key: lookups miss until that many have been
+    generated, then rotate through them so repeated asks still get varied
+    answers. Entries older than ``ttl_s`` are ignored and purged, and the
+    least recently used variants are deleted once the stored text exceeds
+    ``max_disk_bytes``, with access times kept to ``ACCESS_RESOLUTION_S``.
+    The SQLite file may be shared by several processes. Lookups are counted
+    in ``stats`` and exported as the Prometheus counters of metrics.py.
+    """
+
+    def __init__(self,
+                 path: Optional[str] = None,
+                 max_memory_entries: int = 1024,
+                 max_disk_bytes: int = 256 * 1024**2,
+                 ttl_s: float = 7 * 24 * 3600,
+                 num_variants: int = 4):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_s = ttl_s
+        self.num_variants = num_variants
+        # key -> [variant, ...]
+        self._entries = OrderedDict()
+        self._rotation = {}
+        # key -> last access time written to disk
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path,
+                                       timeout=30,
+                                       check_same_thread=False,
+                                       isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                             'key TEXT, variant INTEGER, response TEXT, '
+                             'latency_s REAL, created REAL, accessed REAL, '
+                             'nbytes INTEGER, PRIMARY KEY (key, variant))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                             'ON responses (accessed)')
+            self._purge(time.time())
+        self.hits = 0
+        self.misses = 0
+        self.saved_latency_s = 0.0
+
+    def num_variants_for(self, generation_kwargs: Dict) -> int:
+        if (generation_kwargs.get('do_sample', True)
+                and generation_kwargs.get('temperature', 1.0) > 0):
+            return self.num_variants
+        return 1
+
+    def lookup(self, key: str, num_variants: int = 1) -> Optional[str]:
+        """A cached reply once ``num_variants`` of them exist, else None."""
+        now = time.time()
+        with self._lock:
+            variants = self._load(key, num_variants, now)
+            if len(variants) < num_variants:
+                self.misses += 1
+                RESPONSE_CACHE_MISSES.inc()
+                return None
+            idx = self._rotation.get(key, 0) % len(variants)
+            self._rotation[key] = idx + 1
+            response, latency_s, _ = variants[idx]
+            self.hits += 1
+            self.saved_latency_s += latency_s
+            RESPONSE_CACHE_HITS.inc()
+            RESPONSE_CACHE_SAVED.inc(latency_s)
+            if (self._db is not None and
+                    now - self._touched.get(key, 0.0) >= ACCESS_RESOLUTION_S):
+                self._db.execute(
+                    'UPDATE responses SET accessed = ? WHERE key = ?',
+                    (now, key))
+                self._touched[key] = now
+        return response
+
+    def store(self,
+              key: str,
+              response: str,
+              latency_s: float,
+              num_variants: int = 1):
+        now = time.time()
+        with self._lock:
+            variants = self._load(key, num_variants, now)
+            if len(variants) >= num_variants:
+                return
+            variants.append((response, latency_s, now))
+            if self._db is not None:
+                # expired or purged variants leave gaps in the indices, so
+                # take the next one on disk rather than len(variants) - 1,
+                # which could overwrite a live variant
+                self._db.execute(
+                    'INSERT INTO responses SELECT ?, '
+                    'COALESCE(MAX(variant), -1) + 1, ?, ?, ?, ?, ? '
+                    'FROM responses WHERE key = ?',
+                    (key, response, latency_s, now, now,
+                     len(response.encode()), key))
+                self._touched[key] = now
+                self._purge(now)
+
+    def _load(self, key: str, num_variants: int, now: float) -> List[Variant]:
+        """Live variants of ``key``, read through to disk when the memory
+        tier has fewer than wanted (another process may have added some)."""
+        variants = self._entries.pop(key, [])
+        variants = [v for v in variants if v[2] + self.ttl_s > now]
+        if len(variants) < num_variants and self._db is not None:
+            rows = self._db.execute(
+                'SELECT response, latency_s, created FROM responses '
+                'WHERE key = ? AND created > ? ORDER BY variant',
+                (key, now - self.ttl_s)).fetchall()
+            if len(rows) > len(variants):
+                variants = [tuple(row) for row in rows]
+        self._entries[key] = variants
+        while len(self._entries) > self.max_memory_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._rotation.pop(evicted, None)
+            self._touched.pop(evicted, None)
+        return variants
+
+    def _purge(self, now: float):
+        self._db.execute('DELETE FROM responses WHERE created <= ?',
+                         (now - self.ttl_s, ))
+        total_bytes = self._db.execute(
+            'SELECT COALESCE(SUM(nbytes), 0) FROM responses').fetchone()[0]
+        if total_bytes <= self.max_disk_bytes:
+            return
+        for key, variant, nbytes in self._db.execute(
+                'SELECT key, variant, nbytes FROM responses '
+                'ORDER BY accessed').fetchall():
+            self._db.execute(
+                'DELETE FROM responses WHERE key = ? AND variant = ?',
+                (key, variant))
+            total_bytes -= nbytes
+            if total_bytes <= self.max_disk_bytes:
+                break
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'saved_latency_s': self.saved_latency_s,
+            'memory_entries': len(self._entries),
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cached_stream(cache: ResponseCache, key: str,
+                  stream_fn: Callable[[], Iterable[str]],
+                  num_variants: int = 1) -> Iterator[str]:
+    """Serve the reply from ``cache`` or stream ``stream_fn()`` and cache
+    its final text. Abandoned streams are not cached."""
+    response = cache.lookup(key, num_variants)
+    if response is not None:
+        yield response
+        return
+    start = time.perf_counter()
+    stream = stream_fn()
+    try:
+        for response in stream:
+            yield response
+    finally:
+        # a cancelled reply puts its KV cache back now, not when collected
+        close_stream(stream)
+    if response is not None:
+        cache.store(key, response,
+                    time.perf_counter() - start, num_variants)
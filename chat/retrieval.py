@@ -0,0 +1,331 @@
+"""BM25 index over the curated replies of ``data/cuihun-chinese-v0.1.json``.
+
+Every dataset ``input`` names a relative, a scene and a style. Documents
+are indexed by character bigrams of their ask and reply, plus one token
+per structured field, so a query mentioning ``父亲`` and ``幽默`` ranks
+replies to fathers in a humorous style first. Postings store their final
+BM25 weight, which makes a query a handful of slices and a ``bincount``.
+
+The index is a directory of ``.npy`` arrays that ``load`` memory-maps:
+
+    python retrieval.py ../data/cuihun-chinese-v0.1.json ../data/index
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from response_cache import normalize_text
+
+FIELDS = ('relative', 'scene', 'style')
+# added to the BM25 score of documents sharing the field with the query
+FIELD_WEIGHTS = {'relative': 4.0, 'scene': 3.0, 'style': 2.0}
+# matched against normalize_text of the input
+INPUT_PATTERN = re.compile(r'催婚回应给(?P<relative>.+?),场景(?P<scene>.+?),'
+                           r'风格(?P<style>.+)$')
+ARRAYS = ('term_hashes', 'term_offsets', 'posting_docs', 'posting_weights',
+          'doc_fields', 'input_offsets', 'input_bytes', 'reply_offsets',
+          'reply_bytes')
+
+
+@dataclass
+class RetrievalHit:
+    doc_id: int
+    score: float
+    input: str
+    reply: str
+    fields: Dict[str, Optional[str]]
+
+
+def load_dataset(path) -> List[Tuple[str, str]]:
+    """``(input, output)`` pairs of an xtuner style conversation file."""
+    with open(path, encoding='utf-8') as f:
+        dataset = json.load(f)
+    return [(item['conversation'][0]['input'],
+             item['conversation'][0]['output']) for item in dataset]
+
+
+def term_hash(term: str) -> int:
+    # python's hash() is salted per process, the index outlives it
+    return int.from_bytes(
+        hashlib.blake2b(term.encode(), digest_size=8).digest(),
+        'little',
+        signed=True)
+
+
+def char_bigrams(text: str) -> List[str]:
+    """Bigrams within runs of word characters, lone characters as is."""
+    terms = []
+    for run in re.findall(r'\w+', normalize_text(text)):
+        if len(run) == 1:
+            terms.append(run)
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+def field_term(field: str, value: str) -> str:
+    # the NUL keeps field terms apart from any text bigram
+    return f'\0{field}:{value}'
+
+
+def pack_strings(strings: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode() for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+class RetrievalIndex:
+
+    def __init__(self, arrays: Dict[str, np.ndarray], meta: Dict):
+        self.arrays = arrays
+        self.meta = meta
+        self.vocab = meta['vocab']
+        # longest first, so `堂姐` is not read as `姐`
+        self._field_values = {
+            field: sorted(values, key=len, reverse=True)
+            for field, values in self.vocab.items()
+        }
+
+    @classmethod
+    def build(cls,
+              samples: Sequence[Tuple[str, str]],
+              k1: float = 1.2,
+              b: float = 0.75,
+              max_df_ratio: float = 0.5):
+        """Index ``(input, output)`` pairs.
+
+        Terms in more than ``max_df_ratio`` of the documents, such as the
+        template words of every input, carry next to no BM25 weight and are
+        dropped to keep postings short.
+        """
+        vocab = {field: [] for field in FIELDS}
+        field_ids = {field: {} for field in FIELDS}
+        term_ids = {}
+        # identical documents are tokenized once
+        memo = {}
+        doc_terms, doc_tfs, doc_fields = [], [], []
+        for doc_input, doc_output in samples:
+            key = (doc_input, doc_output)
+            if key not in memo:
+                counts = {}
+                for term in char_bigrams(doc_input) + char_bigrams(doc_output):
+                    term_id = term_ids.setdefault(term, len(term_ids))
+                    counts[term_id] = counts.get(term_id, 0) + 1
+                match = INPUT_PATTERN.match(normalize_text(doc_input))
+                fields = []
+                for field in FIELDS:
+                    value = match[field] if match else None
+                    if value is not None and value not in field_ids[field]:
+                        field_ids[field][value] = len(vocab[field])
+                        vocab[field].append(value)
+                    fields.append(-1 if value is None else
+                                  field_ids[field][value])
+                memo[key] = (np.fromiter(counts, dtype=np.int64),
+                             np.fromiter(counts.values(), dtype=np.float32),
+                             fields)
+            terms, tfs, fields = memo[key]
+            doc_terms.append(terms)
+            doc_tfs.append(tfs)
+            doc_fields.append(fields)
+
+        num_docs = len(doc_terms)
+        lengths = np.array([tfs.sum() for tfs in doc_tfs], dtype=np.float32)
+        docs = np.repeat(np.arange(num_docs, dtype=np.int32),
+                         [len(terms) for terms in doc_terms])
+        terms = np.concatenate(doc_terms)
+        tfs = np.concatenate(doc_tfs)
+        df = np.bincount(terms, minlength=len(term_ids))
+        idf = np.log1p((num_docs - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * lengths / lengths.mean())
+        weights = (idf[terms] * tfs * (k1 + 1) /
+                   (tfs + norm[docs])).astype(np.float32)
+        keep = df[terms] <= max_df_ratio * num_docs
+        text_hashes = np.array([term_hash(term) for term in term_ids],
+                               dtype=np.int64)[terms[keep]]
+        docs, weights = docs[keep], weights[keep]
+
+        # field terms get a flat weight on top of the text score
+        doc_fields = np.array(doc_fields, dtype=np.int16).reshape(-1, 3)
+        all_hashes, all_docs, all_weights = [text_hashes], [docs], [weights]
+        for col, field in enumerate(FIELDS):
+            has_field = doc_fields[:, col] >= 0
+            hashes = np.array(
+                [term_hash(field_term(field, value))
+                 for value in vocab[field]],
+                dtype=np.int64)
+            all_hashes.append(hashes[doc_fields[has_field, col]])
+            all_docs.append(np.nonzero(has_field)[0].astype(np.int32))
+            all_weights.append(
+                np.full(has_field.sum(), FIELD_WEIGHTS[field],
+                        dtype=np.float32))
+        hashes = np.concatenate(all_hashes)
+        docs = np.concatenate(all_docs)
+        weights = np.concatenate(all_weights)
+
+        # impact ordered: the best postings of every term come first
+        order = np.lexsort((docs, -weights, hashes))
+        hashes, docs, weights = hashes[order], docs[order], weights[order]
+        term_hashes, starts = np.unique(hashes, return_index=True)
+        input_offsets, input_bytes = pack_strings(
+            [doc_input for doc_input, _ in samples])
+        reply_offsets, reply_bytes = pack_strings(
+            [doc_output for _, doc_output in samples])
+        arrays = {
+            'term_hashes': term_hashes,
+            'term_offsets': np.append(starts, len(hashes)).astype(np.int64),
+            'posting_docs': docs,
+            'posting_weights': weights,
+            'doc_fields': doc_fields,
+            'input_offsets': input_offsets,
+            'input_bytes': input_bytes,
+            'reply_offsets': reply_offsets,
+            'reply_bytes': reply_bytes,
+        }
+        meta = {'num_docs': num_docs, 'k1': k1, 'b': b, 'vocab': vocab}
+        return cls(arrays, meta)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f'{name}.npy'), self.arrays[name])
+        with open(os.path.join(path, 'meta.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        # plain ndarray views of the mappings, slicing np.memmap is slow
+        arrays = {
+            name: np.asarray(
+                np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+            for name in ARRAYS
+        }
+        return cls(arrays, meta)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def __len__(self):
+        return self.meta['num_docs']
+
+    def query_fields(self, query: str) -> Dict[str, Optional[str]]:
+        """The relative, scene and style a free-form query mentions."""
+        query = normalize_text(query)
+        fields = {}
+        for field in FIELDS:
+            fields[field] = next(
+                (value
+                 for value in self._field_values[field] if value in query),
+                None)
+        return fields
+
+    def _string(self, name, doc_id):
+        offsets = self.arrays[f'{name}_offsets']
+        data = self.arrays[f'{name}_bytes'][offsets[doc_id]:offsets[doc_id +
+                                                                    1]]
+        return bytes(data).decode()
+
+    def search(self,
+               query: str,
+               k: int = 5,
+               max_postings: int = 1024) -> List[RetrievalHit]:
+        """Top ``k`` documents for ``query``.
+
+        Only the ``max_postings`` highest weighted postings of each term are
+        read, which bounds the latency on large indexes and is exact as long
+        as no term matches more documents than that.
+        """
+        fields = self.query_fields(query)
+        terms = set(char_bigrams(query))
+        terms.update(
+            field_term(field, value) for field, value in fields.items()
+            if value is not None)
+        hashes = np.array([term_hash(term) for term in terms],
+                          dtype=np.int64)
+        term_hashes = self.arrays['term_hashes']
+        term_offsets = self.arrays['term_offsets']
+        idx = np.searchsorted(term_hashes, hashes)
+        in_range = idx < len(term_hashes)
+        idx = idx[in_range]
+        idx = idx[term_hashes[idx] == hashes[in_range]]
+        if not len(idx):
+            return []
+        slices = [
+            slice(term_offsets[i],
+                  min(term_offsets[i + 1], term_offsets[i] + max_postings))
+            for i in idx.tolist()
+        ]
+        docs = np.concatenate([self.arrays['posting_docs'][s] for s in slices])
+        weights = np.concatenate(
+            [self.arrays['posting_weights'][s] for s in slices])
+        scores = np.bincount(docs, weights=weights, minlength=len(self))
+        # a document shows up once per matching term, so the best
+        # k * len(slices) postings hold at least k distinct documents
+        candidate_scores = scores[docs]
+        num_candidates = min(len(docs), k * len(slices))
+        top = np.argpartition(-candidate_scores,
+                              num_candidates - 1)[:num_candidates]
+        top = top[np.argsort(-candidate_scores[top], kind='stable')]
+        top = list(dict.fromkeys(docs[top].tolist()))[:k]
+        hits = []
+        for doc_id in top:
+            if scores[doc_id] <= 0:
+                break
+            doc_fields = self.arrays['doc_fields'][doc_id]
+            hits.append(
+                RetrievalHit(doc_id=doc_id,
+                             score=float(scores[doc_id]),
+                             input=self._string('input', doc_id),
+                             reply=self._string('reply', doc_id),
+                             fields={
+                                 field: (self.vocab[field][value]
+                                         if value >= 0 else None)
+                                 for field, value in zip(FIELDS, doc_fields)
+                             }))
+        return hits
+
+    def instant_reply(self, query: str) -> Optional[str]:
+        """The best curated reply, if it agrees with every field the query
+        names and the query names at least the relative."""
+        fields = self.query_fields(query)
+        if fields['relative'] is None:
+            return None
+        hits = self.search(query, k=1)
+        if not hits:
+            return None
+        if any(value is not None and hits[0].fields[field] != value
+               for field, value in fields.items()):
+            return None
+        return hits[0].reply
+
+
+def few_shot_messages(hits: Sequence[RetrievalHit]) -> List[Dict[str, str]]:
+    """Curated examples as prior user/assistant turns."""
+    messages = []
+    for hit in hits:
+        messages.append({'role': 'user', 'content': hit.input})
+        messages.append({'role': 'assistant', 'content': hit.reply})
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('dataset', help='xtuner style json file')
+    parser.add_argument('index', help='output directory')
+    args = parser.parse_args()
+    index = RetrievalIndex.build(load_dataset(args.dataset))
+    index.save(args.index)
+    print(f'{len(index)} documents, {index.nbytes} bytes')
+
+
+if __name__ == '__main__':
+    main()
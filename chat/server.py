@@ -0,0 +1,466 @@
+"""OpenAI compatible inference server with continuous batching.
+
+One engine task owns the model. New requests are prefilled on their own
+and then join the running decode batch at the next token boundary;
+finished ones leave it. Run it with
+
+    python server.py --model-path ../finetune/merge --port 8000
+
+and point ``web_demo.py`` at it with ``CHAT_SERVER_URL=http://host:8000/v1``.
+Prometheus metrics are served on ``/metrics``, see ``metrics.py``.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+import torch
+import torch.nn.functional as F
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from transformers import DynamicCache
+from transformers.utils import logging
+
+from backend import DTYPES, QUANTIZATIONS, BackendConfig, load_pretrained
+from detokenizer import IncrementalDetokenizer
+from generation import (GenerationConfig, prepare_generation,
+                        sample_next_tokens)
+from history import MessageTokenizer
+from kv_cache import SystemPromptCache
+from metrics import RequestMetrics, log_requests
+from prompts import system_prompt
+
+logger = logging.get_logger(__name__)
+
+# request fields forwarded to the generation config
+GENERATION_FIELDS = ('temperature', 'top_p', 'top_k', 'repetition_penalty',
+                     'max_length')
+
+
+class Sequence:
+    """One request being decoded by the engine."""
+
+    def __init__(self, prompt_ids, generation_config, logits_processor,
+                 eos_token_id, detokenizer, metrics):
+        self.request_id = f'chatcmpl-{uuid.uuid4().hex}'
+        self.prompt_ids = prompt_ids
+        self.generation_config = generation_config
+        self.logits_processor = logits_processor
+        self.eos_token_id = eos_token_id
+        self.detokenizer = detokenizer
+        self.input_ids = None
+        self.num_generated = 0
+        self.finish_reason = None
+        self.aborted = False
+        self.outputs = asyncio.Queue()
+        self.metrics = metrics
+        metrics.request_id = self.request_id
+
+    @property
+    def num_tokens(self):
+        return self.input_ids.shape[-1]
+
+    def append(self, next_token):
+        """Record a sampled token, returns the new text."""
+        self.input_ids = torch.cat([self.input_ids, next_token[:, None]],
+                                   dim=-1)
+        self.num_generated += 1
+        next_token_id = next_token.item()
+        delta = ''
+        if next_token_id in self.eos_token_id:
+            self.finish_reason = 'stop'
+        else:
+            delta = self.detokenizer.push(next_token_id)
+        if (self.finish_reason is None
+                and self.num_tokens >= self.generation_config.max_length):
+            self.finish_reason = 'length'
+        if self.finish_reason is not None:
+            delta += self.detokenizer.flush()
+        return delta
+
+    async def stream(self):
+        """Yield ``(delta, finish_reason)`` until the sequence is done."""
+        while True:
+            delta, finish_reason = await self.outputs.get()
+            yield delta, finish_reason
+            if finish_reason is not None:
+                return
+
+
+def left_pad_cache(cache, length):
+    """Legacy ``(key, value)`` tuples of ``cache`` left padded to
+    ``length`` positions."""
+    padded = []
+    for key, value in cache.to_legacy_cache():
+        pad = length - key.shape[-2]
+        padded.append((F.pad(key, (0, 0, pad, 0)), F.pad(value,
+                                                         (0, 0, pad, 0))))
+    return padded
+
+
+class ContinuousBatchingEngine:
+    """Decode loop shared by all requests.
+
+    The running batch keeps one left padded ``DynamicCache`` and attention
+    mask. Every iteration admits waiting requests (prefilled one by one,
+    starting from the shared system prompt KV when it matches), merges them
+    into the batch, runs one decode step for all rows and drops the rows
+    that finished.
+    """
+
+    def __init__(self,
+                 model,
+                 tokenizer,
+                 max_batch_size=8,
+                 system_cache=None,
+                 additional_eos_token_id=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        # clients resend the whole history, only new messages are tokenized
+        self.message_tokenizer = MessageTokenizer(tokenizer)
+        self.max_batch_size = max_batch_size
+        self.system_cache = system_cache
+        self.additional_eos_token_id = additional_eos_token_id
+        self.waiting = collections.deque()
+        self.running = []
+        self.generated_tokens = 0
+        self.past_key_values = None
+        self.attention_mask = None
+        self._wakeup = asyncio.Event()
+        # the model is only ever touched from this one thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, prompt_ids, metrics=None, **kwargs):
+        input_ids = torch.tensor([prompt_ids], device=self.model.device)
+        generation_config, logits_processor, eos_token_id, _ = (
+            prepare_generation(self.model, input_ids, None, None, None,
+                               self.additional_eos_token_id, kwargs))
+        seq = Sequence(prompt_ids, generation_config, logits_processor,
+                       eos_token_id, IncrementalDetokenizer(self.tokenizer),
+                       metrics or RequestMetrics())
+        seq.input_ids = input_ids
+        self.waiting.append(seq)
+        self._wakeup.set()
+        return seq
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.running and not self.waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            admitted = []
+            while self.waiting and (len(self.running) + len(admitted) <
+                                    self.max_batch_size):
+                seq = self.waiting.popleft()
+                if not seq.aborted:
+                    admitted.append(seq)
+            try:
+                events = await loop.run_in_executor(self._executor,
+                                                    self.step, admitted)
+            except Exception:
+                # fail the whole batch rather than leave clients hanging
+                logger.exception('decode step failed')
+                events = [(seq, '', 'error') for seq in dict.fromkeys(
+                    (*self.running, *admitted))]
+                self.running, self.past_key_values = [], None
+                self.attention_mask = None
+            for seq, delta, finish_reason in events:
+                seq.outputs.put_nowait((delta, finish_reason))
+                if finish_reason is not None:
+                    seq.metrics.finish(finish_reason, seq.num_generated,
+                                       self.model.device)
+
+    def _sample(self, seq, logits):
+        return sample_next_tokens(seq.generation_config, seq.logits_processor,
+                                  seq.input_ids, logits)
+
+    def _prefill(self, seq):
+        past_key_values, num_cached = None, 0
+        if self.system_cache is not None:
+            past_key_values, num_cached = self.system_cache.acquire(
+                seq.prompt_ids)
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        seq.metrics.begin_prefill(len(seq.prompt_ids), num_cached,
+                                  self.model.device)
+        outputs = self.model(input_ids=seq.input_ids[:, num_cached:],
+                             past_key_values=past_key_values,
+                             use_cache=True,
+                             logits_to_keep=1)
+        delta = seq.append(self._sample(seq, outputs.logits[:, -1, :]))
+        seq.metrics.first_token(self.model.device)
+        return outputs.past_key_values, delta
+
+    def _join(self, seq, past_key_values):
+        # the last sampled token is not in the cache yet
+        length = seq.num_tokens - 1
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = seq.input_ids.new_ones((1, length))
+            self.running = [seq]
+            return
+        total = max(length, self.attention_mask.shape[-1])
+        batch = left_pad_cache(self.past_key_values, total)
+        new = left_pad_cache(past_key_values, total)
+        self.past_key_values = DynamicCache.from_legacy_cache(
+            tuple((torch.cat([key, new_key]), torch.cat([value, new_value]))
+                  for (key, value), (new_key, new_value) in zip(batch, new)))
+        self.attention_mask = torch.cat([
+            F.pad(self.attention_mask,
+                  (total - self.attention_mask.shape[-1], 0)),
+            F.pad(seq.input_ids.new_ones((1, length)), (total - length, 0)),
+        ])
+        self.running.append(seq)
+
+    def _drop(self, keep):
+        if not keep:
+            self.running, self.past_key_values = [], None
+            self.attention_mask = None
+            return
+        self.running = [self.running[row] for row in keep]
+        self.past_key_values.batch_select_indices(
+            torch.tensor(keep, device=self.attention_mask.device))
+        self.attention_mask = self.attention_mask[keep]
+        # cut the padding columns that no remaining row needs anymore
+        offset = int(self.attention_mask.any(0).long().argmax())
+        if offset:
+            self.past_key_values = DynamicCache.from_legacy_cache(
+                tuple((key[..., offset:, :], value[..., offset:, :]) for key,
+                      value in self.past_key_values.to_legacy_cache()))
+            self.attention_mask = self.attention_mask[:, offset:]
+
+    @torch.inference_mode()
+    def step(self, admitted):
+        events = []
+        for seq in admitted:
+            past_key_values, delta = self._prefill(seq)
+            events.append((seq, delta, seq.finish_reason))
+            if seq.finish_reason is None:
+                self._join(seq, past_key_values)
+
+        rows = [
+            row for row, seq in enumerate(self.running) if not seq.aborted
+        ]
+        if len(rows) != len(self.running):
+            self._drop(rows)
+        if not self.running:
+            self.generated_tokens += len(events)
+            return events
+
+        self.attention_mask = torch.cat([
+            self.attention_mask,
+            self.attention_mask.new_ones((len(self.running), 1))
+        ], dim=-1)
+        step_input_ids = torch.cat(
+            [seq.input_ids[:, -1:] for seq in self.running])
+        position_ids = torch.tensor([[seq.num_tokens - 1]
+                                     for seq in self.running],
+                                    device=step_input_ids.device)
+        outputs = self.model(input_ids=step_input_ids,
+                             attention_mask=self.attention_mask,
+                             position_ids=position_ids,
+                             past_key_values=self.past_key_values,
+                             use_cache=True,
+                             logits_to_keep=1)
+        self.past_key_values = outputs.past_key_values
+        keep = []
+        for row, seq in enumerate(self.running):
+            delta = seq.append(
+                self._sample(seq, outputs.logits[row:row + 1, -1, :]))
+            events.append((seq, delta, seq.finish_reason))
+            if seq.finish_reason is None:
+                keep.append(row)
+        if len(keep) != len(self.running):
+            self._drop(keep)
+        self.generated_tokens += len(events)
+        return events
+
+
+def chunk(seq, model_name, delta, finish_reason=None):
+    return {
+        'id': seq.request_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model_name,
+        'choices': [{
+            'index': 0,
+            'delta': delta,
+            'finish_reason': finish_reason,
+        }],
+    }
+
+
+def sse(payload):
+    return f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode()
+
+
+def error_response(status, message):
+    return web.json_response(
+        {'error': {
+            'message': message,
+            'type': 'invalid_request_error'
+        }},
+        status=status)
+
+
+async def chat_completions(request):
+    engine = request.app['engine']
+    metrics = RequestMetrics()
+    try:
+        body = await request.json()
+        start = time.perf_counter()
+        prompt_ids = engine.message_tokenizer.encode_messages(
+            body['messages'])
+        metrics.tokenize_s = time.perf_counter() - start
+    except (ValueError, KeyError, TypeError) as e:
+        return error_response(400, f'invalid request: {e}')
+    kwargs = asdict(GenerationConfig())
+    kwargs.update({
+        field: body[field]
+        for field in GENERATION_FIELDS if body.get(field) is not None
+    })
+    if body.get('max_tokens') is not None:
+        kwargs['max_new_tokens'] = body['max_tokens']
+        if body.get('max_length') is None:
+            del kwargs['max_length']
+    seq = engine.submit(prompt_ids, metrics, **kwargs)
+    model_name = body.get('model', request.app['model_name'])
+
+    try:
+        if not body.get('stream', False):
+            text, finish_reason = '', None
+            async for delta, finish_reason in seq.stream():
+                text += delta
+            return web.json_response({
+                'id': seq.request_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': model_name,
+                'choices': [{
+                    'index': 0,
+                    'message': {
+                        'role': 'assistant',
+                        'content': text
+                    },
+                    'finish_reason': finish_reason,
+                }],
+                'usage': {
+                    'prompt_tokens': len(prompt_ids),
+                    'completion_tokens': seq.num_generated,
+                    'total_tokens': len(prompt_ids) + seq.num_generated,
+                },
+            })
+
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+        await response.write(
+            sse(chunk(seq, model_name, {
+                'role': 'assistant',
+                'content': ''
+            })))
+        async for delta, finish_reason in seq.stream():
+            if delta:
+                await response.write(
+                    sse(chunk(seq, model_name, {'content': delta})))
+            if finish_reason is not None:
+                await response.write(
+                    sse(chunk(seq, model_name, {}, finish_reason)))
+        await response.write(b'data: [DONE]\n\n')
+        return response
+    except (ConnectionResetError, asyncio.CancelledError):
+        # the client went away, free its row at the next step
+        seq.aborted = True
+        seq.metrics.finish('abort', seq.num_generated, engine.model.device)
+        raise
+
+
+async def list_models(request):
+    return web.json_response({
+        'object': 'list',
+        'data': [{
+            'id': request.app['model_name'],
+            'object': 'model'
+        }],
+    })
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=generate_latest(),
+                        headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def create_app(engine, model_name='cuihun'):
+    app = web.Application()
+    app['engine'] = engine
+    app['model_name'] = model_name
+
+    async def start_engine(app):
+        app['engine_task'] = asyncio.create_task(engine.run())
+        yield
+        app['engine_task'].cancel()
+
+    app.cleanup_ctx.append(start_engine)
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_get('/v1/models', list_models)
+    app.router.add_get('/metrics', prometheus_metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model-path',
+                        default='/home/suxin/chatbot/finetune/merge/')
+    parser.add_argument('--tiny',
+                        action='store_true',
+                        help='serve the random tiny model of tiny_model.py')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--request-log',
+                        default=None,
+                        help="JSON line per request to this file, '-' for "
+                        'stderr')
+    parser.add_argument('--additional-eos-token-id', type=int, default=92542)
+    parser.add_argument('--device', default='auto')
+    parser.add_argument('--dtype', choices=sorted(DTYPES), default='bfloat16')
+    parser.add_argument('--quantization',
+                        choices=QUANTIZATIONS,
+                        default='none')
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.request_log is not None:
+        log_requests(None if args.request_log == '-' else args.request_log)
+    if args.tiny:
+        from tiny_model import load_tiny_model
+        model, tokenizer = load_tiny_model()
+    else:
+        backend_config = BackendConfig.from_env()
+        backend_config.device = args.device
+        backend_config.dtype = args.dtype
+        backend_config.quantization = args.quantization
+        backend_config.num_threads = args.num_threads
+        model, tokenizer = load_pretrained(args.model_path, backend_config)
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    engine = ContinuousBatchingEngine(
+        model,
+        tokenizer,
+        max_batch_size=args.max_batch_size,
+        system_cache=system_cache,
+        additional_eos_token_id=args.additional_eos_token_id)
+    web.run_app(create_app(engine), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
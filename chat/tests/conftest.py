@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# the chat modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def tiny_model():
+    from tiny_model import load_tiny_model
+    return load_tiny_model()
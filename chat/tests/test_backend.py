@@ -0,0 +1,65 @@
+import pytest
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from backend import BackendConfig, Int4Linear, load_pretrained
+from prompts import cur_query_prompt, system_prompt
+from tiny_model import SAMPLE_QUERY
+
+# relative error of the logits against fp32; 4-bit weights of the random
+# model are off by about 20% after its four layers
+MAX_ERROR = {'int8': 0.1, 'int4': 0.35}
+
+
+@pytest.fixture(scope='module')
+def model_path(tiny_model, tmp_path_factory):
+    model, tokenizer = tiny_model
+    path = tmp_path_factory.mktemp('model')
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+
+@pytest.mark.parametrize('quantization,dtype', [('int8', 'float32'),
+                                                ('int4', 'float32'),
+                                                ('int4', 'bfloat16')])
+def test_quantized_logits_stay_close(tiny_model, model_path, tmp_path,
+                                     quantization, dtype):
+    model, tokenizer = tiny_model
+    input_ids = tokenizer(system_prompt() +
+                          cur_query_prompt.format(user=SAMPLE_QUERY),
+                          return_tensors='pt')['input_ids']
+    config = BackendConfig(device='cpu',
+                           dtype=dtype,
+                           quantization=quantization,
+                           quantized_cache_dir=str(tmp_path))
+    with torch.inference_mode():
+        expected = model(input_ids).logits
+        # the second load comes from the cache
+        logits = [
+            load_pretrained(model_path, config)[0](input_ids).logits.float()
+            for _ in range(2)
+        ]
+    assert len(list(tmp_path.iterdir())) == 1
+    assert torch.equal(logits[0], logits[1])
+    error = (logits[0] - expected).norm() / expected.norm()
+    assert error <= MAX_ERROR[quantization]
+    assert F.cosine_similarity(logits[0], expected, dim=-1).min() >= 0.95
+
+
+@pytest.mark.parametrize('in_features', [7, 256])
+def test_int4_packing(in_features):
+    torch.manual_seed(0)
+    linear = nn.Linear(in_features, 5)
+    module = Int4Linear.from_float(linear)
+    assert module.packed.shape == (5, (in_features + 1) // 2)
+    # every weight is within half a step of its group's grid
+    error = (module.dequantize() - linear.weight).abs().reshape(
+        5, -1, module.group_size)
+    assert (error <= module.scale / 2 + 1e-6).all()
+
+    loaded = Int4Linear(in_features, 5)
+    loaded.load_state_dict(module.state_dict())
+    x = torch.randn(3, in_features)
+    assert torch.equal(loaded(x), module(x))
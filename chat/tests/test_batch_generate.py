@@ -0,0 +1,52 @@
+import pytest
+
+from batch_generate import generate_replies, length_sorted_batches
+from generation import generate_interactive
+from history import MessageTokenizer
+from prompts import system_instruction
+from retrieval import load_dataset
+from tiny_model import DATASET_PATH, greedy_config
+
+NUM_PROMPTS = 12
+BATCH_SIZE = 4
+
+
+@pytest.fixture(scope='module')
+def prompt_ids(tiny_model):
+    _, tokenizer = tiny_model
+    samples = load_dataset(DATASET_PATH)
+    message_tokenizer = MessageTokenizer(tokenizer)
+    system = {'role': 'system', 'content': system_instruction()}
+    # short asks and longer follow ups, so batches need padding
+    return [
+        message_tokenizer.encode_messages([
+            system, {
+                'role': 'user',
+                'content': doc_input if i % 2 else doc_input + doc_output
+            }
+        ]) for i, (doc_input, doc_output) in enumerate(
+            samples[::len(samples) // NUM_PROMPTS][:NUM_PROMPTS])
+    ]
+
+
+@pytest.mark.parametrize('sort', [False, True], ids=['unsorted', 'sorted'])
+def test_batches_match_sequential(tiny_model, prompt_ids, sort):
+    model, tokenizer = tiny_model
+    generation_kwargs = greedy_config(16)
+    if sort:
+        batches = length_sorted_batches([len(ids) for ids in prompt_ids],
+                                        BATCH_SIZE)
+    else:
+        batches = [
+            list(range(i, min(i + BATCH_SIZE, NUM_PROMPTS)))
+            for i in range(0, NUM_PROMPTS, BATCH_SIZE)
+        ]
+    replies = dict(pair for results in generate_replies(
+        model, tokenizer, prompt_ids, batches, **generation_kwargs)
+                   for pair in results)
+    assert sorted(replies) == list(range(NUM_PROMPTS))
+    for i, ids in enumerate(prompt_ids):
+        expected = list(
+            generate_interactive(model, tokenizer, ids,
+                                 **generation_kwargs))[-1]
+        assert replies[i] == expected, i
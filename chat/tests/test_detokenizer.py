@@ -0,0 +1,40 @@
+import glob
+import json
+import os
+
+import pytest
+
+from detokenizer import REPLACEMENT_CHAR, IncrementalDetokenizer
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        '..', 'data')
+
+
+def dataset_replies():
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, '*.json'))):
+        with open(path, encoding='utf-8') as f:
+            for sample in json.load(f):
+                for turn in sample['conversation']:
+                    yield turn['output']
+
+
+@pytest.fixture(scope='module')
+def replies():
+    replies = list(dataset_replies())
+    assert replies
+    # these emoji are split into several tokens of partial UTF-8
+    return replies + ['我们一家👨‍👩‍👧', '催婚🥹🫠了']
+
+
+def test_stream_matches_full_decode(tiny_model, replies):
+    _, tokenizer = tiny_model
+    for reply in replies:
+        token_ids = tokenizer(reply, add_special_tokens=False)['input_ids']
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        deltas = []
+        for token_id in token_ids:
+            deltas.append(detokenizer.push(token_id))
+            assert not detokenizer.text.endswith(REPLACEMENT_CHAR), reply
+        deltas.append(detokenizer.flush())
+        expected = tokenizer.decode(token_ids)
+        assert detokenizer.text == ''.join(deltas) == expected
@@ -0,0 +1,282 @@
+from dataclasses import asdict
+
+import pytest
+import torch
+from torch import nn
+from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList
+
+from generation import (GenerationConfig, SpeculationStats,
+                        generate_batch_interactive, generate_interactive,
+                        prepare_generation)
+from kv_cache import PrefixCache, SystemPromptCache, cache_nbytes
+from metrics import RequestMetrics
+from prompts import cur_query_prompt, system_prompt
+from tiny_model import SAMPLE_QUERY, greedy_config
+
+PROMPTS = [
+    cur_query_prompt.format(user=SAMPLE_QUERY),
+    system_prompt(False) + cur_query_prompt.format(user=SAMPLE_QUERY),
+    system_prompt(True) + cur_query_prompt.format(user='一加一等于几？'),
+]
+
+
+@torch.inference_mode()
+def full_prefill_generate(model, tokenizer, prompt, **kwargs):
+    """The loop generate_interactive ran before the KV cache: every step
+    feeds the whole sequence through ``prepare_inputs_for_generation``.
+    Returns the generated token ids, without eos."""
+    input_ids = tokenizer([prompt], return_tensors='pt')['input_ids']
+    input_length = input_ids.shape[-1]
+    generation_config, logits_processor, eos_token_id, model_kwargs = (
+        prepare_generation(model, input_ids, None, None, None, None, kwargs))
+    while input_ids.shape[-1] < generation_config.max_length:
+        model_inputs = model.prepare_inputs_for_generation(
+            input_ids, **model_kwargs)
+        outputs = model(**model_inputs, return_dict=True)
+        next_token_scores = logits_processor(input_ids,
+                                             outputs.logits[:, -1, :])
+        probs = nn.functional.softmax(next_token_scores, dim=-1)
+        next_tokens = torch.argmax(probs, dim=-1)
+        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+        if next_tokens.item() in eos_token_id:
+            return input_ids[0, input_length:-1].tolist()
+    return input_ids[0, input_length:].tolist()
+
+
+@pytest.mark.parametrize('prompt', PROMPTS)
+def test_greedy_matches_full_prefill(tiny_model, prompt):
+    model, tokenizer = tiny_model
+    generation_kwargs = greedy_config(24)
+    expected = full_prefill_generate(model, tokenizer, prompt,
+                                     **generation_kwargs)
+    steps = list(
+        generate_interactive(model, tokenizer, prompt, **generation_kwargs))
+    # one step per token, plus the step that samples eos when stopped early
+    assert len(steps) == len(expected) + (len(expected) < 24)
+    assert steps[-1] == tokenizer.decode(expected)
+
+
+@pytest.mark.parametrize('max_new_tokens', range(1, 13))
+def test_speculative_matches_greedy(tiny_model, max_new_tokens):
+    model, tokenizer = tiny_model
+    generation_kwargs = greedy_config(max_new_tokens)
+    for prompt in PROMPTS:
+        expected = list(
+            generate_interactive(model, tokenizer, prompt,
+                                 **generation_kwargs))
+        prefix_cache = PrefixCache(max_bytes=2**30)
+        stats = SpeculationStats()
+        steps = list(
+            generate_interactive(model,
+                                 tokenizer,
+                                 prompt,
+                                 prefix_cache=prefix_cache,
+                                 cache_key='session',
+                                 num_speculative_tokens=4,
+                                 speculation_stats=stats,
+                                 **generation_kwargs))
+        assert steps == expected
+        assert stats.generated_tokens == len(expected)
+        # every pass yields one sampled token plus its accepted drafts, none
+        # past max_length
+        assert stats.forward_passes + stats.accepted_tokens == len(expected)
+        prompt_length = len(tokenizer(prompt)['input_ids'])
+        cached_ids, cache, _ = prefix_cache._entries['session']
+        assert len(cached_ids) == cache.get_seq_length()
+        assert len(cached_ids) < prompt_length + max_new_tokens
+
+
+def test_speculative_stops_at_accepted_eos(tiny_model, monkeypatch):
+    model, tokenizer = tiny_model
+    prompt = PROMPTS[1]
+    prompt_length = len(tokenizer(prompt)['input_ids'])
+    generation_kwargs = greedy_config(12)
+    reply_ids = full_prefill_generate(model, tokenizer, prompt,
+                                      **generation_kwargs)
+    # the first new token from the middle of the reply ends it, so the
+    # speculative run accepts it with the drafts after it
+    eos_idx = next(idx for idx in range(2, len(reply_ids))
+                   if reply_ids[idx] not in reply_ids[:idx])
+
+    def draft_the_reply(input_ids, num_draft_tokens, max_ngram_size):
+        num_generated = len(input_ids) - prompt_length
+        return torch.tensor(reply_ids[num_generated:num_generated +
+                                      num_draft_tokens])
+
+    monkeypatch.setattr('generation.prompt_lookup_draft', draft_the_reply)
+    runs = []
+    for num_speculative_tokens in (0, 4):
+        metrics = RequestMetrics()
+        prefix_cache = PrefixCache(max_bytes=2**30)
+        stats = SpeculationStats()
+        steps = list(
+            generate_interactive(
+                model,
+                tokenizer,
+                prompt,
+                metrics=metrics,
+                additional_eos_token_id=reply_ids[eos_idx],
+                prefix_cache=prefix_cache,
+                cache_key='session',
+                num_speculative_tokens=num_speculative_tokens,
+                speculation_stats=stats,
+                **generation_kwargs))
+        cached_ids, cache, _ = prefix_cache._entries['session']
+        assert len(cached_ids) == cache.get_seq_length()
+        runs.append((steps, metrics.output_tokens, metrics.stop_reason,
+                     cached_ids))
+    assert stats.accepted_tokens > eos_idx
+    assert runs[1] == runs[0]
+    assert runs[0][1] == eos_idx + 1
+
+
+def sampling_config(max_new_tokens):
+    """The web demo's sampled config, as used by compare mode."""
+    generation_kwargs = asdict(GenerationConfig())
+    del generation_kwargs['max_length']
+    generation_kwargs['max_new_tokens'] = max_new_tokens
+    return generation_kwargs
+
+
+class RecordInputIds(LogitsProcessor):
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, input_ids, scores):
+        self.calls.append(input_ids[0].tolist())
+        return scores
+
+
+def test_batch_rows_see_their_own_ids(tiny_model):
+    model, tokenizer = tiny_model
+    rows = [tokenizer(prompt)['input_ids'] for prompt in PROMPTS]
+    recorder = RecordInputIds()
+    torch.manual_seed(0)
+    *_, replies = generate_batch_interactive(
+        model,
+        tokenizer,
+        rows,
+        logits_processor=LogitsProcessorList([recorder]),
+        **sampling_config(8))
+    # every call sees one row's prompt and its own tokens, never padding
+    for row in rows:
+        calls = [ids for ids in recorder.calls if ids[:len(row)] == row]
+        assert [len(ids) - len(row) for ids in calls] == list(range(8))
+    assert len(recorder.calls) == 8 * len(rows)
+
+
+@pytest.mark.parametrize('limit', [{
+    'max_new_tokens': 10
+}, {
+    'max_length': 60
+}])
+def test_batch_matches_sequential(tiny_model, limit):
+    model, tokenizer = tiny_model
+    rows = [tokenizer(prompt)['input_ids'] for prompt in PROMPTS]
+    # a strong penalty would also hit the eos padding of the shorter rows
+    generation_kwargs = asdict(
+        GenerationConfig(temperature=0.0, repetition_penalty=1.5))
+    del generation_kwargs['max_length']
+    generation_kwargs.update(min_new_tokens=4, **limit)
+    *_, replies = generate_batch_interactive(model, tokenizer, rows,
+                                             **generation_kwargs)
+    for row, reply in zip(rows, replies):
+        *_, expected = generate_interactive(model, tokenizer, row,
+                                            **generation_kwargs)
+        assert reply == expected
+
+
+@torch.inference_mode()
+def prefill(model, token_ids):
+    cache = DynamicCache()
+    model(input_ids=torch.tensor([token_ids]),
+          past_key_values=cache,
+          use_cache=True,
+          logits_to_keep=1)
+    return cache
+
+
+def test_prefix_and_system_caches_keep_output(tiny_model):
+    model, tokenizer = tiny_model
+    generation_kwargs = greedy_config(16)
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    prefix_cache = PrefixCache(max_bytes=2**30)
+    prompt = system_prompt(False)
+    for query in (SAMPLE_QUERY, '一加一等于几？', SAMPLE_QUERY):
+        prompt += cur_query_prompt.format(user=query)
+        *_, expected = generate_interactive(model, tokenizer, prompt,
+                                            **generation_kwargs)
+        reused_tokens = prefix_cache.reused_tokens
+        *_, reply = generate_interactive(model,
+                                         tokenizer,
+                                         prompt,
+                                         prefix_cache=prefix_cache,
+                                         cache_key='session',
+                                         system_cache=system_cache,
+                                         **generation_kwargs)
+        assert reply == expected
+        prompt += reply
+    # the later turns start from the transcript of the earlier ones
+    assert prefix_cache.hits == 2
+    assert prefix_cache.reused_tokens > reused_tokens > 0
+    # the shared system prompt caches were only read
+    for cached_ids, cache in system_cache._entries:
+        assert cache.get_seq_length() == len(cached_ids)
+
+
+def test_prefix_cache_evicts_least_recently_used(tiny_model):
+    model, _ = tiny_model
+    token_ids = list(range(100, 132))
+    nbytes = cache_nbytes(prefill(model, token_ids))
+    prefix_cache = PrefixCache(max_bytes=2 * nbytes)
+    for key in 'ab':
+        prefix_cache.release(key, token_ids, prefill(model, token_ids))
+    # using a puts it back as the most recent entry
+    prefix_cache.acquire('a', token_ids)
+    prefix_cache.release('a', token_ids, prefill(model, token_ids))
+    prefix_cache.release('c', token_ids, prefill(model, token_ids))
+    assert list(prefix_cache._entries) == ['a', 'c']
+    assert prefix_cache.total_bytes == 2 * nbytes
+    # an entry over the whole budget is not kept
+    prefix_cache.release('a', token_ids * 3, prefill(model, token_ids * 3))
+    assert list(prefix_cache._entries) == ['c']
+    assert prefix_cache.total_bytes == nbytes
+
+
+def test_prefix_cache_invalidate(tiny_model):
+    model, _ = tiny_model
+    token_ids = list(range(100, 132))
+    prefix_cache = PrefixCache(max_bytes=2**30)
+    # web_demo keys by (session, deepthink) and drops both on Clear or a
+    # mode change
+    for deepthink in (False, True):
+        prefix_cache.release(('session', deepthink), token_ids,
+                             prefill(model, token_ids))
+    prefix_cache.release(('other', False), token_ids,
+                         prefill(model, token_ids))
+    prefix_cache.invalidate(('session', False), ('session', True))
+    assert list(prefix_cache._entries) == [('other', False)]
+    assert prefix_cache.total_bytes == cache_nbytes(
+        prefix_cache._entries[('other', False)][1])
+    assert prefix_cache.acquire(('session', False), token_ids) == (None, 0)
+
+
+def test_prefix_cache_leaves_a_token_to_prefill(tiny_model):
+    model, _ = tiny_model
+    token_ids = list(range(100, 132))
+    prefix_cache = PrefixCache(max_bytes=2**30)
+    prefix_cache.release('session', token_ids, prefill(model, token_ids))
+    # the same prompt again still feeds its last token for the logits
+    cache, num_reused = prefix_cache.acquire('session', token_ids)
+    assert num_reused == cache.get_seq_length() == len(token_ids) - 1
+    prefix_cache.release('session', token_ids, prefill(model, token_ids))
+    # an edited message reuses up to the first change only
+    edited = token_ids[:10] + [99] + token_ids[11:]
+    cache, num_reused = prefix_cache.acquire('session', edited)
+    assert num_reused == cache.get_seq_length() == 10
+    prefix_cache.release('session', token_ids, prefill(model, token_ids))
+    assert prefix_cache.acquire('session', [99] + token_ids) == (None, 0)
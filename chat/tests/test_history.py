@@ -0,0 +1,52 @@
+import copy
+
+import pytest
+
+from history import HistoryWindow, MessageTokenizer, summarize_topics
+from prompts import render_messages, system_instruction
+from retrieval import load_dataset
+from tiny_model import DATASET_PATH
+
+BUDGET = 512
+
+
+def conversation(num_turns):
+    """Messages of a session after every turn, ending in its query."""
+    samples = load_dataset(DATASET_PATH)
+    messages = [{'role': 'system', 'content': system_instruction()}]
+    for turn in range(num_turns):
+        doc_input, doc_output = samples[turn * 7 % len(samples)]
+        messages.append({'role': 'user', 'content': doc_input})
+        yield list(messages)
+        messages.append({'role': 'assistant', 'content': doc_output})
+
+
+@pytest.mark.parametrize('summarize', [None, summarize_topics],
+                         ids=['truncate', 'summarize'])
+def test_prompt_within_budget(tiny_model, summarize):
+    _, tokenizer = tiny_model
+    window = HistoryWindow(MessageTokenizer(tokenizer),
+                           BUDGET,
+                           summarize=summarize)
+    dropped = 0
+    for messages in conversation(60):
+        prompt = render_messages(window.fit(messages))
+        num_tokens = len(tokenizer(prompt).input_ids)
+        assert num_tokens <= BUDGET
+        assert num_tokens == window.last_stats['prompt_tokens']
+        dropped = window.last_stats['dropped_messages']
+    # the session did outgrow the budget
+    assert dropped > 0
+
+
+def test_copy_leaves_the_session_window(tiny_model):
+    _, tokenizer = tiny_model
+    window = HistoryWindow(MessageTokenizer(tokenizer),
+                           BUDGET,
+                           summarize=summarize_topics)
+    sessions = list(conversation(60))
+    window.fit(sessions[-1])
+    start, summary = window.start, window._summary
+    # an older reply regenerated from a shorter prefix
+    copy.copy(window).fit(sessions[len(sessions) // 2])
+    assert (window.start, window._summary) == (start, summary)
@@ -0,0 +1,119 @@
+import logging
+import os
+import statistics
+import time
+
+import psutil
+import pytest
+import torch
+
+from generation import generate_interactive
+from metrics import REQUEST_LOG, RequestMetrics, log_requests, peak_memory
+from prompts import cur_query_prompt
+from tiny_model import SAMPLE_QUERY, greedy_config
+
+MAX_OVERHEAD = 0.02
+OVERHEAD_PAIRS = 40
+OVERHEAD_ATTEMPTS = 3
+
+
+@pytest.fixture
+def request_log():
+    log_requests(os.devnull)
+    yield
+    handler = REQUEST_LOG.handlers.pop()
+    handler.close()
+    REQUEST_LOG.setLevel(logging.NOTSET)
+
+
+def trimmed_mean(timings):
+    """Mean without the fastest and slowest tenth, which are mostly noise."""
+    cut = len(timings) // 10
+    return statistics.mean(sorted(timings)[cut:len(timings) - cut])
+
+
+def test_instrumentation_overhead(tiny_model, request_log):
+    model, tokenizer = tiny_model
+    prompt = tokenizer(cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+    generation_kwargs = greedy_config(8)
+
+    def run(metrics):
+        start = time.perf_counter()
+        for _ in generate_interactive(model,
+                                      tokenizer,
+                                      prompt,
+                                      metrics=metrics,
+                                      **generation_kwargs):
+            pass
+        return time.perf_counter() - start
+
+    for _ in range(3):
+        run(None)
+    # many short interleaved runs, so drift in the machine's speed hits both
+    # loops alike; which one goes first alternates. Noise on a shared CPU
+    # only ever adds time, so a measurement within the bound is enough
+    for _ in range(OVERHEAD_ATTEMPTS):
+        bare, instrumented = [], []
+        for i in range(OVERHEAD_PAIRS):
+            for instrument in (i % 2 == 1, i % 2 == 0):
+                if instrument:
+                    instrumented.append(run(RequestMetrics()))
+                else:
+                    bare.append(run(None))
+        overhead = trimmed_mean(instrumented) / trimmed_mean(bare) - 1
+        if overhead <= MAX_OVERHEAD:
+            break
+    assert overhead <= MAX_OVERHEAD
+
+
+def test_metrics_filled_in(tiny_model):
+    model, tokenizer = tiny_model
+    metrics = RequestMetrics()
+    steps = list(
+        generate_interactive(model,
+                             tokenizer,
+                             cur_query_prompt.format(user=SAMPLE_QUERY),
+                             metrics=metrics,
+                             **greedy_config(8)))
+    assert metrics.stop_reason == 'length'
+    assert metrics.output_tokens == len(steps) == 8
+    assert 0 < metrics.prefill_s <= metrics.ttft_s
+    assert metrics.decode_tokens_per_s > 0
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'),
+                    reason='peak RSS is only resettable on Linux')
+def test_cpu_peak_memory_is_the_peak():
+    nbytes = 256 * 2**20
+    process = psutil.Process()
+    # a peak from before the request does not count
+    torch.ones(nbytes // 4)
+    metrics = RequestMetrics()
+    metrics.begin_prefill(1, 0, 'cpu')
+    assert peak_memory('cpu') < process.memory_info().rss + nbytes // 2
+    # one during the request does, even though it is freed before the end
+    torch.ones(nbytes // 4)
+    metrics.finish('stop', 1, 'cpu')
+    assert (metrics.peak_memory_bytes >=
+            process.memory_info().rss + nbytes * 0.9)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'),
+                    reason='peak RSS is only resettable on Linux')
+def test_concurrent_request_keeps_the_peak():
+    nbytes = 256 * 2**20
+    process = psutil.Process()
+    first = RequestMetrics()
+    first.begin_prefill(1, 0, 'cpu')
+    torch.ones(nbytes // 4)
+    # a request starting later must not reset the peak of the first
+    second = RequestMetrics()
+    second.begin_prefill(1, 0, 'cpu')
+    first.finish('stop', 1, 'cpu')
+    second.finish('stop', 1, 'cpu')
+    assert first.peak_memory_bytes >= process.memory_info().rss + nbytes * 0.9
+    # with none running the next request resets it again
+    third = RequestMetrics()
+    third.begin_prefill(1, 0, 'cpu')
+    third.finish('stop', 1, 'cpu')
+    assert third.peak_memory_bytes < process.memory_info().rss + nbytes // 2
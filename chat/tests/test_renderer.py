@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from renderer import CURSOR, StreamRenderer, convert_math
+
+PREFIX = ':blue[[Normal Response]]\n\n'
+
+
+class Placeholder:
+
+    def __init__(self):
+        self.drawn = []
+
+    def markdown(self, body):
+        self.drawn.append(body)
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_convert_math():
+    assert convert_math(r'\(x^2\) 和 \[y\]') == '$x^2$ 和 $$y$$'
+    assert convert_math('\\\\(') == '\\$'
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_incremental_matches_full_conversion(seed):
+    rng = random.Random(seed)
+    text = ''.join(rng.choice(['\\', '(', ')', '[', ']', '$', 'x', '催'])
+                   for _ in range(200))
+    # cut after every kind of character, trailing backslashes included
+    cuts = sorted(rng.sample(range(1, len(text)), 60)) + [len(text)]
+    placeholder = Placeholder()
+    renderer = StreamRenderer(placeholder, prefix=PREFIX, frame_interval_s=0)
+    for cut in cuts:
+        renderer.update(text[:cut])
+        # everything but a held back backslash is drawn, converted
+        shown = text[:cut].removesuffix('\\')
+        assert placeholder.drawn[-1] == PREFIX + convert_math(shown) + CURSOR
+    assert renderer.finish() == text
+    assert placeholder.drawn[-1] == PREFIX + convert_math(text)
+
+
+def test_held_backslash_joins_the_next_token():
+    placeholder = Placeholder()
+    renderer = StreamRenderer(placeholder, frame_interval_s=0)
+    renderer.update('面积是 \\')
+    assert placeholder.drawn[-1] == '面积是 ' + CURSOR
+    renderer.update('面积是 \\(r^2\\')
+    assert placeholder.drawn[-1] == '面积是 $r^2' + CURSOR
+    renderer.update('面积是 \\(r^2\\)')
+    assert renderer.finish() == '面积是 \\(r^2\\)'
+    assert placeholder.drawn[-1] == '面积是 $r^2$'
+
+
+def test_replaced_text_starts_over():
+    placeholder = Placeholder()
+    renderer = StreamRenderer(placeholder, prefix=PREFIX, frame_interval_s=0)
+    renderer.update('先立业\\')
+    renderer.update('\\[后成家\\]')
+    assert renderer.finish() == '\\[后成家\\]'
+    assert placeholder.drawn[-1] == PREFIX + '$$后成家$$'
+
+
+def test_redraws_are_rate_limited():
+    placeholder = Placeholder()
+    clock = Clock()
+    renderer = StreamRenderer(placeholder,
+                              frame_interval_s=0.05,
+                              clock=clock)
+    text = ''
+    for _ in range(100):
+        # 50 tokens per second, so at most one frame per 2.5 tokens
+        clock.now += 0.02
+        text += '催'
+        renderer.update(text)
+    assert renderer.frames == len(placeholder.drawn) == 34
+    # the text between frames is drawn with the next one
+    assert placeholder.drawn[-1] == '催' * 100 + CURSOR
+    renderer.finish()
+    assert placeholder.drawn[-1] == '催' * 100
+    assert renderer.frames == 35
+
+
+def test_pending_tokens_force_a_frame():
+    placeholder = Placeholder()
+    clock = Clock()
+    renderer = StreamRenderer(placeholder,
+                              frame_interval_s=1.0,
+                              tokens_per_frame=4,
+                              clock=clock)
+    for num_tokens in range(1, 10):
+        renderer.update('x' * num_tokens)
+    # the first token draws at once, then every fourth one
+    assert placeholder.drawn == ['x' + CURSOR, 'x' * 5 + CURSOR,
+                                 'x' * 9 + CURSOR]
@@ -0,0 +1,145 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from response_cache import (ACCESS_RESOLUTION_S, ResponseCache,
+                            cached_stream)
+
+COUNTERS = ('chat_response_cache_hits_total',
+            'chat_response_cache_misses_total',
+            'chat_response_cache_saved_seconds_total')
+
+
+def counters():
+    return [REGISTRY.get_sample_value(name) for name in COUNTERS]
+
+
+def test_lookups_are_exported(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite3'))
+    before = counters()
+    assert cache.lookup('key') is None
+    cache.store('key', '先立业再成家', 1.5)
+    for _ in range(3):
+        assert cache.lookup('key') == '先立业再成家'
+    replies = cached_stream(cache, 'key', lambda: iter(['不该生成']))
+    assert list(replies) == ['先立业再成家']
+    hits, misses, saved = (after - start
+                           for after, start in zip(counters(), before))
+    stats = cache.stats()
+    assert (hits, misses) == (stats['hits'], stats['misses']) == (4, 1)
+    assert saved == pytest.approx(stats['saved_latency_s']) == 6.0
+
+
+class Clock:
+    """Stands in for ``time`` in response_cache.py, ``now`` is unix time."""
+
+    def __init__(self):
+        self.now = 1e9
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('response_cache.time', clock)
+    return clock
+
+
+def test_store_after_expiry_adds_a_variant(tmp_path, clock):
+    path = str(tmp_path / 'responses.sqlite3')
+    cache = ResponseCache(path, ttl_s=100, num_variants=2)
+    cache.store('key', '第一句', 1.0, num_variants=2)
+    clock.now += 50
+    cache.store('key', '第二句', 1.0, num_variants=2)
+    # the first variant expires, the second is still live
+    clock.now += 60
+    cache = ResponseCache(path, ttl_s=100, num_variants=2)
+    assert cache.lookup('key', 2) is None
+    cache.store('key', '第三句', 1.0, num_variants=2)
+    for cache in cache, ResponseCache(path, ttl_s=100, num_variants=2):
+        assert {cache.lookup('key', 2), cache.lookup('key', 2)} == {
+            '第二句', '第三句'
+        }
+
+
+def test_store_after_purge_adds_a_variant(tmp_path, clock):
+    path = str(tmp_path / 'responses.sqlite3')
+    nbytes = len('回复0'.encode())
+    cache = ResponseCache(path, max_disk_bytes=2 * nbytes, num_variants=2)
+    cache.store('key', '回复0', 1.0, num_variants=2)
+    clock.now += 1
+    cache.store('key', '回复1', 1.0, num_variants=2)
+    clock.now += 1
+    # over budget, the least recently stored variant 0 goes
+    cache.store('other', '回复2', 1.0)
+    cache = ResponseCache(path, max_disk_bytes=3 * nbytes, num_variants=2)
+    assert cache.lookup('key', 2) is None
+    clock.now += 1
+    cache.store('key', '回复3', 1.0, num_variants=2)
+    cache = ResponseCache(path, num_variants=2)
+    assert {cache.lookup('key', 2), cache.lookup('key', 2)} == {'回复1', '回复3'}
+    assert cache.lookup('other') == '回复2'
+
+
+def test_disk_purge_keeps_recently_used(tmp_path, clock):
+    path = str(tmp_path / 'responses.sqlite3')
+    nbytes = len('回复a'.encode())
+    cache = ResponseCache(path, max_disk_bytes=2 * nbytes)
+    for key in 'ab':
+        cache.store(key, '回复' + key, 1.0)
+        clock.now += ACCESS_RESOLUTION_S
+    assert cache.lookup('a') == '回复a'
+    clock.now += 1
+    cache.store('c', '回复c', 1.0)
+    cache = ResponseCache(path)
+    assert [cache.lookup(key) for key in 'abc'] == ['回复a', None, '回复c']
+
+
+def test_hits_write_the_access_time_once_per_resolution(tmp_path, clock):
+    path = str(tmp_path / 'responses.sqlite3')
+    cache = ResponseCache(path)
+    cache.store('key', '回复', 1.0)
+
+    def accessed():
+        return cache._db.execute(
+            'SELECT accessed FROM responses').fetchone()[0]
+
+    stored = clock.now
+    clock.now += 1
+    cache.lookup('key')
+    assert accessed() == stored
+    clock.now += ACCESS_RESOLUTION_S
+    cache.lookup('key')
+    assert accessed() == clock.now
+
+
+def test_ttl_and_memory_lru(tmp_path, clock):
+    path = str(tmp_path / 'responses.sqlite3')
+    cache = ResponseCache(path, max_memory_entries=2, ttl_s=100)
+    for key in 'abc':
+        cache.store(key, '回复' + key, 1.0)
+    assert len(cache) == 2
+    # evicted from memory, read through from disk
+    assert cache.lookup('a') == '回复a'
+    clock.now += 100
+    assert [cache.lookup(key) for key in 'abc'] == [None] * 3
+    ResponseCache(path, ttl_s=100)
+    assert len(cache._db.execute('SELECT * FROM responses').fetchall()) == 0
+
+
+def test_greedy_is_cached_once_and_sampled_rotates(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite3'), num_variants=3)
+    greedy = cache.num_variants_for({'do_sample': False})
+    sampled = cache.num_variants_for({'do_sample': True, 'temperature': 0.8})
+    assert (greedy, sampled) == (1, 3)
+    for i in range(3):
+        assert cache.lookup('sampled', sampled) is None
+        cache.store('sampled', f'回复{i}', 1.0, sampled)
+    # a fourth store is ignored once all variants exist
+    cache.store('sampled', '回复3', 1.0, sampled)
+    assert [cache.lookup('sampled', sampled)
+            for _ in range(6)] == ['回复0', '回复1', '回复2'] * 2
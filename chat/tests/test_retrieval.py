@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from retrieval import ARRAYS, RetrievalIndex, term_hash
+
+CORPUS = [
+    ('催婚回应给父亲，场景 家庭聚会催婚，风格 幽默', '爸，我正在给您物色一位会下象棋的儿媳妇'),
+    ('催婚回应给父亲，场景 春节团圆饭被催婚，风格 认真', '爸，我明白您的心意，今年一定认真考虑'),
+    ('催婚回应给母亲，场景 家庭聚会催婚，风格 幽默', '妈，您的厨艺太好，我怕找不到能比得上的'),
+    ('催婚回应给堂姐，场景 婚礼上被催婚，风格 温和', '姐，等我遇到像姐夫这样好的人就结婚'),
+    ('催婚回应给姐，场景 微信聊天催婚，风格 幽默', '姐，我在等一个比你还会砍价的人'),
+    ('催婚回应给舅妈，场景 春节拜年被催婚，风格 认真', '舅妈，谢谢关心，工作稳定下来我就考虑'),
+]
+QUERIES = [
+    '父亲在家庭聚会催婚, 幽默回应',
+    '妈妈做饭的时候问我什么时候结婚',
+    '堂姐在婚礼上催我',
+    '春节认真回应',
+]
+
+
+@pytest.fixture(scope='module')
+def index():
+    return RetrievalIndex.build(CORPUS)
+
+
+def test_memmap_reload_matches_the_built_index(index, tmp_path):
+    index.save(tmp_path)
+    loaded = RetrievalIndex.load(tmp_path)
+    assert len(loaded) == len(index) == len(CORPUS)
+    assert loaded.nbytes == index.nbytes
+    for name in ARRAYS:
+        # views of the mapped files, not copies
+        assert isinstance(loaded.arrays[name].base, np.memmap), name
+        assert np.array_equal(loaded.arrays[name], index.arrays[name]), name
+    for query in QUERIES:
+        assert loaded.search(query) == index.search(query)
+
+
+def test_template_terms_are_dropped(index):
+    # in every input, so they carry no weight
+    assert term_hash('催婚') not in index.arrays['term_hashes']
+    assert term_hash('风格') not in index.arrays['term_hashes']
+    assert term_hash('象棋') in index.arrays['term_hashes']
+
+
+def test_search_ranks_matching_fields_first(index):
+    hits = index.search('父亲在家庭聚会催婚, 幽默回应', k=3)
+    # all three fields, then scene and style outweigh the relative alone
+    assert [hit.doc_id for hit in hits] == [0, 2, 1]
+    assert hits[0].fields == {
+        'relative': '父亲',
+        'scene': '家庭聚会催婚',
+        'style': '幽默'
+    }
+    assert (hits[0].input, hits[0].reply) == CORPUS[0]
+    assert [hit.score for hit in hits] == sorted(
+        (hit.score for hit in hits), reverse=True)
+    # the reply's own words rank it without any field
+    assert index.search('会下象棋的儿媳妇', k=1)[0].doc_id == 0
+    assert index.search('完全无关的 query') == []
+
+
+def test_query_fields_prefer_the_longest_value(index):
+    assert index.query_fields('堂姐在婚礼上催我')['relative'] == '堂姐'
+    assert index.query_fields('姐又在微信上问')['relative'] == '姐'
+    assert index.query_fields('外婆问我') == {
+        'relative': None,
+        'scene': None,
+        'style': None
+    }
+
+
+def test_instant_reply_thresholds(index):
+    # every field the query names agrees with the best document
+    assert index.instant_reply('父亲在家庭聚会催婚, 幽默回应') == CORPUS[0][1]
+    assert index.instant_reply('堂姐在婚礼上被催婚') == CORPUS[3][1]
+    # no relative named
+    assert index.instant_reply('家庭聚会催婚, 幽默回应') is None
+    # a relative the dataset does not know
+    assert index.instant_reply('外婆在家庭聚会催婚') is None
+    # no curated reply to a father in this style
+    assert index.instant_reply('父亲在家庭聚会催婚, 温和回应') is None
@@ -0,0 +1,120 @@
+import pytest
+import torch
+
+from generation import generate_interactive
+from history import MessageTokenizer
+from kv_cache import SystemPromptCache
+from prompts import system_instruction, system_prompt
+from retrieval import load_dataset
+from server import ContinuousBatchingEngine
+from tiny_model import DATASET_PATH, greedy_config
+
+# (max_new_tokens, step at which the request joins), the long prompts
+# finish first so the batch drops their padding columns
+SCHEDULE = [(12, 0), (5, 2), (9, 2), (3, 4), (8, 5), (3, 5), (4, 9)]
+
+
+@pytest.fixture(scope='module')
+def prompts(tiny_model):
+    _, tokenizer = tiny_model
+    samples = load_dataset(DATASET_PATH)
+    message_tokenizer = MessageTokenizer(tokenizer)
+    # both system prompts, and prompts of different lengths so the joined
+    # caches need left padding
+    return [
+        message_tokenizer.encode_messages([{
+            'role': 'system',
+            'content': system_instruction(deepthink=i % 2 == 1)
+        }, {
+            'role': 'user',
+            'content': doc_input + doc_output * (i % 3)
+        }]) for i, (doc_input, doc_output) in enumerate(
+            samples[::len(samples) // len(SCHEDULE)][:len(SCHEDULE)])
+    ]
+
+
+@pytest.fixture(scope='module')
+def engine(tiny_model):
+    model, tokenizer = tiny_model
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    return ContinuousBatchingEngine(model,
+                                    tokenizer,
+                                    max_batch_size=len(SCHEDULE),
+                                    system_cache=system_cache)
+
+
+def run_schedule(engine, prompts, abort=None):
+    """Step the engine by hand, joining each request at its step. Returns
+    the text and finish reason of every request."""
+    seqs = {}
+    texts, finish_reasons = {}, {}
+    step = 0
+    while len(finish_reasons) < len(SCHEDULE):
+        admitted = []
+        for idx, (max_new_tokens, join_step) in enumerate(SCHEDULE):
+            if join_step == step:
+                seqs[idx] = engine.submit(prompts[idx],
+                                          **greedy_config(max_new_tokens))
+                admitted.append(seqs[idx])
+        engine.waiting.clear()
+        if abort is not None and step == abort[1]:
+            seqs[abort[0]].aborted = True
+            finish_reasons[abort[0]] = 'abort'
+        for seq, delta, finish_reason in engine.step(admitted):
+            idx = next(i for i, s in seqs.items() if s is seq)
+            texts[idx] = texts.get(idx, '') + delta
+            if finish_reason is not None:
+                finish_reasons[idx] = finish_reason
+        step += 1
+    assert not engine.running and engine.past_key_values is None
+    return texts, finish_reasons, seqs
+
+
+def expected_reply(tiny_model, prompt_ids, max_new_tokens):
+    model, tokenizer = tiny_model
+    return list(
+        generate_interactive(model, tokenizer, prompt_ids,
+                             **greedy_config(max_new_tokens)))[-1]
+
+
+def test_joins_and_finishes_match_sequential(tiny_model, engine, prompts):
+    texts, finish_reasons, _ = run_schedule(engine, prompts)
+    for idx, (max_new_tokens, _) in enumerate(SCHEDULE):
+        assert texts[idx] == expected_reply(tiny_model, prompts[idx],
+                                            max_new_tokens), idx
+        assert finish_reasons[idx] in ('stop', 'length')
+
+
+def test_aborted_row_is_dropped(tiny_model, engine, prompts):
+    # the longest request leaves mid-batch, the others must not notice
+    texts, finish_reasons, _ = run_schedule(engine, prompts, abort=(0, 6))
+    assert finish_reasons[0] == 'abort'
+    for idx, (max_new_tokens, _) in enumerate(SCHEDULE[1:], 1):
+        assert texts[idx] == expected_reply(tiny_model, prompts[idx],
+                                            max_new_tokens), idx
+
+
+def test_logits_match_full_prefill(tiny_model, engine, prompts, monkeypatch):
+    """Greedy text hides small errors in the merged cache, compare the
+    logits of every step with one forward pass over the same tokens."""
+    model, _ = tiny_model
+    logits = {}
+    sample = engine._sample
+
+    def record(seq, step_logits):
+        logits.setdefault(seq, []).append(step_logits)
+        return sample(seq, step_logits)
+
+    monkeypatch.setattr(engine, '_sample', record)
+    _, _, seqs = run_schedule(engine, prompts)
+    with torch.inference_mode():
+        for idx, seq in seqs.items():
+            expected = model(input_ids=seq.input_ids[:, :-1]).logits[
+                0, len(prompts[idx]) - 1:]
+            torch.testing.assert_close(torch.cat(logits[seq]),
+                                       expected,
+                                       atol=1e-4,
+                                       rtol=1e-4)
@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from generation import generate_interactive
+from prompts import cur_query_prompt
+from tiny_model import (LOAD_PEAK_BOUND, SAMPLE_QUERY, greedy_config,
+                        measure_load, save_sharded_checkpoint)
+from transformers import AutoModelForCausalLM
+from weights import (SAFE_INDEX, SAFE_WEIGHTS, convert, has_safetensors,
+                     load_mmap_model, load_streaming, shard_files)
+
+
+def test_streaming_load_matches_from_pretrained(tmp_path):
+    assert save_sharded_checkpoint(tmp_path) > 1
+    expected = AutoModelForCausalLM.from_pretrained(
+        tmp_path, torch_dtype=torch.bfloat16).state_dict()
+    state_dict = load_streaming(tmp_path, torch.bfloat16).state_dict()
+    assert state_dict.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert state_dict[name].dtype == tensor.dtype
+        assert torch.equal(state_dict[name], tensor), name
+
+
+def test_streaming_load_peak_memory(tmp_path):
+    save_sharded_checkpoint(tmp_path)
+    result = measure_load('streaming', str(tmp_path))
+    assert result['peak_ratio'] <= LOAD_PEAK_BOUND
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+def test_converted_checkpoint_round_trips(tmp_path, tiny_model, dtype):
+    model, tokenizer = tiny_model
+    model.save_pretrained(tmp_path / 'bin', safe_serialization=False)
+    convert(tmp_path / 'bin', tmp_path / 'safetensors', dtype)
+    assert has_safetensors(tmp_path / 'safetensors')
+    expected = AutoModelForCausalLM.from_pretrained(
+        tmp_path / 'bin', torch_dtype=dtype).eval()
+
+    converted = load_mmap_model(tmp_path / 'safetensors')
+    state_dict = converted.state_dict()
+    assert state_dict.keys() == expected.state_dict().keys()
+    for name, tensor in expected.state_dict().items():
+        assert state_dict[name].dtype == tensor.dtype
+        assert torch.equal(state_dict[name], tensor), name
+
+    prompt = tokenizer(cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+    generation_kwargs = greedy_config(16)
+    assert (list(
+        generate_interactive(converted, tokenizer, prompt,
+                             **generation_kwargs)) == list(
+                                 generate_interactive(expected, tokenizer,
+                                                      prompt,
+                                                      **generation_kwargs)))
+
+
+def test_converted_shards_are_indexed(tmp_path):
+    save_sharded_checkpoint(tmp_path / 'bin')
+    convert(tmp_path / 'bin', tmp_path / 'safetensors', torch.float32)
+    shards = shard_files(tmp_path / 'safetensors', SAFE_INDEX, SAFE_WEIGHTS)
+    assert len(shards) > 1
+    expected = load_streaming(tmp_path / 'bin', torch.float32).state_dict()
+    state_dict = load_mmap_model(tmp_path / 'safetensors').state_dict()
+    assert state_dict.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert torch.equal(state_dict[name], tensor), name
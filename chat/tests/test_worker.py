@@ -0,0 +1,75 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from generation import generate_interactive
+from kv_cache import PrefixCache
+from prompts import cur_query_prompt, system_prompt
+from response_cache import ResponseCache, cached_stream
+from tiny_model import SAMPLE_QUERY, greedy_config
+from worker import GenerationWorker, ReplyCancelled, batches_of_one
+
+READ_STEPS = 8
+
+
+def wasted_steps():
+    return REGISTRY.get_sample_value('chat_wasted_decode_steps_total')
+
+
+@pytest.fixture
+def prompt(tiny_model):
+    _, tokenizer = tiny_model
+    return tokenizer(system_prompt() +
+                     cur_query_prompt.format(user=SAMPLE_QUERY))['input_ids']
+
+
+def test_superseded_reply_stops_and_puts_its_cache_back(
+        tiny_model, prompt, tmp_path):
+    model, tokenizer = tiny_model
+    prefix_cache = PrefixCache(max_bytes=2**30)
+    response_cache = ResponseCache(str(tmp_path / 'responses.sqlite3'))
+    worker = GenerationWorker(max_workers=1)
+    # wrapped like a reply of web_demo.py, closing the job must reach
+    # generate_interactive through both wrappers
+    inner = generate_interactive(model,
+                                 tokenizer,
+                                 prompt,
+                                 prefix_cache=prefix_cache,
+                                 cache_key='session',
+                                 **greedy_config(512))
+    job = worker.submit(
+        'session',
+        batches_of_one(
+            cached_stream(response_cache, 'key', lambda: inner)))
+    for steps, _ in enumerate(job, 1):
+        if steps == READ_STEPS:
+            break
+    before = wasted_steps()
+    steps_at_cancel = job.steps
+    # a new reply of the same session cancels this one and waits for it
+    worker.submit('session', iter([['next reply']]))
+    assert job.done and job.stopped
+    assert job.steps - steps_at_cancel <= 1
+    assert wasted_steps() - before == job.steps - steps_at_cancel
+    # the test still holds the generator, it was closed all the same
+    assert inner.gi_frame is None
+    cached_ids, cache, _ = prefix_cache._entries['session']
+    assert len(cached_ids) == cache.get_seq_length() >= len(prompt)
+    # a cancelled reply is never cached as a finished one
+    assert response_cache.lookup('key') is None
+    with pytest.raises(ReplyCancelled):
+        list(job)
+
+
+def test_finished_reply_is_not_wasted(tiny_model, prompt):
+    model, tokenizer = tiny_model
+    worker = GenerationWorker(max_workers=1)
+    before = wasted_steps()
+    job = worker.submit(
+        'session',
+        batches_of_one(
+            generate_interactive(model, tokenizer, prompt,
+                                 **greedy_config(8))))
+    assert len(list(job)) == 8
+    job.cancel()
+    assert not job.stopped
+    assert wasted_steps() == before
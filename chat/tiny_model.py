@@ -0,0 +1,119 @@
+"""The tiny randomly initialised Qwen2 shared by the tests, benchmark.py
+and the ``--tiny`` flag of server.py and batch_generate.py.
+
+The model keeps the architecture and tokenizer of ``finetune/merge`` but is
+scaled down so it runs in seconds without a GPU. The synthetic sharded
+checkpoint and ``measure_load`` exercise the weight loaders of weights.py.
+"""
+import multiprocessing
+import os
+import statistics
+import time
+from dataclasses import asdict
+
+import torch
+
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from backend import PeakMemory, model_nbytes
+from generation import GenerationConfig
+from weights import load_streaming
+
+MERGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'finetune', 'merge')
+DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                            'data', 'cuihun-chinese-v0.1.json')
+
+# shapes of finetune/merge/config.json scaled down to run on a laptop CPU
+TINY_CONFIG = dict(
+    hidden_size=128,
+    intermediate_size=344,
+    num_hidden_layers=4,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+)
+
+SAMPLE_QUERY = '父亲在家庭聚会催婚, 幽默回应'
+
+# a synthetic checkpoint whose weights dwarf the allocator noise
+SHARDED_CONFIG = dict(
+    hidden_size=512,
+    intermediate_size=1376,
+    num_hidden_layers=8,
+    num_attention_heads=8,
+    num_key_value_heads=8,
+    vocab_size=8192,
+)
+# peak RSS growth while loading, in multiples of the loaded model
+LOAD_PEAK_BOUND = 1.5
+
+
+def load_tiny_model(seed=0, **overrides):
+    config = AutoConfig.from_pretrained(MERGE_PATH)
+    for key, value in {**TINY_CONFIG, **overrides}.items():
+        setattr(config, key, value)
+    config.torch_dtype = torch.float32
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(config).eval()
+    tokenizer = AutoTokenizer.from_pretrained(MERGE_PATH)
+    return model, tokenizer
+
+
+def greedy_config(max_new_tokens):
+    generation_kwargs = asdict(GenerationConfig(temperature=0.0))
+    del generation_kwargs['max_length']
+    generation_kwargs['max_new_tokens'] = max_new_tokens
+    return generation_kwargs
+
+
+def peak_load_worker(loader, model_path, results):
+    config = AutoConfig.from_pretrained(model_path)
+    AutoModelForCausalLM._model_mapping[type(config)]
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+        if loader == 'streaming':
+            model = load_streaming(model_path, torch.bfloat16)
+        elif loader == 'from_pretrained_dtype':
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path, torch_dtype=torch.bfloat16)
+        else:
+            # what web_demo.py used to do
+            model = AutoModelForCausalLM.from_pretrained(model_path).to(
+                torch.bfloat16)
+    load_s = time.perf_counter() - start
+    results.put({
+        'load_s': load_s,
+        'peak_growth_bytes': memory.peak_rss_bytes - memory.start_rss_bytes,
+        'model_bytes': model_nbytes(model),
+    })
+
+
+def save_sharded_checkpoint(path, shard_size='16MB'):
+    """Save a synthetic fp32 checkpoint of ``SHARDED_CONFIG`` in several
+    shards, returns the number of shards."""
+    sharded_model, _ = load_tiny_model(**SHARDED_CONFIG)
+    sharded_model.save_pretrained(path,
+                                  max_shard_size=shard_size,
+                                  safe_serialization=False)
+    return len([f for f in os.listdir(path) if f.endswith('.bin')])
+
+
+def measure_load(loader, model_path, repeats=1):
+    """Load ``model_path`` as bf16 in a fresh process per repeat, reporting
+    the worst peak RSS growth in multiples of the loaded model."""
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeats):
+        queue = context.Queue()
+        worker = context.Process(target=peak_load_worker,
+                                 args=(loader, model_path, queue))
+        worker.start()
+        runs.append(queue.get())
+        worker.join()
+    return {
+        'load_s': statistics.median(r['load_s'] for r in runs),
+        'model_bytes': runs[0]['model_bytes'],
+        'peak_growth_bytes': max(r['peak_growth_bytes'] for r in runs),
+        'peak_ratio': max(r['peak_growth_bytes'] / r['model_bytes']
+                          for r in runs),
+    }
@@ -1,174 +1,198 @@
 # isort: skip_file
 import copy
-import re
-import warnings
-from dataclasses import asdict, dataclass
-from typing import Callable, List, Optional
+import os
+import time
+import uuid
+from dataclasses import asdict
 
+import prometheus_client
 import streamlit as st
 import torch
-from torch import nn
 
-from transformers.generation.utils import LogitsProcessorList
-from transformers.utils import logging
+from generation import (GenerationConfig, generate_batch_interactive,
+                        generate_interactive)
+from backend import BackendConfig, load_pretrained
+from client import stream_chat_completion, stream_chat_completions
+from history import HistoryWindow, MessageTokenizer, summarize_topics
+from kv_cache import PrefixCache, SystemPromptCache
+from metrics import RequestMetrics, log_requests
+from profiling import profiled_stream, should_profile
+from prompts import system_instruction, system_prompt
+from renderer import StreamRenderer, convert_math
+from response_cache import ResponseCache, cached_stream, response_cache_key
+from retrieval import RetrievalIndex, few_shot_messages, load_dataset
+from worker import GenerationWorker, ReplyCancelled, batches_of_one
 
-from transformers import AutoTokenizer, AutoModelForCausalLM  # isort: skip
-
-logger = logging.get_logger(__name__)
 st.set_page_config(layout='wide')
 
+# memory budget shared by the KV caches of all sessions
+PREFIX_CACHE_MAX_BYTES = 4 * 1024**3
+# e.g. http://localhost:8000/v1 to run as a thin client of server.py
+CHAT_SERVER_URL = os.environ.get('CHAT_SERVER_URL')
+# tokens drafted by prompt lookup per step, 0 disables speculative decoding
+SPECULATIVE_TOKENS = int(os.environ.get('CHAT_SPECULATIVE_TOKENS', 0))
+MODEL_PATH = '/home/suxin/chatbot/finetune/merge/'
+# finished replies, shared by all sessions and worker processes
+RESPONSE_CACHE_PATH = os.environ.get(
+    'CHAT_RESPONSE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'cuihun',
+                 'responses.sqlite3'))
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'data')
+# built by `python retrieval.py`, otherwise indexed from the dataset at start
+RETRIEVAL_INDEX_PATH = os.environ.get('CHAT_RETRIEVAL_INDEX',
+                                      os.path.join(DATA_DIR, 'index'))
+# prompt tokens the history window may fill, the oldest turns give way
+HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKENS', 8192))
+# streamed replies are redrawn at most this often, plus every N tokens if set
+RENDER_FPS = float(os.environ.get('CHAT_RENDER_FPS', 20))
+RENDER_TOKENS = int(os.environ.get('CHAT_RENDER_TOKENS', 0)) or None
+# Prometheus metrics of local generation are served on this port if set
+METRICS_PORT = int(os.environ.get('CHAT_METRICS_PORT', 0))
+# JSON line per reply to this file, '-' for stderr
+REQUEST_LOG_PATH = os.environ.get('CHAT_REQUEST_LOG')
+# torch.profiler traces of the replies picked by the sidebar toggle, or of
+# this share of all replies
+PROFILE_DIR = os.environ.get(
+    'CHAT_PROFILE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'cuihun', 'profiles'))
+PROFILE_RATE = float(os.environ.get('CHAT_PROFILE_RATE', 0))
+# threads generating replies for all sessions, more replies wait their turn
+GENERATION_WORKERS = int(os.environ.get('CHAT_GENERATION_WORKERS', 8))
 
-@dataclass
-class GenerationConfig:
-    # this config is used for chat to provide more diversity
-    max_length: int = 32768
-    top_p: float = 0.8
-    temperature: float = 0.8
-    do_sample: bool = True
-    repetition_penalty: float = 1.005
-
-
-@torch.inference_mode()
-def generate_interactive(
-    model,
-    tokenizer,
-    prompt,
-    generation_config: Optional[GenerationConfig] = None,
-    logits_processor: Optional[LogitsProcessorList] = None,
-    prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor],
-                                                List[int]]] = None,
-    additional_eos_token_id: Optional[int] = None,
-    **kwargs,
-):
-    inputs = tokenizer([prompt], padding=True, return_tensors='pt')
-    input_length = len(inputs['input_ids'][0])
-    for k, v in inputs.items():
-        inputs[k] = v.cuda()
-    input_ids = inputs['input_ids']
-    _, input_ids_seq_length = input_ids.shape[0], input_ids.shape[-1]
-    if generation_config is None:
-        generation_config = model.generation_config
-    generation_config = copy.deepcopy(generation_config)
-    generation_config._eos_token_tensor = generation_config.eos_token_id
-    model_kwargs = generation_config.update(**kwargs)
-    if generation_config.temperature == 0.0:
-        generation_config.do_sample = False
-    eos_token_id = generation_config.eos_token_id
-    if isinstance(eos_token_id, int):
-        eos_token_id = [eos_token_id]
-    if additional_eos_token_id is not None:
-        eos_token_id.append(additional_eos_token_id)
-    has_default_max_length = kwargs.get(
-        'max_length') is None and generation_config.max_length is not None
-    if has_default_max_length and generation_config.max_new_tokens is None:
-        warnings.warn(
-            f"Using 'max_length''s default \
-                ({repr(generation_config.max_length)}) \
-                to control the generation length. "
-            'This behaviour is deprecated and will be removed from the \
-                config in v5 of Transformers -- we'
-            ' recommend using `max_new_tokens` to control the maximum \
-                length of the generation.',
-            UserWarning,
-        )
-    elif generation_config.max_new_tokens is not None:
-        generation_config.max_length = (generation_config.max_new_tokens +
-                                        input_ids_seq_length)
-        if not has_default_max_length:
-            logger.warn(  # pylint: disable=W4902
-                f"Both 'max_new_tokens' (={generation_config.max_new_tokens}) "
-                f"and 'max_length'(={generation_config.max_length}) seem to "
-                "have been set. 'max_new_tokens' will take precedence. "
-                'Please refer to the documentation for more information. '
-                '(https://huggingface.co/docs/transformers/main/'
-                'en/main_classes/text_generation)',
-                UserWarning,
-            )
-
-    if input_ids_seq_length >= generation_config.max_length:
-        input_ids_string = 'input_ids'
-        logger.warning(
-            f'Input length of {input_ids_string} is {input_ids_seq_length}, '
-            f"but 'max_length' is set to {generation_config.max_length}. "
-            'This can lead to unexpected behavior. You should consider'
-            " increasing 'max_new_tokens'.")
-
-    # 2. Set generation parameters if not already defined
-    logits_processor = (logits_processor if logits_processor is not None else
-                        LogitsProcessorList())
-    logits_processor = model._get_logits_processor(
-        generation_config=generation_config,
-        input_ids_seq_length=input_ids_seq_length,
-        encoder_input_ids=input_ids,
-        prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
-        logits_processor=logits_processor,
-    )
-    unfinished_sequences = input_ids.new(input_ids.shape[0]).fill_(1)
-    while True:
-        model_inputs = model.prepare_inputs_for_generation(
-            input_ids, **model_kwargs)
-        # forward pass to get next token
-        outputs = model(
-            **model_inputs,
-            return_dict=True,
-            output_attentions=False,
-            output_hidden_states=False,
-        )
 
-        next_token_logits = outputs.logits[:, -1, :]
+@st.cache_resource
+def load_prefix_cache():
+    return PrefixCache(max_bytes=PREFIX_CACHE_MAX_BYTES)
 
-        # pre-process distribution
-        next_token_scores = logits_processor(input_ids, next_token_logits)
 
-        # sample
-        probs = nn.functional.softmax(next_token_scores, dim=-1)
-        if generation_config.do_sample:
-            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
-        else:
-            next_tokens = torch.argmax(probs, dim=-1)
+@st.cache_resource
+def load_generation_worker():
+    return GenerationWorker(GENERATION_WORKERS)
 
-        # update generated ids, model inputs, and length for next step
-        input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-        unfinished_sequences = unfinished_sequences.mul(
-            (min(next_tokens != i for i in eos_token_id)).long())
 
-        output_token_ids = input_ids[0].cpu().tolist()
-        output_token_ids = output_token_ids[input_length:]
-        for each_eos_token_id in eos_token_id:
-            if output_token_ids[-1] == each_eos_token_id:
-                output_token_ids = output_token_ids[:-1]
-        response = tokenizer.decode(output_token_ids)
+def session_id():
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
 
-        yield response
-        # stop when each sentence is finished
-        # or if we exceed the maximum length
-        if unfinished_sequences.max() == 0:
-            break
+
+def prefix_cache_key(deepthink):
+    return session_id(), deepthink
+
+
+def invalidate_prefix_cache():
+    load_prefix_cache().invalidate(prefix_cache_key(False),
+                                   prefix_cache_key(True))
 
 
 def on_btn_click():
+    # a reply still generating would put its KV cache back afterwards
+    load_generation_worker().cancel(session_id())
     del st.session_state.messages
     del st.session_state.deepthink_messages
+    for deepthink in (False, True):
+        st.session_state.pop(f'history_window_{deepthink}', None)
+    invalidate_prefix_cache()
+
+
+def response_prefix(deepthink=False):
+    return (':red[[Deep Thinking]]\n\n'
+            if deepthink else ':blue[[Normal Response]]\n\n')
 
 
 def postprocess(text, add_prefix=True, deepthink=False):
-    text = re.sub(r'\\\(|\\\)', r'$', text)
-    text = re.sub(r'\\\[|\\\]', r'$$', text)
+    text = convert_math(text)
     if add_prefix:
-        text = (':red[[Deep Thinking]]\n\n'
-                if deepthink else ':blue[[Normal Response]]\n\n') + text
+        text = response_prefix(deepthink) + text
     return text
 
 
+def stream_renderer(placeholder, deepthink=False):
+    return StreamRenderer(placeholder,
+                          prefix=response_prefix(deepthink),
+                          frame_interval_s=1 / RENDER_FPS,
+                          tokens_per_frame=RENDER_TOKENS)
+
+
+def render_replies(stream, renderers):
+    """Draw the lists of replies ``stream`` yields, one per renderer, and
+    return the final replies.
+
+    The stream is generated on a worker thread, profiled when asked for,
+    and cancelled as soon as this script stops reading it.
+    """
+    request_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    trace_path = os.path.join(PROFILE_DIR, f'{request_id}.json')
+    if should_profile(st.session_state.get('profile', False), PROFILE_RATE):
+        stream = profiled_stream(stream, PROFILE_DIR, request_id)
+    job = load_generation_worker().submit(session_id(), stream)
+    try:
+        for replies in job:
+            for renderer, reply in zip(renderers, replies):
+                renderer.update(reply)
+    except ReplyCancelled:
+        # superseded, this run is being replaced by a newer one
+        st.stop()
+    finally:
+        # a rerun stops the script in the middle of the loop above
+        job.cancel()
+    replies = [renderer.finish() for renderer in renderers]
+    if os.path.exists(trace_path):
+        st.toast(f'profile written to {trace_path}')
+    return replies
+
+
+@st.cache_resource
+def start_metrics_export():
+    # once per process, the script itself reruns on every interaction
+    if METRICS_PORT:
+        prometheus_client.start_http_server(METRICS_PORT)
+    if REQUEST_LOG_PATH:
+        log_requests(None if REQUEST_LOG_PATH == '-' else REQUEST_LOG_PATH)
+
+
+@st.cache_resource
+def load_response_cache():
+    return ResponseCache(RESPONSE_CACHE_PATH)
+
+
+@st.cache_resource
+def load_message_tokenizer(_tokenizer):
+    return MessageTokenizer(_tokenizer)
+
+
+def history_window(tokenizer, deepthink, latest=True):
+    """The window of the session. Older replies are regenerated from a
+    shorter prefix of the conversation, which would move its start, so
+    they get a throwaway copy."""
+    key = f'history_window_{deepthink}'
+    if key not in st.session_state:
+        st.session_state[key] = HistoryWindow(
+            load_message_tokenizer(tokenizer),
+            HISTORY_TOKEN_BUDGET,
+            summarize=summarize_topics)
+    if not latest:
+        return copy.copy(st.session_state[key])
+    return st.session_state[key]
+
+
+@st.cache_resource
+def load_retrieval_index():
+    if os.path.exists(RETRIEVAL_INDEX_PATH):
+        return RetrievalIndex.load(RETRIEVAL_INDEX_PATH)
+    return RetrievalIndex.build(
+        load_dataset(os.path.join(DATA_DIR, 'cuihun-chinese-v0.1.json')))
+
+
 @st.cache_resource
 def load_model():
-    model_path = '/home/suxin/chatbot/finetune/merge/'
-    model = AutoModelForCausalLM.from_pretrained(model_path,
-                                                 trust_remote_code=True).to(
-                                                     torch.bfloat16).cuda()
-    tokenizer = AutoTokenizer.from_pretrained(model_path,
-                                              trust_remote_code=True)
-    return model, tokenizer
+    model, tokenizer = load_pretrained(MODEL_PATH, BackendConfig.from_env())
+    system_cache = SystemPromptCache.build(
+        model, tokenizer,
+        [system_prompt(deepthink=False),
+         system_prompt(deepthink=True)])
+    return model, tokenizer, system_cache
 
 
 def prepare_generation_config():
@@ -181,8 +205,26 @@ def prepare_generation_config():
         temperature = st.slider('Temperature', 0.0, 1.0, 0.7, step=0.01)
         radio = st.radio('Inference Mode',
                          ['Normal Response', 'Deep Thinking'],
-                         key='mode')
+                         key='mode',
+                         on_change=invalidate_prefix_cache)
+        st.toggle('Instant Reply',
+                  key='instant_reply',
+                  help='answer with the best matching curated reply')
+        st.slider('Few-shot Examples', 0, 5, 0, key='few_shot')
+        st.toggle('Profile Replies',
+                  key='profile',
+                  help=f'write a torch.profiler trace of every reply to '
+                  f'{PROFILE_DIR}')
         st.button('Clear Chat History', on_click=on_btn_click)
+        with st.expander('Response Cache'):
+            st.json(load_response_cache().stats())
+        with st.expander('Context Window'):
+            st.json({
+                f'deepthink={deepthink}':
+                st.session_state[f'history_window_{deepthink}'].last_stats
+                for deepthink in (False, True)
+                if f'history_window_{deepthink}' in st.session_state
+            })
 
     st.session_state['inference_mode'] = radio
     generation_config = GenerationConfig(max_length=max_length,
@@ -192,99 +234,44 @@ def prepare_generation_config():
     return generation_config
 
 
-user_prompt = '<|im_start|>user\n{user}<|im_end|>\n'
-robot_prompt = '<|im_start|>assistant\n{robot}<|im_end|>\n'
-cur_query_prompt = '<|im_start|>user\n{user}<|im_end|>\n\
-    <|im_start|>assistant\n'
-
-
-
-def combine_history(prompt, deepthink=False, start=0, stop=None):
+def chat_messages(prompt, deepthink=False, start=0, stop=None):
     if stop is None:
         stop = len(st.session_state.messages)
     elif stop < 0:
         stop = len(st.session_state.messages) + stop
-    messages = []
+    messages = [{'role': 'system', 'content': system_instruction(deepthink)}]
     for idx in range(start, stop):
         message, deepthink_message = st.session_state.messages[
             idx], st.session_state.deepthink_messages[idx]
         if deepthink:
-            if deepthink_message['content'] is not None:
-                messages.append(deepthink_message)
-            else:
-                messages.append(message)
-        else:
-            if message['content'] is not None:
-                messages.append(message)
-            else:
-                messages.append(deepthink_message)
-    meta_instruction = ('你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。')
-    if deepthink:
-        meta_instruction += (
-            """You are an expert mathematician with extensive experience in mathematical competitions. You approach problems through systematic thinking and rigorous reasoning. When solving problems, follow these thought processes:
-## Deep Understanding
-Take time to fully comprehend the problem before attempting a solution. Consider:
-- What is the real question being asked?
-- What are the given conditions and what do they tell us?
-- Are there any special restrictions or assumptions?
-- Which information is crucial and which is supplementary?
-## Multi-angle Analysis
-Before solving, conduct thorough analysis:
-- What mathematical concepts and properties are involved?
-- Can you recall similar classic problems or solution methods?
-- Would diagrams or tables help visualize the problem?
-- Are there special cases that need separate consideration?
-## Systematic Thinking
-Plan your solution path:
-- Propose multiple possible approaches
-- Analyze the feasibility and merits of each method
-- Choose the most appropriate method and explain why
-- Break complex problems into smaller, manageable steps
-## Rigorous Proof
-During the solution process:
-- Provide solid justification for each step
-- Include detailed proofs for key conclusions
-- Pay attention to logical connections
-- Be vigilant about potential oversights
-## Repeated Verification
-After completing your solution:
-- Verify your results satisfy all conditions
-- Check for overlooked special cases
-- Consider if the solution can be optimized or simplified
-- Review your reasoning process
-Remember:
-1. Take time to think thoroughly rather than rushing to an answer
-2. Rigorously prove each key conclusion
-3. Keep an open mind and try different approaches
-4. Summarize valuable problem-solving methods
-5. Maintain healthy skepticism and verify multiple times
-Your response should reflect deep mathematical understanding and precise logical thinking, making your solution path and reasoning clear to others.
-When you're ready, present your complete solution with:
-- Clear problem understanding
-- Detailed solution process
-- Key insights
-- Thorough verification
-Focus on clear, logical progression of ideas and thorough explanation of your mathematical reasoning. Provide answers in the same language as the user asking the question, repeat the final answer using a '\\boxed{}' without any units, you have [[8192]] tokens to complete the answer.
-""")  # noqa: E501
-    total_prompt = f'<s><|im_start|>system\n{meta_instruction}<|im_end|>\n'
-    for message in messages:
-        cur_content = message['content']
+            if deepthink_message['content'] is None:
+                deepthink_message = message
+            message = deepthink_message
+        elif message['content'] is None:
+            message = deepthink_message
         if message['role'] == 'user':
-            cur_prompt = user_prompt.format(user=cur_content)
+            role = 'user'
         elif message['role'] == 'robot':
-            cur_prompt = robot_prompt.format(robot=cur_content)
+            role = 'assistant'
         else:
             raise RuntimeError
-        total_prompt += cur_prompt
-    total_prompt = total_prompt + cur_query_prompt.format(user=prompt)
-    return total_prompt
+        messages.append({'role': role, 'content': message['content']})
+    messages.append({'role': 'user', 'content': prompt})
+    return messages
 
 
 def main():
     # torch.cuda.empty_cache()
-    print('load model begin.')
-    model, tokenizer = load_model()
-    print('load model end.')
+    if CHAT_SERVER_URL:
+        model = tokenizer = system_cache = prefix_cache = None
+        message_tokenizer = None
+    else:
+        print('load model begin.')
+        model, tokenizer, system_cache = load_model()
+        print('load model end.')
+        prefix_cache = load_prefix_cache()
+        start_metrics_export()
+        message_tokenizer = load_message_tokenizer(tokenizer)
 
     user_avator = 'assets/user.png'
     # robot_avator = 'assets/robot.png'
@@ -296,29 +283,138 @@ def main():
 
     generation_config = prepare_generation_config()
 
+    def ground_messages(messages):
+        # curated examples go right before the query, the history before
+        # them still matches the cached KV states of earlier turns
+        num_examples = st.session_state.get('few_shot', 0)
+        if not num_examples:
+            return messages
+        hits = load_retrieval_index().search(messages[-1]['content'],
+                                             k=num_examples)
+        return messages[:-1] + few_shot_messages(hits) + messages[-1:]
+
+    def prepare_messages(messages, deepthink, latest):
+        messages = ground_messages(messages)
+        if tokenizer is None:
+            # the server owns the tokenizer in client mode
+            return messages
+        try:
+            return history_window(tokenizer, deepthink,
+                                  latest).fit(messages)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+
+    def stream_reply(messages, deepthink, latest=True):
+        if st.session_state.get('instant_reply'):
+            reply = load_retrieval_index().instant_reply(
+                messages[-1]['content'])
+            if reply is not None:
+                return iter([reply])
+        messages = prepare_messages(messages, deepthink, latest)
+        generation_kwargs = asdict(generation_config)
+        response_cache = load_response_cache()
+        # the reply is generated on a worker thread, which has no session
+        cache_key = prefix_cache_key(deepthink)
+        # submitted now, so the queue wait includes waiting for a worker
+        metrics = RequestMetrics(request_id=uuid.uuid4().hex)
+        return cached_stream(
+            response_cache,
+            response_cache_key(messages, generation_kwargs,
+                               CHAT_SERVER_URL or MODEL_PATH),
+            lambda: generate_reply(messages, cache_key, metrics),
+            response_cache.num_variants_for(generation_kwargs))
+
+    def generate_reply(messages, cache_key, metrics):
+        if CHAT_SERVER_URL:
+            return stream_chat_completion(CHAT_SERVER_URL, messages,
+                                          **asdict(generation_config))
+        start = time.perf_counter()
+        # only messages not seen before go through the tokenizer
+        prompt_ids = message_tokenizer.encode_messages(messages)
+        metrics.tokenize_s = time.perf_counter() - start
+        return generate_interactive(
+            model=model,
+            tokenizer=tokenizer,
+            prompt=prompt_ids,
+            metrics=metrics,
+            additional_eos_token_id=92542,
+            prefix_cache=prefix_cache,
+            system_cache=system_cache,
+            cache_key=cache_key,
+            num_speculative_tokens=SPECULATIVE_TOKENS,
+            **asdict(generation_config),
+        )
+
+    def stream_replies(batch_messages, deepthinks, latest=True):
+        batch_messages = [
+            prepare_messages(messages, deepthink, latest)
+            for messages, deepthink in zip(batch_messages, deepthinks)
+        ]
+        if CHAT_SERVER_URL:
+            return stream_chat_completions(CHAT_SERVER_URL, batch_messages,
+                                           **asdict(generation_config))
+        # both columns share one prefill and decode loop instead: unlike
+        # stream_reply this skips the prefix, system prompt and response
+        # caches, and no request metrics are exported
+        return generate_batch_interactive(
+            model=model,
+            tokenizer=tokenizer,
+            prompts=[
+                message_tokenizer.encode_messages(messages)
+                for messages in batch_messages
+            ],
+            additional_eos_token_id=92542,
+            **asdict(generation_config),
+        )
+
+    def is_latest(msg_idx):
+        # the reply to the last query, as rendered or still being generated
+        return msg_idx >= len(st.session_state.messages) - 1
+
     def render_message(msg, msg_idx, deepthink):
         if msg['content'] is None:
-            real_prompt = combine_history(
+            messages = chat_messages(
                 st.session_state.messages[msg_idx - 1]['content'],
                 deepthink=deepthink,
                 stop=msg_idx - 1)
-            placeholder = st.empty()
-            for cur_response in generate_interactive(
-                    model=model,
-                    tokenizer=tokenizer,
-                    prompt=real_prompt,
-                    additional_eos_token_id=92542,
-                    **asdict(generation_config),
-            ):
-                placeholder.markdown(
-                    postprocess(cur_response, deepthink=deepthink) + '▌')
-            placeholder.markdown(postprocess(cur_response,
-                                             deepthink=deepthink))
-            msg['content'] = cur_response
+            msg['content'], = render_replies(
+                batches_of_one(
+                    stream_reply(messages, deepthink, is_latest(msg_idx))),
+                [stream_renderer(st.empty(), deepthink)])
             torch.cuda.empty_cache()
         else:
             st.markdown(postprocess(msg['content'], deepthink=deepthink))
 
+    def render_compare(message, deepthink_message, msg_idx):
+        cols = st.columns(2)
+        if message['content'] is None and deepthink_message['content'] is None:
+            # neither answer exists yet, stream both from one batch
+            batch_messages = [
+                chat_messages(
+                    st.session_state.messages[msg_idx - 1]['content'],
+                    deepthink=deepthink,
+                    stop=msg_idx - 1) for deepthink in (False, True)
+            ]
+            replies = stream_replies(batch_messages, (False, True),
+                                     is_latest(msg_idx))
+            message['content'], deepthink_message['content'] = (
+                render_replies(replies, [
+                    stream_renderer(col.empty(), deepthink)
+                    for col, deepthink in zip(cols, (False, True))
+                ]))
+            torch.cuda.empty_cache()
+        elif st.session_state['inference_mode'] == 'Deep Thinking':
+            with cols[1]:
+                render_message(deepthink_message, msg_idx, True)
+            with cols[0]:
+                render_message(message, msg_idx, False)
+        else:
+            with cols[0]:
+                render_message(message, msg_idx, False)
+            with cols[1]:
+                render_message(deepthink_message, msg_idx, True)
+
     # Initialize chat history
     if 'messages' not in st.session_state:
         st.session_state.messages = []
@@ -334,17 +430,7 @@ def main():
                 st.markdown(postprocess(message['content'], add_prefix=False))
             else:
                 if st.toggle('compare', key=f'compare_{idx}'):
-                    cols = st.columns(2)
-                    if st.session_state['inference_mode'] == 'Deep Thinking':
-                        with cols[1]:
-                            render_message(deepthink_message, idx, True)
-                        with cols[0]:
-                            render_message(message, idx, False)
-                    else:
-                        with cols[0]:
-                            render_message(message, idx, False)
-                        with cols[1]:
-                            render_message(deepthink_message, idx, True)
+                    render_compare(message, deepthink_message, idx)
                 else:
                     if st.session_state['inference_mode'] == 'Deep Thinking':
                         if deepthink_message['content'] is not None:
@@ -366,9 +452,8 @@ def main():
         # Display user message in chat message container
         with st.chat_message('user', avatar=user_avator):
             st.markdown(postprocess(prompt, add_prefix=False))
-        real_prompt = combine_history(
-            prompt,
-            deepthink=st.session_state['inference_mode'] == 'Deep Thinking')
+        deepthink = st.session_state['inference_mode'] == 'Deep Thinking'
+        messages = chat_messages(prompt, deepthink=deepthink)
         # Add user message to chat history
         st.session_state.messages.append({
             'role': 'user',
@@ -382,30 +467,27 @@ def main():
         })
 
         with st.chat_message('robot', avatar=robot_avator):
-            st.toggle('compare',
-                      key=f'compare_{len(st.session_state.messages)}')
-            message_placeholder = st.empty()
-            for cur_response in generate_interactive(
-                    model=model,
-                    tokenizer=tokenizer,
-                    prompt=real_prompt,
-                    additional_eos_token_id=92542,
-                    **asdict(generation_config),
-            ):
+            msg_idx = len(st.session_state.messages)
+            # keep comparing if the previous answer was shown side by side
+            compare = st.toggle('compare',
+                                key=f'compare_{msg_idx}',
+                                value=st.session_state.get(
+                                    f'compare_{msg_idx - 2}', False))
+            if compare:
+                message = {'role': 'robot', 'content': None}
+                deepthink_message = {'role': 'robot', 'content': None}
+                render_compare(message, deepthink_message, msg_idx)
+                response = message['content']
+                deepthink_response = deepthink_message['content']
+            else:
                 # Display robot response in chat message container
-                message_placeholder.markdown(
-                    postprocess(cur_response,
-                                deepthink=st.session_state['inference_mode'] ==
-                                'Deep Thinking') + '▌')
-            message_placeholder.markdown(
-                postprocess(cur_response,
-                            deepthink=st.session_state['inference_mode'] ==
-                            'Deep Thinking'))
-        # Add robot response to chat history
-        response, deepthink_response = ((None, cur_response)
-                                        if st.session_state['inference_mode']
-                                        == 'Deep Thinking' else
-                                        (cur_response, None))
+                cur_response, = render_replies(
+                    ([reply] for reply in stream_reply(messages, deepthink)),
+                    [stream_renderer(st.empty(), deepthink)])
+                # Add robot response to chat history
+                response, deepthink_response = ((None, cur_response)
+                                                if deepthink else
+                                                (cur_response, None))
         st.session_state.messages.append({
             'role': 'robot',
             'content': response,  # pylint: disable=undefined-loop-variable
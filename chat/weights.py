@@ -0,0 +1,255 @@
+"""Store the merged model as safetensors and load it memory-mapped.
+
+``finetune/merge`` holds pickled ``pytorch_model-*.bin`` shards, so every
+process unpickles all weights into its own anonymous memory. Converted
+once with
+
+    python weights.py ../finetune/merge ../finetune/merge-safetensors
+
+the weights are mapped straight from the page cache instead: processes on
+one host share the same physical pages and start up as fast as the disk
+can be read.
+"""
+import argparse
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch import nn
+
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+from transformers.utils import logging
+
+logger = logging.get_logger(__name__)
+
+BIN_INDEX = 'pytorch_model.bin.index.json'
+BIN_WEIGHTS = 'pytorch_model.bin'
+SAFE_INDEX = 'model.safetensors.index.json'
+SAFE_WEIGHTS = 'model.safetensors'
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def shard_files(model_path, index_name, single_name):
+    index_path = os.path.join(model_path, index_name)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)['weight_map']
+        return sorted(set(weight_map.values()))
+    if os.path.exists(os.path.join(model_path, single_name)):
+        return [single_name]
+    return []
+
+
+def has_safetensors(model_path):
+    return bool(shard_files(model_path, SAFE_INDEX, SAFE_WEIGHTS))
+
+
+def convert(src, dst, dtype=torch.bfloat16):
+    """Rewrite the ``.bin`` shards of ``src`` as safetensors in ``dst``."""
+    bin_files = shard_files(src, BIN_INDEX, BIN_WEIGHTS)
+    if not bin_files:
+        raise FileNotFoundError(f'no pytorch_model*.bin weights in {src}')
+    os.makedirs(dst, exist_ok=True)
+    for file_name in os.listdir(src):
+        if not file_name.startswith('pytorch_model'):
+            shutil.copy2(os.path.join(src, file_name), dst)
+
+    weight_map, total_size = {}, 0
+    for idx, bin_file in enumerate(bin_files, 1):
+        state_dict = torch.load(os.path.join(src, bin_file),
+                                map_location='cpu',
+                                weights_only=True,
+                                mmap=True)
+        tensors = {
+            name: (tensor.to(dtype) if tensor.is_floating_point() else
+                   tensor).contiguous()
+            for name, tensor in state_dict.items()
+        }
+        shard_name = (SAFE_WEIGHTS if len(bin_files) == 1 else
+                      f'model-{idx:05d}-of-{len(bin_files):05d}.safetensors')
+        save_file(tensors,
+                  os.path.join(dst, shard_name),
+                  metadata={'format': 'pt'})
+        for name, tensor in tensors.items():
+            weight_map[name] = shard_name
+            total_size += tensor.numel() * tensor.element_size()
+        del state_dict, tensors
+
+    if len(bin_files) > 1:
+        with open(os.path.join(dst, SAFE_INDEX), 'w') as f:
+            json.dump(
+                {
+                    'metadata': {
+                        'total_size': total_size
+                    },
+                    'weight_map': weight_map
+                },
+                f,
+                indent=2)
+    config_path = os.path.join(dst, 'config.json')
+    with open(config_path) as f:
+        config = json.load(f)
+    config['torch_dtype'] = str(dtype).replace('torch.', '')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def mmap_safetensors(path):
+    """Tensors of one safetensors file, backed by a private mapping of it.
+
+    Pages are only copied if a tensor is written to, so read-only weights
+    stay shared with every other process mapping the same file.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        begin, _ = info['data_offsets']
+        numel = math.prod(info['shape'])
+        if numel == 0:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(buffer,
+                                         dtype=dtype,
+                                         count=numel,
+                                         offset=data_start + begin).reshape(
+                                             info['shape'])
+    return tensors
+
+
+def empty_model(model_path, dtype):
+    """The model with its parameters on the meta device.
+
+    Buffers such as the rotary frequencies are built for real, they are
+    not stored in the checkpoint.
+    """
+    config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    with init_empty_weights(include_buffers=False):
+        return AutoModelForCausalLM.from_config(config,
+                                                torch_dtype=dtype,
+                                                trust_remote_code=True)
+
+
+def finish_model(model, model_path):
+    model.tie_weights()
+    missing = [name for name, p in model.named_parameters() if p.is_meta]
+    if missing:
+        raise KeyError(f'weights missing from {model_path}: {missing[:5]}')
+    if os.path.exists(os.path.join(model_path, 'generation_config.json')):
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    return model.eval()
+
+
+def load_mmap_model(model_path, dtype=None):
+    """Build the model around memory-mapped safetensors weights on CPU."""
+    state_dict = {}
+    for file_name in shard_files(model_path, SAFE_INDEX, SAFE_WEIGHTS):
+        state_dict.update(mmap_safetensors(os.path.join(model_path,
+                                                        file_name)))
+    stored_dtype = next(t.dtype for t in state_dict.values()
+                        if t.is_floating_point())
+    model = empty_model(model_path, stored_dtype)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model = finish_model(model, model_path)
+    if dtype is not None and dtype != stored_dtype:
+        logger.warning(f'{model_path} is stored as {stored_dtype}, casting to '
+                       f'{dtype} makes private copies of the weights')
+        model = model.to(dtype)
+    return model
+
+
+def iter_checkpoint(model_path):
+    """Yield ``(name, tensor)`` for every stored weight, one shard at a
+    time, so at most one shard is mapped at once."""
+    safetensors_files = shard_files(model_path, SAFE_INDEX, SAFE_WEIGHTS)
+    if safetensors_files:
+        for file_name in safetensors_files:
+            with safe_open(os.path.join(model_path, file_name),
+                           framework='pt') as f:
+                for name in f.keys():
+                    yield name, f.get_tensor(name)
+        return
+    bin_files = shard_files(model_path, BIN_INDEX, BIN_WEIGHTS)
+    if not bin_files:
+        raise FileNotFoundError(f'no weights in {model_path}')
+    for file_name in bin_files:
+        state_dict = torch.load(os.path.join(model_path, file_name),
+                                map_location='cpu',
+                                weights_only=True,
+                                mmap=True)
+        for name in list(state_dict):
+            yield name, state_dict.pop(name)
+        del state_dict
+
+
+def load_streaming(model_path, dtype, device='cpu'):
+    """Load the model tensor by tensor straight into ``dtype`` on
+    ``device``.
+
+    Each tensor is cast as soon as it is read, so the peak stays around the
+    final model plus one shard. The pinned transformers maps the shards too
+    and peaks about as low with ``torch_dtype`` (``benchmark.py load``);
+    this loader does not depend on that and also feeds the quantization in
+    ``backend.py``.
+    """
+    model = empty_model(model_path, dtype)
+    for name, tensor in iter_checkpoint(model_path):
+        module_name, _, tensor_name = name.rpartition('.')
+        try:
+            module = model.get_submodule(module_name)
+        except AttributeError:
+            logger.warning(f'ignoring unexpected weight {name}')
+            continue
+        if tensor.is_floating_point():
+            tensor = tensor.to(device=device, dtype=dtype)
+        else:
+            tensor = tensor.to(device)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = nn.Parameter(
+                tensor, requires_grad=False)
+        elif tensor_name in module._buffers:
+            module._buffers[tensor_name] = tensor
+        else:
+            logger.warning(f'ignoring unexpected weight {name}')
+    # moves the buffers that were built on CPU
+    return finish_model(model, model_path).to(device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('src', help='model directory with .bin shards')
+    parser.add_argument('dst', help='output directory')
+    parser.add_argument('--dtype',
+                        default='bfloat16',
+                        choices=['bfloat16', 'float16', 'float32'])
+    args = parser.parse_args()
+    convert(args.src, args.dst, getattr(torch, args.dtype))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Reply streams pulled on worker threads, so they can be cancelled.
+
+Streamlit reruns the script on every interaction, whether the user sends a
+new message, clears the history or closes the tab, and drops the reply it
+was streaming. A generator dropped that way keeps its checked out KV cache
+until it happens to be garbage collected, so the next turn prefills the
+whole transcript again.
+
+``GenerationWorker`` pulls every reply on a thread of its pool and hands
+the steps to the script through a queue. A job is cancelled when the
+script stops reading it, when the same session starts another reply and
+when it clears its history. The worker checks for that after every decode
+step and closes the generator, which puts the KV cache back. Generators
+wrapping another stream close it in a ``finally`` (``yield from`` does so
+already), so the close reaches ``generate_interactive`` right away instead
+of whenever the wrapped generator is garbage collected.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional
+
+from metrics import CANCEL_LATENCY, WASTED_DECODE_STEPS
+
+# ends the queue of a job
+_DONE = object()
+
+
+def close_stream(stream: Iterable):
+    """Run the ``finally`` blocks of ``stream`` now if it is a generator."""
+    close = getattr(stream, 'close', None)
+    if close is not None:
+        close()
+
+
+def batches_of_one(stream: Iterable) -> Iterator[List]:
+    """Every step of ``stream`` as a list of one, like a batch of replies.
+    Closing it closes ``stream``."""
+    try:
+        for output in stream:
+            yield [output]
+    finally:
+        close_stream(stream)
+
+
+class ReplyCancelled(Exception):
+    """The reply was cancelled before it finished."""
+
+
+class ReplyJob:
+    """One reply stream, pulled by ``run`` on a worker and read by iterating
+    the job.
+
+    Every item of the stream is one decode step, e.g. the reply so far from
+    ``generate_interactive`` or the replies of a batch.
+    """
+
+    def __init__(self, stream: Iterable):
+        self.stream = iter(stream)
+        self.steps = 0
+        # set when the job was cancelled before the stream ended
+        self.stopped = False
+        self._cancelled_at = None
+        self._steps_at_cancel = 0
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._outputs = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def cancel(self):
+        """Stop after the step in progress, a no-op once the job is done."""
+        with self._lock:
+            if self._cancelled.is_set() or self._done.is_set():
+                return
+            self._cancelled_at = time.perf_counter()
+            self._steps_at_cancel = self.steps
+            self._cancelled.set()
+            if self._started:
+                return
+            # still waiting for a worker, which will skip it
+            self.stopped = True
+            self._outputs.put(_DONE)
+            self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def run(self):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._started = True
+        try:
+            for output in self.stream:
+                self.steps += 1
+                if self._cancelled.is_set():
+                    self.stopped = True
+                    break
+                self._outputs.put((output, None))
+        except Exception as e:  # noqa: B902
+            # raised again in the thread reading the job
+            self._outputs.put((None, e))
+        finally:
+            # runs the finally blocks of the generators, e.g. the KV cache
+            # goes back to the prefix cache
+            close_stream(self.stream)
+            if self.stopped:
+                # only the steps decoded after the cancel were for nothing
+                WASTED_DECODE_STEPS.inc(self.steps - self._steps_at_cancel)
+                CANCEL_LATENCY.observe(time.perf_counter() -
+                                       self._cancelled_at)
+            self._outputs.put(_DONE)
+            self._done.set()
+
+    def __iter__(self) -> Iterator:
+        """The steps as the worker produces them. Raises ``ReplyCancelled``
+        if the job was cancelled before the stream ended, so a partial reply
+        is never taken for a finished one."""
+        while True:
+            item = self._outputs.get()
+            if item is _DONE:
+                break
+            output, error = item
+            if error is not None:
+                raise error
+            yield output
+        if self.stopped:
+            raise ReplyCancelled
+
+
+class GenerationWorker:
+    """Thread pool pulling reply streams, at most one running per key.
+
+    Keys are sessions: a new reply of a session cancels the one before.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='generation')
+        self._jobs: Dict[Hashable, ReplyJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: Hashable, stream: Iterable) -> ReplyJob:
+        """Pull ``stream`` as the reply of ``key``. The previous reply of
+        ``key`` is cancelled first, and has put its KV cache back by the
+        time the new one starts."""
+        self.cancel(key)
+        job = ReplyJob(stream)
+        with self._lock:
+            self._jobs[key] = job
+        self._executor.submit(job.run).add_done_callback(
+            lambda _: self._forget(key, job))
+        return job
+
+    def cancel(self, key: Hashable, timeout: Optional[float] = None):
+        """Cancel the reply of ``key`` and wait until it stopped, which
+        takes at most one decode step."""
+        with self._lock:
+            job = self._jobs.pop(key, None)
+        if job is not None:
+            job.cancel()
+            job.wait(timeout)
+
+    def _forget(self, key, job):
+        with self._lock:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
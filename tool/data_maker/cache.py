@@ -0,0 +1,93 @@
+"""
+按内容寻址的回复缓存，get_data_v1.py 和 get_data_v2.py 共用，存在 SQLite 里。
+
+key 是请求参数（模型、messages 和采样参数）的哈希，改了模板或风格表后重新运行，
+没变的提示词直接用缓存里的回复，不再发请求。同一个请求可以存 samples 个不同的回复，
+第 k 次出现的同样请求用第 k % samples 个，保留多轮生成的多样性。
+设置 max_entries 后超出的部分按最近使用时间淘汰（LRU）。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_PATH = os.path.expanduser("~/.cache/cuihun/completions.sqlite3")
+
+
+def request_key(request):
+    """
+    chat.completions.create 参数的哈希，参数的顺序不影响结果
+    """
+    data = json.dumps(request, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def occurrences(requests):
+    """
+    每个请求是同样的请求中第几次出现，从 0 开始
+    """
+    counts = {}
+    result = []
+    for request in requests:
+        key = request_key(request)
+        result.append(counts.get(key, 0))
+        counts[key] = result[-1] + 1
+    return result
+
+
+class CompletionCache:
+    """
+    (key, sample) 对应一条回复。每次写入都提交，程序中断也不会丢失已缓存的回复
+    """
+
+    def __init__(self, path=DEFAULT_PATH, samples=1, max_entries=None):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.samples = samples
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT NOT NULL, sample INTEGER NOT NULL, text TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (key, sample))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._db.commit()
+
+    def get(self, key, sample):
+        """
+        缓存的回复，没有时为 None。命中时更新最近使用时间
+        """
+        row = self._db.execute("SELECT text FROM completions WHERE key = ? AND sample = ?", (key, sample)).fetchone()
+        if row is None:
+            return None
+        with self._db:
+            self._db.execute(
+                "UPDATE completions SET last_used = ? WHERE key = ? AND sample = ?",
+                (time.time(), key, sample),
+            )
+        return row[0]
+
+    def put(self, key, sample, text):
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, sample, text, now, now),
+            )
+            if self.max_entries is not None:
+                # 只保留最近使用的 max_entries 条
+                self._db.execute(
+                    "DELETE FROM completions WHERE rowid IN ("
+                    "SELECT rowid FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,313 @@
+"""
+get_data_v1.py 和 get_data_v2.py 共用的异步生成引擎。
+
+每个请求是一次 chat completions 调用，共用一个带连接池的 HTTP 客户端。
+同时在途的请求数由 AdaptiveLimit 按 AIMD 调整，最多 concurrency 个：
+请求成功时慢慢加，接口过载（429、503、超时）时减半，Retry-After 让所有请求一起暂停。
+可重试的错误按带抖动的指数退避重试；重试也不会成功的错误（参数错误、鉴权失败等）
+和重试用尽的请求写入 dead letter 文件，不会被悄悄丢掉。内容为空的回复（例如被内容过滤）
+也算作可重试的错误，不会当作成功返回 None。
+
+传入 cache（见 cache.py）时先查缓存，命中的请求不占并发也不发网络请求，
+同一轮里同样的请求只发一次，结束时打印缓存命中率。
+结果按请求的顺序返回，与完成的先后无关，运行中定期打印进度和吞吐。
+用 mock_server.py 可以在本地模拟一个有延迟和 TPM 限制的接口：
+
+    python mock_server.py --latency 2 --tpm 60000 &
+    OPENAI_API_BASE=http://localhost:8001/v1 python get_data_v2.py --concurrency 32
+"""
+import asyncio
+import email.utils
+import json
+import os
+import random
+import time
+
+import httpx
+from openai import (APIConnectionError, APIStatusError, APITimeoutError,
+                    AsyncOpenAI, DefaultAsyncHttpxClient)
+
+from cache import occurrences, request_key
+
+# 除 5xx 外可以重试的状态码
+RETRYABLE_STATUS = (408, 409, 429)
+# 说明接口已经过载、需要降低并发的状态码
+OVERLOAD_STATUS = (429, 503)
+
+# 退避的抖动，不影响脚本里用 --seed 固定的随机数
+_jitter = random.Random()
+
+
+class EmptyReplyError(Exception):
+    """
+    接口返回成功但没有回复内容，例如 finish_reason 为 content_filter
+    """
+
+    def __init__(self, finish_reason):
+        super().__init__(f"回复内容为空，finish_reason={finish_reason}")
+        self.finish_reason = finish_reason
+
+
+def make_client(concurrency, timeout=600.0):
+    """
+    异步客户端，连接池大小与并发数一致，连接在请求之间复用。
+    重试由 complete_all 负责，客户端自己不重试
+    """
+    return AsyncOpenAI(
+        api_key=os.getenv("DASHSCOPE_API_KEY"),
+        base_url=os.getenv("OPENAI_API_BASE"),
+        timeout=timeout,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=concurrency,
+            )
+        ),
+    )
+
+
+def is_retryable(error):
+    """
+    超时、连接错误、空回复、408/409/429 和 5xx 可以重试
+    """
+    if isinstance(error, (APIConnectionError, EmptyReplyError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def is_overload(error):
+    if isinstance(error, APITimeoutError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in OVERLOAD_STATUS
+
+
+def retry_after(error):
+    """
+    响应头 retry-after-ms 或 Retry-After（秒数或 HTTP 日期）要求等待的秒数，没有时为 None
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+    """
+    第 attempt 次重试前等待的秒数，指数增长并在 [0, 上限) 内随机（full jitter）
+    """
+    return _jitter.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimit:
+    """
+    AIMD 并发控制。每个请求成功，上限加 1/上限，大约每轮加 1；
+    接口过载时上限减半。减半之前发出的请求再过载不会继续减半，
+    避免一次突发的 429 把上限压到底。Retry-After 让所有请求暂停到指定时间。
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        等到不在暂停中且在途请求数低于上限，返回请求的开始时间
+        """
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+                # 等待期间可能又收到了 Retry-After
+                if self.paused_until <= time.monotonic():
+                    self.in_flight += 1
+                    return time.monotonic()
+
+    async def release(self, start, error=None):
+        async with self._condition:
+            self.in_flight -= 1
+            if error is None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif is_overload(error) and start >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = time.monotonic()
+                self.decreases += 1
+            wait = retry_after(error) if error is not None else None
+            if wait:
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            self._condition.notify_all()
+
+
+class Progress:
+    """
+    完成数、失败数、重试数、缓存命中数和吞吐，每 interval 秒打印一次
+    """
+
+    def __init__(self, total, limit, interval=5.0):
+        self.total = total
+        self.limit = limit
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+        self.hits = 0
+        self.completion_tokens = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, response, hit=False):
+        self.done += 1
+        if hit:
+            self.hits += 1
+        elif response is None:
+            self.failed += 1
+        elif response.usage is not None:
+            self.completion_tokens += response.usage.completion_tokens
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or self.done == self.total:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else float("inf")
+        print(
+            f"进度: {self.done}/{self.total}，失败 {self.failed}，重试 {self.retries}，缓存命中 {self.hits}，"
+            f"并发上限 {int(self.limit.limit)}，{rate:.2f} 请求/秒，"
+            f"{self.completion_tokens / elapsed:.0f} token/秒，"
+            f"预计剩余 {eta:.0f} 秒"
+        )
+
+
+def write_dead_letter(path, index, request, error, attempts):
+    """
+    追加一行失败的请求，排查原因后可以据此补生成
+    """
+    record = {
+        "index": index,
+        "request": request,
+        "error": f"{type(error).__name__}: {error}",
+        "status": getattr(error, "status_code", None),
+        "attempts": attempts,
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+async def complete_all(
+    requests, concurrency=8, on_result=None, max_retries=8, dead_letter_path=None, cache=None, samples=None
+):
+    """
+    requests 为 chat.completions.create 的参数列表，返回对应的回复文本，
+    失败的为 None 并写入 dead_letter_path。on_result(index, text) 在每个请求成功时调用。
+    samples[i] 为第 i 个请求在同样的请求中是第几次出现，决定用缓存里的第几个回复，
+    默认按 requests 里的顺序计算
+    """
+    client = make_client(concurrency)
+    limit = AdaptiveLimit(concurrency)
+    results = [None] * len(requests)
+    progress = Progress(len(requests), limit)
+    # 各个 worker 共用一个迭代器，按顺序领取下一个请求
+    pending = iter(range(len(requests)))
+    if cache is not None and samples is None:
+        samples = occurrences(requests)
+    # 正在生成的 (key, sample)，同样的请求等它的结果
+    generating = {}
+
+    async def complete(index):
+        if cache is None:
+            return await generate(index)
+        slot = (request_key(requests[index]), samples[index] % cache.samples)
+        text = cache.get(*slot)
+        # 生成失败时由下一个等待的请求接着生成
+        while text is None and slot in generating:
+            text = await generating[slot]
+        if text is not None:
+            progress.update(None, hit=True)
+            return text
+        generating[slot] = asyncio.get_running_loop().create_future()
+        text = await generate(index)
+        generating.pop(slot).set_result(text)
+        if text is not None:
+            cache.put(*slot, text)
+        return text
+
+    async def generate(index):
+        for attempt in range(max_retries + 1):
+            start = await limit.acquire()
+            try:
+                response = await client.chat.completions.create(**requests[index])
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            await limit.release(start, error)
+            if error is None:
+                choice = response.choices[0] if response.choices else None
+                if choice is not None and choice.message.content:
+                    progress.update(response)
+                    return choice.message.content
+                # 接口没有过载，不影响并发上限，但和其他错误一样重试或写入 dead letter
+                error = EmptyReplyError(choice.finish_reason if choice is not None else None)
+            if not is_retryable(error) or attempt == max_retries:
+                break
+            progress.retries += 1
+            # 有 Retry-After 时 acquire 会等到暂停结束，这里只错开各请求恢复的时间，
+            # 错开的范围不超过要求等待的时间，等待很短时不多等
+            wait = retry_after(error)
+            if wait is not None:
+                await asyncio.sleep(_jitter.uniform(0, min(1.0, wait)))
+            else:
+                await asyncio.sleep(backoff(attempt))
+        print(f"生成失败，错误: {error}")
+        if dead_letter_path is not None:
+            write_dead_letter(dead_letter_path, index, requests[index], error, attempt + 1)
+        progress.update(None)
+        return None
+
+    async def worker():
+        for index in pending:
+            results[index] = await complete(index)
+            if on_result is not None and results[index] is not None:
+                on_result(index, results[index])
+
+    async with client:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if cache is not None and requests:
+        print(f"缓存命中率: {progress.hits}/{len(requests)} ({progress.hits / len(requests):.1%})")
+    return results
+
+
+def run(requests, concurrency=8, on_result=None, max_retries=8, dead_letter_path=None, cache=None, samples=None):
+    return asyncio.run(
+        complete_all(requests, concurrency, on_result, max_retries, dead_letter_path, cache, samples)
+    )
@@ -1,25 +1,19 @@
 # from zhipu import ZhipuAI
-import time 
-import json
-import random
-import datetime
-import os
-from openai import OpenAI
+import run
 
-# client = OpenAI(
-#     api_key=os.getenv("DASHSCOPE_API_KEY"),
-#     base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-# )
-openai_key = os.getenv("DASHSCOPE_API_KEY")
-client = OpenAI(api_key=openai_key, base_url=os.getenv("OPENAI_API_BASE"))
+# 接口地址和密钥见 engine.make_client，例如
+# OPENAI_API_BASE=https://dashscope.aliyuncs.com/compatible-mode/v1
 
-def get_data_openai(content):
-    response = client.chat.completions.create(
+def build_request(content):
+    """
+    chat completions 的请求参数，由 engine.py 并发发送
+    """
+    return dict(
         model="qwen2.5-72b-instruct",
         messages=[
             {
                 "role": "system", 
-                "content": "你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。"
+                "content": run.SYSTEM_PROMPT
             },
             {
                 "role": "user",
@@ -30,8 +24,6 @@ def get_data_openai(content):
         # max_tokens=4096,
         # temperature=0.8  # 多样化输出
     )
-    res = response.choices[0].message.content
-    return res
 
 
 # 不同对象
@@ -132,63 +124,39 @@ final_prompt = """
 注意：直接返回文本内容，不要包含任何对话角色信息和多余解释。
 """
 
-def main():
-    roop_count = 2  # 循环次数
-    now_count = 0
-
-    conversations = []
-
-    for _ in range(roop_count):
-        for name in name_list:
-            for scene in scenes:
-                try:
-                    style_name = random.choice(list(styles.keys()))
-                    style_config = styles[style_name]
-
-                    if style_config["if_example"]:
-                        example = random.choice(style_config["examples"])
-                        style_prompt = style_config["style_temple"].format(example)
-                    else:
-                        style_prompt = style_config["style_temple"]
-
-                    extra_prompt = random.choice(random_finalprompt_sentence)
-
-                    input_prompt = final_prompt.format(
-                        name=name,
-                        scene=scene,
-                        style=style_prompt,
-                        extra=extra_prompt,
-                    )
-
-                    response = get_data_openai(input_prompt)
-                    now_count += 1
-
-                    conversation = {
-                        "conversation": [
-                            {
-                                "system": "你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。",
-                                "src_input": input_prompt,
-                                "style_name": style_name,
-                                "input": f"催婚回应给{name}，场景 {scene}，风格 {style_name}",
-                                "output": response,
-                            }
-                        ]
-                    }
-
-                    conversations.append(conversation)
-                    print(f"对象: {name}, 场景: {scene}, 风格: {style_name}, 回应: {response}")
-                    print(f"当前已生成数目: {now_count}")
-
-                except Exception as e:
-                    print(f"生成失败，错误: {e}")
-                    continue
+def build_items(plan):
+    """
+    由 planner.py 的计划生成每条任务的提示词
+    """
+    items = []
+    for task in plan:
+        style_config = styles[task["style_name"]]
+        if style_config["if_example"]:
+            style_prompt = style_config["style_temple"].format(task["example"])
+        else:
+            style_prompt = style_config["style_temple"]
+
+        input_prompt = final_prompt.format(
+            name=task["name"],
+            scene=task["scene"],
+            style=style_prompt,
+            extra=task["extra"],
+        )
+        items.append(
+            {
+                "key": task["key"],
+                "name": task["name"],
+                "scene": task["scene"],
+                "style_name": task["style_name"],
+                "src_input": input_prompt,
+                "request": build_request(input_prompt),
+            }
+        )
+    return items
 
-    now_time = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    file_path = f"/home/suxin/chatbot/data/marriage_responses_{now_time}.json"
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(conversations, f, ensure_ascii=False, indent=4)
 
-    print(f"生成完毕，保存文件：{file_path}")
+def main():
+    run.main(name_list, scenes, styles, random_finalprompt_sentence, build_items, "/home/suxin/chatbot/data/marriage_responses.json")
 
 
 if __name__ == "__main__":
@@ -1,24 +1,15 @@
 # from zhipu import ZhipuAI
-import time 
-import json
-import random
-import datetime
-import os
-from openai import OpenAI
+import run
 
-openai_key = os.getenv("DASHSCOPE_API_KEY")
-client = OpenAI(api_key=openai_key, base_url=os.getenv("OPENAI_API_BASE"))
-
-def get_data_openai(messages):
+def build_request(messages):
     """
-    调用chat completions接口，messages为list形式对话上下文
+    chat completions 的请求参数，messages为list形式对话上下文，由 engine.py 并发发送
     """
-    response = client.chat.completions.create(
+    return dict(
         model="qwen3-235b-a22b",
         messages=messages,
         temperature=1,
     )
-    return response.choices[0].message.content
 
 # 新增风格
 styles = {
@@ -147,72 +138,49 @@ final_prompt_template = """
 请只返回这两句话，中间不要有多余其他说明。
 """
 
-def main():
-    roop_count = 2  # 循环次数
-    now_count = 0
-
-    conversations = []
-
-    for _ in range(roop_count):
-        for name in name_list:
-            for scene in scenes:
-                try:
-                    style_name = random.choice(list(styles.keys()))
-                    style_config = styles[style_name]
-
-                    if style_config["if_example"]:
-                        example = random.choice(style_config["examples"])
-                        style_prompt = style_config["style_temple"].format(example)
-                    else:
-                        style_prompt = style_config["style_temple"]
-
-                    extra_prompt = random.choice(random_finalprompt_sentence)
-
-                    prompt = final_prompt_template.format(
-                        name=name,
-                        scene=scene,
-                        style=style_prompt,
-                        extra=extra_prompt,
-                    )
-                    messages = [
-                        {
-                            "role": "system",
-                            "content": "你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。"
-                        },
-                        {
-                            "role": "user",
-                            "content": prompt,
-                        }
-                    ]
-
-                    response = get_data_openai(messages)
-                    now_count += 1
-
-                    conversation = {
-                        "conversation": [
-                            {
-                                "system": "你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。",
-                                "src_input": prompt,
-                                "style_name": style_name,
-                                "input": f"催婚回应给{name}，场景 {scene}，风格 {style_name}",
-                                "output": response,
-                            }
-                        ]
-                    }
-
-                    conversations.append(conversation)
-                    print(f"对象: {name}, 场景: {scene}, 风格: {style_name}, 回应:\n{response}")
-                    print(f"当前已生成数目: {now_count}")
+def build_items(plan):
+    """
+    由 planner.py 的计划生成每条任务的对话上下文
+    """
+    items = []
+    for task in plan:
+        style_config = styles[task["style_name"]]
+        if style_config["if_example"]:
+            style_prompt = style_config["style_temple"].format(task["example"])
+        else:
+            style_prompt = style_config["style_temple"]
+
+        prompt = final_prompt_template.format(
+            name=task["name"],
+            scene=task["scene"],
+            style=style_prompt,
+            extra=task["extra"],
+        )
+        messages = [
+            {
+                "role": "system",
+                "content": run.SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt,
+            }
+        ]
+        items.append(
+            {
+                "key": task["key"],
+                "name": task["name"],
+                "scene": task["scene"],
+                "style_name": task["style_name"],
+                "src_input": prompt,
+                "request": build_request(messages),
+            }
+        )
+    return items
 
-                except Exception as e:
-                    print(f"生成失败，错误: {e}")
-                    continue
 
-    now_time = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    file_path = f"marriage_responses_enhanced_{now_time}.json"
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(conversations, f, ensure_ascii=False, indent=4)
-    print(f"生成完毕，保存文件：{file_path}")
+def main():
+    run.main(name_list, scenes, styles, random_finalprompt_sentence, build_items, "marriage_responses_enhanced.json", reply_sep="\n")
 
 
 if __name__ == "__main__":
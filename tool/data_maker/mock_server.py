@@ -0,0 +1,177 @@
+"""
+本地模拟的 OpenAI 兼容接口，用来测试 engine.py，不消耗真实的 API 额度。
+
+每个请求先等待 latency ± jitter 秒，再返回由提示词生成的固定回复。
+设置 --tpm 后按令牌桶限制每分钟的 token 数（提示词加回复），超出时返回 429
+和 Retry-After；--error-rate 按比例返回 500，--fatal-rate 按比例返回重试也不会成功的 400，
+--empty-rate 按比例返回内容被过滤的空回复。/stats 返回请求数、同时在途的最大请求数、
+客户端用过的连接数、被限流、出错和空回复的次数，以及从第一个请求放行起实际达到的每分钟 token 数：
+
+    python mock_server.py --port 8001 --latency 2 --jitter 1 --tpm 60000
+"""
+import argparse
+import asyncio
+import hashlib
+import math
+import random
+import time
+
+from aiohttp import web
+
+
+def mock_reply(messages):
+    """
+    同样的提示词总是得到同样的回复
+    """
+    digest = hashlib.sha256(messages[-1]["content"].encode()).hexdigest()
+    return f"模拟回复 {digest[:12]}"
+
+
+class TokenBucket:
+    """
+    每秒补充 tpm / 60 个 token，最多攒 burst 秒的量
+    """
+
+    def __init__(self, tpm, burst=5.0):
+        self.rate = tpm / 60
+        self.capacity = self.rate * burst
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost):
+        """
+        够用时扣除 cost 并返回 0，否则返回还需等待的秒数
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+def error_response(status, message, error_type, headers=None):
+    return web.json_response(
+        {"error": {"message": message, "type": error_type, "code": None}},
+        status=status,
+        headers=headers,
+    )
+
+
+def create_app(latency=1.0, jitter=0.0, seed=0, tpm=None, burst=5.0, error_rate=0.0, fatal_rate=0.0, empty_rate=0.0):
+    rng = random.Random(seed)
+    bucket = TokenBucket(tpm, burst) if tpm else None
+    stats = {
+        "requests": 0,
+        "in_flight": 0,
+        "max_in_flight": 0,
+        "connections": 0,
+        "rate_limited": 0,
+        "errors": 0,
+        "fatal_errors": 0,
+        "empty_replies": 0,
+        "tokens": 0,
+        "tokens_per_minute": 0.0,
+    }
+    peers = set()
+    first_admitted = []
+
+    async def chat_completions(request):
+        body = await request.json()
+        stats["requests"] += 1
+        # 连接池复用连接时，同一个客户端端口会发来多个请求
+        peers.add(request.transport.get_extra_info("peername"))
+        stats["connections"] = len(peers)
+        content = mock_reply(body["messages"])
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"])
+        total_tokens = prompt_tokens + len(content)
+        if bucket is not None:
+            wait = bucket.take(total_tokens)
+            if wait > 0:
+                stats["rate_limited"] += 1
+                return error_response(
+                    429,
+                    "Rate limit reached for tokens per minute",
+                    "rate_limit_error",
+                    {"Retry-After": str(math.ceil(wait)), "retry-after-ms": str(int(wait * 1000))},
+                )
+        if not first_admitted:
+            first_admitted.append(time.monotonic())
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+        finally:
+            stats["in_flight"] -= 1
+        draw = rng.random()
+        if draw < error_rate:
+            stats["errors"] += 1
+            return error_response(500, "The server had an error", "server_error")
+        if draw < error_rate + fatal_rate:
+            stats["fatal_errors"] += 1
+            return error_response(400, "Invalid request", "invalid_request_error")
+        finish_reason = "stop"
+        if draw < error_rate + fatal_rate + empty_rate:
+            stats["empty_replies"] += 1
+            content = None
+            finish_reason = "content_filter"
+        # 令牌桶按放行时计数，吞吐也从第一个请求放行时算起
+        stats["tokens"] += total_tokens
+        elapsed = time.monotonic() - first_admitted[0]
+        if elapsed > 0:
+            stats["tokens_per_minute"] = stats["tokens"] * 60 / elapsed
+        return web.json_response(
+            {
+                "id": f"chatcmpl-mock-{stats['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": finish_reason,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content or ""),
+                    "total_tokens": total_tokens,
+                },
+            }
+        )
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟的 OpenAI 兼容接口")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=1.0, help="每个请求的平均延迟，秒")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机浮动，秒")
+    parser.add_argument("--tpm", type=int, default=None, help="每分钟最多的 token 数")
+    parser.add_argument("--burst", type=float, default=5.0, help="令牌桶最多攒几秒的 token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--fatal-rate", type=float, default=0.0, help="返回 400 的比例，重试也不会成功")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="返回空回复的比例，像被内容过滤")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(
+            args.latency, args.jitter, args.seed, args.tpm, args.burst, args.error_rate, args.fatal_rate, args.empty_rate
+        ),
+        host=args.host,
+        port=args.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+按覆盖率规划生成任务，代替逐轮随机选择风格和附加要求，get_data_v1.py 和 get_data_v2.py 共用。
+
+一条任务是 对象 × 场景 × 风格 × 附加要求 的一个组合。逐轮随机选择会重复抽到同样的组合，
+也会漏掉一些搭配。make_plan 按对角线顺序轮流排列 对象 × 场景，任意前缀里各对象、各场景
+出现的次数都接近；再为每条任务贪心地选择能覆盖最多新的两两搭配（pairwise）的风格和附加要求，
+一样多时选用得最少的，组合不会重复。seed 相同时，任务少的计划是任务多的计划的前缀。
+
+计划存成 JSON，重新运行时读取同一份计划，配合 records.py 接着生成。
+直接运行本文件，比较计划与原来逐轮随机选择的覆盖率：
+
+    python planner.py --data v2 --samples 700 1400 2800 7000
+"""
+import argparse
+import json
+import math
+import os
+import random
+from collections import Counter
+from itertools import combinations
+
+
+def _cells(names, scenes):
+    """
+    对象 × 场景 按对角线轮流排列，每 len(names) × len(scenes) 个覆盖一遍全部格子
+    """
+    while True:
+        for d in range(len(scenes)):
+            for i, name in enumerate(names):
+                yield name, scenes[(i + d) % len(scenes)]
+
+
+def _task(name, scene, style_name, example, extra):
+    return {
+        "key": f"{name}|{scene}|{style_name}|{extra}",
+        "name": name,
+        "scene": scene,
+        "style_name": style_name,
+        "example": example,
+        "extra": extra,
+    }
+
+
+def make_plan(names, scenes, styles, extras, samples, seed=0):
+    """
+    styles 为脚本里的风格表。返回 samples 条组合不重复的任务，超过组合总数时返回全部组合。
+    有示例的风格按使用次数轮流选用示例
+    """
+    rng = random.Random(seed)
+    options = [(style_name, extra) for style_name in styles for extra in extras]
+    samples = min(samples, len(names) * len(scenes) * len(options))
+    covered = set()
+    used = set()
+    style_counts = Counter()
+    extra_counts = Counter()
+    plan = []
+    for name, scene in _cells(names, scenes):
+        if len(plan) == samples:
+            break
+
+        def pairs(option):
+            style_name, extra = option
+            return [
+                ("name", name, style_name),
+                ("scene", scene, style_name),
+                ("name", name, extra),
+                ("scene", scene, extra),
+                ("style", style_name, extra),
+            ]
+
+        def score(option):
+            new = sum(pair not in covered for pair in pairs(option))
+            return (-new, style_counts[option[0]] + extra_counts[option[1]], rng.random())
+
+        # 每一轮每个格子只取一个组合，取完全部组合之前总有没用过的
+        style_name, extra = min((o for o in options if (name, scene) + o not in used), key=score)
+        covered.update(pairs((style_name, extra)))
+        used.add((name, scene, style_name, extra))
+        example = None
+        if styles[style_name]["if_example"]:
+            examples = styles[style_name]["examples"]
+            example = examples[style_counts[style_name] % len(examples)]
+        style_counts[style_name] += 1
+        extra_counts[extra] += 1
+        plan.append(_task(name, scene, style_name, example, extra))
+    return plan
+
+
+def random_plan(names, scenes, styles, extras, samples, seed=0):
+    """
+    原来的方案：逐轮遍历 对象 × 场景，用随机数选择风格、示例和附加要求，用来比较覆盖率
+    """
+    plan = []
+    for round_index in range(math.ceil(samples / (len(names) * len(scenes)))):
+        for name in names:
+            for scene in scenes:
+                rng = random.Random(f"{seed}|{round_index}|{name}|{scene}")
+                style_name = rng.choice(list(styles.keys()))
+                example = None
+                if styles[style_name]["if_example"]:
+                    example = rng.choice(styles[style_name]["examples"])
+                plan.append(_task(name, scene, style_name, example, rng.choice(extras)))
+    return plan[:samples]
+
+
+def coverage(plan, names, scenes, styles, extras):
+    """
+    不重复的组合数、被覆盖的两两搭配数、第几次调用时覆盖了全部两两搭配，
+    以及每个两两搭配出现次数的最小值和最大值，越接近越均匀
+    """
+    levels = [names, scenes, list(styles), extras]
+    fields = ["name", "scene", "style_name", "extra"]
+    all_pairs = [(i, j, a, b) for i, j in combinations(range(len(levels)), 2) for a in levels[i] for b in levels[j]]
+    pair_counts = Counter()
+    full_at = None
+    for calls, task in enumerate(plan, 1):
+        combo = [task[field] for field in fields]
+        pair_counts.update((i, j, combo[i], combo[j]) for i, j in combinations(range(len(fields)), 2))
+        if full_at is None and len(pair_counts) == len(all_pairs):
+            full_at = calls
+    counts = [pair_counts[pair] for pair in all_pairs]
+    return {
+        "calls": len(plan),
+        "combos": len({tuple(task[field] for field in fields) for task in plan}),
+        "grid": math.prod(len(level) for level in levels),
+        "pairs": len(pair_counts),
+        "all_pairs": len(all_pairs),
+        "full_at": full_at,
+        "min_count": min(counts),
+        "max_count": max(counts),
+    }
+
+
+def format_coverage(stats):
+    return (
+        f"{stats['calls']} 次调用，不重复组合 {stats['combos']}（重复 {stats['calls'] - stats['combos']}，"
+        f"占全部 {stats['grid']} 个组合的 {stats['combos'] / stats['grid']:.1%}），"
+        f"两两搭配覆盖 {stats['pairs']}/{stats['all_pairs']}（第 {stats['full_at'] or '-'} 次调用时全部覆盖），"
+        f"每个搭配出现 {stats['min_count']}~{stats['max_count']} 次"
+    )
+
+
+def save_plan(path, plan, seed):
+    """
+    先写临时文件再替换，中途失败不会留下残缺的计划
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"seed": seed, "samples": len(plan), "tasks": plan}, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load_plan(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["tasks"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较覆盖率计划与逐轮随机选择")
+    parser.add_argument("--data", choices=["v1", "v2"], default="v2", help="使用哪个脚本的对象、场景和风格表")
+    parser.add_argument("--samples", type=int, nargs="+", default=[700, 1400, 2800, 7000], help="任务数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.data == "v1":
+        import get_data_v1 as data
+    else:
+        import get_data_v2 as data
+    tables = (data.name_list, data.scenes, data.styles, data.random_finalprompt_sentence)
+    for samples in args.samples:
+        print(f"任务数 {samples}")
+        print("  随机:", format_coverage(coverage(random_plan(*tables, samples, args.seed), *tables)))
+        print("  计划:", format_coverage(coverage(make_plan(*tables, samples, args.seed), *tables)))
+
+
+if __name__ == "__main__":
+    main()
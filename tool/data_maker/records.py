@@ -0,0 +1,50 @@
+"""
+生成结果的 JSONL 文件，get_data_v1.py 和 get_data_v2.py 共用。
+
+每条数据带一个稳定的 key，完成后立即追加一行并 flush，程序崩溃最多丢掉写了一半的
+最后一行。重新运行同一命令时跳过已完成的 key，只生成缺少的；最后 compact
+按任务顺序把它整理成 xtuner 需要的 JSON 文件。
+"""
+import json
+import os
+
+
+def load_done_keys(path):
+    """
+    已完成的 key。崩溃时写了一半的最后一行会被截掉，这条数据重新生成
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return {json.loads(line)["key"] for line in data[:end].splitlines()}
+
+
+def append_record(f, key, conversation):
+    """
+    写入一行并立即 flush，不等到整个运行结束
+    """
+    record = {"key": key, "conversation": conversation}
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f.flush()
+
+
+def compact(jsonl_path, json_path, keys):
+    """
+    按 keys 的顺序把 JSONL 里的数据写成 xtuner 的 JSON 格式，与各条完成的先后无关。
+    先写临时文件再替换，中途失败不会留下残缺的 JSON
+    """
+    conversations = {}
+    with open(jsonl_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            conversations[record["key"]] = record["conversation"]
+    data = [{"conversation": conversations[key]} for key in keys if key in conversations]
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, json_path)
+    return len(data)
@@ -0,0 +1,116 @@
+"""
+get_data_v1.py 和 get_data_v2.py 共用的运行流程：命令行参数、任务计划、断点续跑、回复缓存、
+并发请求和最后写出的 json 文件。两个脚本只保留各自的对象、场景、风格表和提示词模板。
+"""
+import argparse
+import os
+
+from cache import DEFAULT_PATH, CompletionCache, occurrences
+from engine import run
+from planner import coverage, format_coverage, load_plan, make_plan, save_plan
+from records import append_record, compact, load_done_keys
+
+SYSTEM_PROMPT = "你现在是一个擅长应对长辈催婚的年轻人，善于用不同风格巧妙且礼貌地回应长辈。"
+
+
+def parse_args(default_output):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roop-count", type=int, default=2, help="循环次数，未指定 --samples 时任务数为 循环次数 × 对象数 × 场景数")
+    parser.add_argument("--samples", type=int, default=None, help="任务数，按覆盖率规划不重复的 对象 × 场景 × 风格 × 附加要求 组合")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时在途的请求数")
+    parser.add_argument("--seed", type=int, default=0, help="规划任务时的随机种子")
+    parser.add_argument(
+        "--output",
+        default=default_output,
+        help="输出的 json 文件，生成中的数据追加在同名的 .jsonl 里，重新运行同一命令会接着生成",
+    )
+    parser.add_argument("--max-retries", type=int, default=8, help="限流、超时等错误的最多重试次数")
+    parser.add_argument("--plan", default=None, help="任务计划的 json 文件，默认在输出文件旁，已存在时直接使用")
+    parser.add_argument("--dead-letter", default=None, help="最终失败的请求写入的 jsonl 文件，默认在输出文件旁")
+    parser.add_argument("--cache", default=DEFAULT_PATH, help="回复缓存的 SQLite 文件，同样的请求不再重复发送")
+    parser.add_argument("--no-cache", action="store_true", help="不读也不写回复缓存")
+    parser.add_argument(
+        "--cache-samples",
+        type=int,
+        default=1,
+        help="同一个请求最多缓存几个不同的回复，计划里的请求互不相同，一般不需要更多",
+    )
+    parser.add_argument("--cache-max-entries", type=int, default=None, help="缓存最多保留的回复数，超出时淘汰最久未用的")
+    return parser.parse_args()
+
+
+def main(name_list, scenes, styles, extras, build_items, default_output, reply_sep=" "):
+    """
+    build_items 由计划生成任务，每条任务含 key、name、scene、style_name、
+    src_input（写进数据的提示词）和 request（chat completions 的请求参数）。
+    reply_sep 是打印回应前的分隔符，多行的回应用换行
+    """
+    args = parse_args(default_output)
+
+    file_path = args.output
+    jsonl_path = os.path.splitext(file_path)[0] + ".jsonl"
+    dead_letter_path = args.dead_letter or os.path.splitext(file_path)[0] + "_dead_letter.jsonl"
+    if os.path.exists(dead_letter_path):
+        # 只记录本次运行的失败，之前失败的这次会重新生成
+        os.remove(dead_letter_path)
+
+    plan_path = args.plan or os.path.splitext(file_path)[0] + "_plan.json"
+    if os.path.exists(plan_path):
+        # 重新运行时沿用同一份计划，删除计划文件后才会重新规划
+        plan = load_plan(plan_path)
+        print(f"使用已有的任务计划：{plan_path}，删除后才会按 --samples 和 --seed 重新规划")
+    else:
+        samples = args.samples or args.roop_count * len(name_list) * len(scenes)
+        plan = make_plan(name_list, scenes, styles, extras, samples, args.seed)
+        save_plan(plan_path, plan, args.seed)
+        print(f"任务计划已保存：{plan_path}")
+    print("计划覆盖率:", format_coverage(coverage(plan, name_list, scenes, styles, extras)))
+
+    items = build_items(plan)
+    requests = [item["request"] for item in items]
+    # 按全部任务计算，已完成哪些不影响每个任务用缓存里的第几个回复
+    samples = occurrences(requests)
+    done = load_done_keys(jsonl_path)
+    todo = [i for i, item in enumerate(items) if item["key"] not in done]
+    print(f"共 {len(items)} 条，已完成 {len(items) - len(todo)} 条，本次生成 {len(todo)} 条")
+
+    cache = None
+    if not args.no_cache:
+        cache = CompletionCache(args.cache, args.cache_samples, args.cache_max_entries)
+
+    with open(jsonl_path, "a", encoding="utf-8") as f:
+
+        def on_result(index, response):
+            item = items[todo[index]]
+            append_record(
+                f,
+                item["key"],
+                [
+                    {
+                        "system": SYSTEM_PROMPT,
+                        "src_input": item["src_input"],
+                        "style_name": item["style_name"],
+                        "input": f"催婚回应给{item['name']}，场景 {item['scene']}，风格 {item['style_name']}",
+                        "output": response,
+                    }
+                ],
+            )
+            print(f"对象: {item['name']}, 场景: {item['scene']}, 风格: {item['style_name']}, 回应:{reply_sep}{response}")
+
+        run(
+            [requests[i] for i in todo],
+            concurrency=args.concurrency,
+            on_result=on_result,
+            max_retries=args.max_retries,
+            dead_letter_path=dead_letter_path,
+            cache=cache,
+            samples=[samples[i] for i in todo],
+        )
+    if cache is not None:
+        cache.close()
+
+    num_done = compact(jsonl_path, file_path, [item["key"] for item in items])
+    print(f"当前已生成数目: {num_done}")
+    print(f"生成完毕，保存文件：{file_path}")
+    if num_done < len(items):
+        print(f"{len(items) - num_done} 条生成失败，见 {dead_letter_path}，重新运行同一命令会补上")
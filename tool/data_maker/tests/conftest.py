@@ -0,0 +1,41 @@
+import contextlib
+import os
+import sys
+
+import httpx
+import pytest
+from aiohttp import web
+
+# data_maker 的脚本互相按顶层模块导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_server import create_app  # noqa: E402
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """
+    在当前事件循环里启动 mock_server，engine.make_client 连到它。
+    用法：async with mock_api(latency=0.1) as stats: ...，stats() 返回 /stats
+    """
+
+    @contextlib.asynccontextmanager
+    async def start(**kwargs):
+        runner = web.AppRunner(create_app(**kwargs))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        base_url = "http://127.0.0.1:{}".format(runner.addresses[0][1])
+        monkeypatch.setenv("OPENAI_API_BASE", base_url + "/v1")
+        monkeypatch.setenv("DASHSCOPE_API_KEY", "test")
+
+        async def stats():
+            async with httpx.AsyncClient() as client:
+                return (await client.get(base_url + "/stats")).json()
+
+        try:
+            yield stats
+        finally:
+            await runner.cleanup()
+
+    return start
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from cache import CompletionCache
+from engine import complete_all
+from mock_server import mock_reply
+
+TPM = 120000
+BURST = 1.0
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """
+    退避按秒计，测试里缩短到毫秒
+    """
+    monkeypatch.setattr("engine.backoff", lambda attempt: 0.001 * 2**attempt)
+
+
+def make_requests(num_requests, length=100):
+    return [
+        {"model": "mock", "messages": [{"role": "user", "content": f"{i:04d}" + "催" * length}]}
+        for i in range(num_requests)
+    ]
+
+
+def read_dead_letter(path):
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_rate_limited_run_drops_nothing(mock_api, tmp_path, capsys):
+    """
+    限流、500 和空回复都重试到成功，dead letter 里只有注入的 400，吞吐接近 TPM 上限
+    """
+    requests = make_requests(150)
+    dead_letter_path = tmp_path / "dead_letter.jsonl"
+
+    async def scenario():
+        async with mock_api(
+            latency=0.2, jitter=0.1, tpm=TPM, burst=BURST, error_rate=0.05, fatal_rate=0.02, empty_rate=0.05
+        ) as stats:
+            start = time.monotonic()
+            results = await complete_all(requests, concurrency=32, dead_letter_path=str(dead_letter_path))
+            return results, time.monotonic() - start, await stats()
+
+    results, elapsed, stats = asyncio.run(scenario())
+    assert stats["rate_limited"] > 0 and stats["errors"] > 0 and stats["empty_replies"] > 0
+    dead_letter = read_dead_letter(dead_letter_path)
+    assert len(dead_letter) == stats["fatal_errors"] > 0
+    assert all(record["status"] == 400 for record in dead_letter)
+    assert {i for i, text in enumerate(results) if text is None} == {record["index"] for record in dead_letter}
+    # 令牌桶最多多放行 BURST 秒的量，失败的请求也占了令牌
+    assert 0.85 * TPM <= stats["tokens_per_minute"] <= TPM * (1 + BURST / elapsed)
+
+
+def test_empty_replies_are_dead_lettered(mock_api, tmp_path, capsys):
+    dead_letter_path = tmp_path / "dead_letter.jsonl"
+
+    async def scenario():
+        async with mock_api(latency=0.0, empty_rate=1.0):
+            return await complete_all(make_requests(3), max_retries=1, dead_letter_path=str(dead_letter_path))
+
+    assert asyncio.run(scenario()) == [None] * 3
+    dead_letter = read_dead_letter(dead_letter_path)
+    assert sorted(record["index"] for record in dead_letter) == [0, 1, 2]
+    assert all(record["error"].startswith("EmptyReplyError") and record["attempts"] == 2 for record in dead_letter)
+    assert "失败 3" in capsys.readouterr().out
+
+
+def test_results_in_input_order(mock_api, capsys):
+    requests = make_requests(40, length=10)
+    finished = []
+
+    async def scenario():
+        async with mock_api(latency=0.05, jitter=0.05, seed=1):
+            return await complete_all(requests, concurrency=8, on_result=lambda index, text: finished.append(index))
+
+    results = asyncio.run(scenario())
+    assert results == [mock_reply(request["messages"]) for request in requests]
+    # 随机延迟下完成的先后与请求顺序不同
+    assert sorted(finished) == list(range(len(requests))) != finished
+
+
+def test_in_flight_within_concurrency(mock_api, capsys):
+    async def scenario():
+        async with mock_api(latency=0.05, jitter=0.02) as stats:
+            await complete_all(make_requests(40, length=10), concurrency=4)
+            return await stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["max_in_flight"] == 4
+    assert stats["connections"] <= 4
+
+
+def test_identical_requests_sent_once(mock_api, tmp_path, capsys):
+    """
+    同样的请求同时在途时只发一次，其余的等它的结果
+    """
+    requests = make_requests(5, length=10) * 4
+    cache = CompletionCache(str(tmp_path / "completions.sqlite3"))
+
+    async def scenario():
+        async with mock_api(latency=0.1) as stats:
+            results = await complete_all(requests, concurrency=20, cache=cache)
+            return results, await stats()
+
+    results, stats = asyncio.run(scenario())
+    cache.close()
+    assert stats["requests"] == 5
+    assert results == [mock_reply(request["messages"]) for request in requests]
+    assert "缓存命中率: 15/20" in capsys.readouterr().out
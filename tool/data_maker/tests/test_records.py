@@ -0,0 +1,30 @@
+import json
+
+from records import append_record, compact, load_done_keys
+
+
+def test_resume_after_torn_line(tmp_path):
+    jsonl_path = tmp_path / "responses.jsonl"
+    with open(jsonl_path, "w", encoding="utf-8") as f:
+        append_record(f, "b", [{"output": "回复 b"}])
+        append_record(f, "a", [{"output": "回复 a"}])
+        # 崩溃时只写了一半的最后一行
+        f.write('{"key": "c", "conversation": [{"outp')
+
+    assert load_done_keys(jsonl_path) == {"a", "b"}
+    with open(jsonl_path, encoding="utf-8") as f:
+        assert [json.loads(line)["key"] for line in f] == ["b", "a"]
+
+    # 接着生成缺少的 c，整理时按任务顺序
+    with open(jsonl_path, "a", encoding="utf-8") as f:
+        append_record(f, "c", [{"output": "回复 c"}])
+    assert load_done_keys(jsonl_path) == {"a", "b", "c"}
+    json_path = tmp_path / "responses.json"
+    assert compact(str(jsonl_path), str(json_path), ["a", "b", "c", "d"]) == 3
+    with open(json_path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert [conversation["conversation"][0]["output"] for conversation in data] == ["回复 a", "回复 b", "回复 c"]
+
+
+def test_no_records_yet(tmp_path):
+    assert load_done_keys(tmp_path / "missing.jsonl") == set()